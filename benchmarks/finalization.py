@@ -0,0 +1,44 @@
+"""Benchmark of the finalization of builders.
+
+Reports the throughput of `kwant.Builder.finalized` in sites per second for
+square lattices of increasing size, with constant and with function values.
+
+Usage: python finalization.py [max_linear_size]
+"""
+
+import sys
+import time
+
+import kwant
+
+
+def make_builder(L, values):
+    lat = kwant.lattice.square(norbs=1)
+    syst = kwant.Builder()
+    if values == 'functions':
+        syst[(lat(x, y) for x in range(L) for y in range(L))] = (
+            lambda site, V: 4 + V)
+        syst[lat.neighbors()] = lambda site1, site2, t: -t
+    else:
+        syst[(lat(x, y) for x in range(L) for y in range(L))] = 4
+        syst[lat.neighbors()] = -1
+    return syst
+
+
+def main(max_size=800):
+    print('{:>10} {:>10} {:>10} {:>12}'.format(
+        'values', 'sites', 'time [s]', 'sites/s'))
+    L = 100
+    while L <= max_size:
+        for values in ['constants', 'functions']:
+            syst = make_builder(L, values)
+            start = time.perf_counter()
+            syst.finalized()
+            duration = time.perf_counter() - start
+            print('{:>10} {:>10} {:>10.3f} {:>12.0f}'.format(
+                values, L * L, duration, L * L / duration))
+        L *= 2
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,50 @@
+"""Benchmark of the recursive Green's function solver.
+
+Reports the time taken by `kwant.solvers.rgf.smatrix` and
+`kwant.solvers.rgf.ldos` for square-lattice wires of fixed width and
+increasing length, together with the time per unit length, which stays
+constant if the solver scales linearly with the length.  The sparse solver is
+timed for comparison.
+
+Usage: python rgf.py [width] [max_length]
+"""
+
+import sys
+import time
+
+import kwant
+from kwant.solvers import rgf, sparse
+
+
+def make_wire(W, L):
+    lat = kwant.lattice.square(norbs=1)
+    syst = kwant.Builder()
+    syst[(lat(x, y) for x in range(L) for y in range(W))] = 4
+    syst[lat.neighbors()] = -1
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(lat(0, y) for y in range(W))] = 4
+    lead[lat.neighbors()] = -1
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    return syst.finalized()
+
+
+def main(W=40, max_length=4000):
+    print('{:>8} {:>8} {:>10} {:>14}'.format(
+        'length', 'what', 'time [s]', 'time/length'))
+    L = 500
+    while L <= max_length:
+        syst = make_wire(W, L)
+        for what, function in [('rgf', rgf.smatrix),
+                               ('sparse', sparse.smatrix),
+                               ('rgf ldos', rgf.ldos)]:
+            start = time.perf_counter()
+            function(syst, 0.5)
+            duration = time.perf_counter() - start
+            print('{:>8} {:>8} {:>10.3f} {:>14.2e}'.format(
+                L, what, duration, duration / L))
+        L *= 2
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
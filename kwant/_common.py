@@ -12,8 +12,10 @@ import numbers
 import inspect
 import warnings
 import importlib
+import threading
 from contextlib import contextmanager
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from copy import deepcopy
 
 __all__ = ['KwantDeprecationWarning', 'UserCodeError']
 
@@ -125,6 +127,93 @@ def get_parameters(func):
     return _Params(required_params, default_params, takes_kwargs)
 
 
+def nbytes(obj):
+    """Estimate the memory in bytes occupied by the arrays in 'obj'.
+
+    NumPy arrays are looked for in 'obj' itself, in tuples and lists, and in
+    the attributes of objects.
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(nbytes(item) for item in obj)
+    if hasattr(obj, '__dict__'):
+        return sum(nbytes(value) for value in vars(obj).values())
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    """A least-recently-used cache that is bounded by memory.
+
+    The cache stores copies of the values, and returns copies on lookup,
+    such that modifying values outside of the cache does not corrupt it.
+    When the total size of the stored values (as estimated by `nbytes`)
+    exceeds 'max_bytes', the least recently used entries are dropped.  The
+    contents of the cache are not pickled.
+    """
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._max_bytes = value
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self._max_bytes:
+            self._bytes -= self._entries.popitem(last=False)[1][1]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get(self, key, compute):
+        """Return the value for 'key', calling 'compute()' if it is missing.
+
+        Keys that are not hashable are never cached.
+        """
+        try:
+            hash(key)
+        except TypeError:
+            return compute()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            return deepcopy(entry[0])
+
+        value = compute()
+        size = nbytes(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (deepcopy(value), size)
+                self._bytes += size
+            self._evict()
+        return value
+
+
 class lazy_import:
     def __init__(self, module, package='kwant', deprecation_warning=False):
         if module.startswith('.') and not package:
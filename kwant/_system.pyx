@@ -20,6 +20,64 @@ from .graph.defs import gint_dtype
 msg = ('Hopping from site {0} to site {1} does not match the '
        'dimensions of onsite Hamiltonians of these sites.')
 
+
+def vectorized_entries(vectorized, to_norb, to_off, from_norb, from_off,
+                       indices=True):
+    """For internal use by hamiltonian_submatrix.
+
+    Return the row and column indices and the values of the matrix elements
+    that stem from vectorized value functions.  Only used when the full
+    Hamiltonian is requested, hence row and column offsets coincide.  If
+    'indices' is false, only the values are returned.
+    """
+    onsite_mask, hopping_mask, onsites, hoppings = vectorized
+    to_norb = np.asarray(to_norb)
+    to_off = np.asarray(to_off)
+    from_norb = np.asarray(from_norb)
+    from_off = np.asarray(from_off)
+
+    all_rows, all_cols, all_data = [], [], []
+    for site_ids, values in onsites:
+        bad = to_norb[site_ids] != values.shape[1]
+        if values.shape[1] != values.shape[2] or bad.any():
+            site = site_ids[np.argmax(bad)]
+            raise ValueError(msg.format(site, site))
+        all_data.append(values.ravel())
+        if not indices:
+            continue
+        n_i, n_j = values.shape[1:]
+        rows = to_off[site_ids, None, None] + np.arange(n_i)[:, None]
+        cols = from_off[site_ids, None, None] + np.arange(n_j)
+        rows, cols = np.broadcast_arrays(rows, cols)
+        all_rows.append(rows.ravel())
+        all_cols.append(cols.ravel())
+
+    for tails, heads, values in hoppings:
+        bad = ((to_norb[tails] != values.shape[1])
+               | (from_norb[heads] != values.shape[2]))
+        if bad.any():
+            i = np.argmax(bad)
+            raise ValueError(msg.format(heads[i], tails[i]))
+        n_i, n_j = values.shape[1:]
+        values = values.ravel()
+        all_data.extend((values, values.conjugate()))
+        if not indices:
+            continue
+        rows = to_off[tails, None, None] + np.arange(n_i)[:, None]
+        cols = from_off[heads, None, None] + np.arange(n_j)
+        rows, cols = np.broadcast_arrays(rows, cols)
+        rows, cols = rows.ravel(), cols.ravel()
+        all_rows.extend((rows, cols))
+        all_cols.extend((cols, rows))
+
+    data = np.concatenate(all_data) if all_data else np.empty(0, complex)
+    if not indices:
+        return data
+    if not all_data:
+        return np.empty(0, gint_dtype), np.empty(0, gint_dtype), data
+    return np.concatenate(all_rows), np.concatenate(all_cols), data
+
+
 @cython.boundscheck(False)
 def make_sparse(ham, args, params, CGraph gr, diag,
                 gint [:] from_sites, n_by_to_site,
@@ -100,49 +158,70 @@ def make_sparse(ham, args, params, CGraph gr, diag,
 @cython.boundscheck(False)
 def make_sparse_full(ham, args, params, CGraph gr, diag,
                      gint [:] to_norb, gint [:] to_off,
-                     gint [:] from_norb, gint [:] from_off):
+                     gint [:] from_norb, gint [:] from_off,
+                     vectorized=None):
     """For internal use by hamiltonian_submatrix."""
     cdef gintArraySlice nbors
-    cdef gint n, fs, ts
+    cdef gint n, fs, ts, nb
     cdef gint i, j, num_entries
     cdef complex [:, :] h
     cdef gint [:, :] rows_cols
     cdef complex [:] data
     cdef complex value
+    cdef signed char [:] onsite_mask = None, hopping_mask = None
 
     matrix = ta.matrix
     n = gr.num_nodes
 
+    if vectorized is not None:
+        onsite_mask, hopping_mask = vectorized[:2]
+        vec_rows, vec_cols, vec_data = vectorized_entries(
+            vectorized, to_norb, to_off, from_norb, from_off)
+        nonzero = vec_data != 0
+        vec_rows = vec_rows[nonzero]
+        vec_cols = vec_cols[nonzero]
+        vec_data = vec_data[nonzero]
+
     # Calculate the data size.
     num_entries = 0
     for fs in range(n):
-        num_entries += from_norb[fs] * from_norb[fs]
+        if onsite_mask is None or not onsite_mask[fs]:
+            num_entries += from_norb[fs] * from_norb[fs]
         nbors = gr.out_neighbors(fs)
-        for ts in nbors.data[:nbors.size]:
-            if fs < ts:
+        for nb in range(nbors.size):
+            ts = nbors.data[nb]
+            if fs < ts and (hopping_mask is None or
+                            not hopping_mask[gr.heads_idxs[fs] + nb]):
                 num_entries += 2 * to_norb[ts] * from_norb[fs]
+    if vectorized is not None:
+        num_entries += len(vec_data)
 
     rows_cols = np.empty((2, num_entries), gint_dtype)
     data = np.empty(num_entries, complex)
 
     cdef gint k = 0
     for fs in range(n):
-        h = diag[fs]
-        if not (h.shape[0] == h.shape[1] == from_norb[fs]):
-            raise ValueError(msg.format(fs, fs))
-        for i in range(h.shape[0]):
-            for j in range(h.shape[1]):
-                value = h[i, j]
-                if value != 0:
-                    data[k] = value
-                    rows_cols[0, k] = i + to_off[fs]
-                    rows_cols[1, k] = j + from_off[fs]
-                    k += 1
+        if onsite_mask is None or not onsite_mask[fs]:
+            h = diag[fs]
+            if not (h.shape[0] == h.shape[1] == from_norb[fs]):
+                raise ValueError(msg.format(fs, fs))
+            for i in range(h.shape[0]):
+                for j in range(h.shape[1]):
+                    value = h[i, j]
+                    if value != 0:
+                        data[k] = value
+                        rows_cols[0, k] = i + to_off[fs]
+                        rows_cols[1, k] = j + from_off[fs]
+                        k += 1
 
         nbors = gr.out_neighbors(fs)
-        for ts in nbors.data[:nbors.size]:
+        for nb in range(nbors.size):
+            ts = nbors.data[nb]
             if ts < fs:
                 continue
+            if (hopping_mask is not None and
+                hopping_mask[gr.heads_idxs[fs] + nb]):
+                continue
             h = matrix(ham(ts, fs, *args, params=params), complex)
             if h.shape[0] != to_norb[ts] or h.shape[1] != from_norb[fs]:
                 raise ValueError(msg.format(fs, ts))
@@ -164,6 +243,12 @@ def make_sparse_full(ham, args, params, CGraph gr, diag,
     np_to_off = np.asarray(to_off)
     np_from_off = np.asarray(from_off)
 
+    if vectorized is not None:
+        np_data[k : k + len(vec_data)] = vec_data
+        np_rows_cols[0, k : k + len(vec_data)] = vec_rows
+        np_rows_cols[1, k : k + len(vec_data)] = vec_cols
+        k += len(vec_data)
+
     return sp.coo_matrix((np_data[:k], np_rows_cols[:, :k]),
                          shape=(np_to_off[-1], np_from_off[-1]))
 
@@ -209,28 +294,41 @@ def make_dense(ham, args, params, CGraph gr, diag,
 @cython.boundscheck(False)
 def make_dense_full(ham, args, params, CGraph gr, diag,
                     gint [:] to_norb, gint [:] to_off,
-                    gint [:] from_norb, gint [:] from_off):
+                    gint [:] from_norb, gint [:] from_off,
+                    vectorized=None):
     """For internal use by hamiltonian_submatrix."""
     cdef gintArraySlice nbors
-    cdef gint n, fs, ts
+    cdef gint n, fs, ts, nb
     cdef complex [:, :] h_sub_view, h, h_herm
+    cdef signed char [:] onsite_mask = None, hopping_mask = None
 
     matrix = ta.matrix
     n = gr.num_nodes
 
     h_sub = np.zeros((to_off[-1], from_off[-1]), complex)
     h_sub_view = h_sub
+    if vectorized is not None:
+        onsite_mask, hopping_mask = vectorized[:2]
+        rows, cols, data = vectorized_entries(vectorized, to_norb, to_off,
+                                              from_norb, from_off)
+        h_sub[rows, cols] = data
+
     for fs in range(n):
-        h = diag[fs]
-        if not (h.shape[0] ==  h.shape[1] == from_norb[fs]):
-            raise ValueError(msg.format(fs, fs))
-        h_sub_view[to_off[fs] : to_off[fs + 1],
-                   from_off[fs] : from_off[fs + 1]] = h
+        if onsite_mask is None or not onsite_mask[fs]:
+            h = diag[fs]
+            if not (h.shape[0] ==  h.shape[1] == from_norb[fs]):
+                raise ValueError(msg.format(fs, fs))
+            h_sub_view[to_off[fs] : to_off[fs + 1],
+                       from_off[fs] : from_off[fs + 1]] = h
 
         nbors = gr.out_neighbors(fs)
-        for ts in nbors.data[:nbors.size]:
+        for nb in range(nbors.size):
+            ts = nbors.data[nb]
             if ts < fs:
                 continue
+            if (hopping_mask is not None and
+                hopping_mask[gr.heads_idxs[fs] + nb]):
+                continue
             h = mat = matrix(ham(ts, fs, *args, params=params), complex)
             h_herm = mat.transpose().conjugate()
             if h.shape[0] != to_norb[ts] or h.shape[1] != from_norb[fs]:
@@ -242,6 +340,211 @@ def make_dense_full(ham, args, params, CGraph gr, diag,
     return h_sub
 
 
+def full_diag(self, args, params, vectorized):
+    """For internal use by hamiltonian_submatrix and AssemblyPlan.
+
+    Return the onsite Hamiltonians of all the sites and their numbers of
+    orbitals.  The onsite Hamiltonians of sites with vectorized values are
+    not evaluated, their entries are ``None``.
+    """
+    cdef gint site, n
+    cdef gint [:] norb
+
+    ham = self.hamiltonian
+    n = self.graph.num_nodes
+    matrix = ta.matrix
+
+    diag = n * [None]
+    norb = np.empty(n, gint_dtype)
+    if vectorized is not None:
+        onsite_mask = vectorized[0]
+        for site_ids, values in vectorized[2]:
+            np.asarray(norb)[site_ids] = values.shape[1]
+    for site in range(n):
+        if vectorized is not None and onsite_mask[site]:
+            continue
+        diag[site] = h = matrix(ham(site, site, *args, params=params),
+                                complex)
+        norb[site] = h.shape[0]
+    return diag, np.asarray(norb)
+
+
+@cython.boundscheck(False)
+def fill_sparse_full(ham, args, params, CGraph gr, diag,
+                     gint [:] norb, gint [:] off, vectorized,
+                     complex [:] data, gint [:] positions=None,
+                     gint [:, :] rows_cols=None):
+    """For internal use by AssemblyPlan.
+
+    Store all the entries of the full Hamiltonian, including the ones that are
+    zero, in 'data'.  The k-th entry is stored at 'positions[k]', or at 'k' if
+    no positions are given.  The enumeration of the entries only depends on
+    the graph and on the numbers of orbitals of the sites.  If 'rows_cols' is
+    given, the row and column indices of the k-th entry are stored in
+    ``rows_cols[:, k]``.
+    """
+    cdef gintArraySlice nbors
+    cdef gint n, fs, ts, nb
+    cdef gint i, j, k, p
+    cdef complex [:, :] h
+    cdef signed char [:] onsite_mask = None, hopping_mask = None
+    cdef bint store_indices = rows_cols is not None
+    cdef bint permute = positions is not None
+
+    matrix = ta.matrix
+    n = gr.num_nodes
+
+    if vectorized is not None:
+        onsite_mask, hopping_mask = vectorized[:2]
+
+    k = 0
+    for fs in range(n):
+        if onsite_mask is None or not onsite_mask[fs]:
+            h = diag[fs]
+            if not (h.shape[0] == h.shape[1] == norb[fs]):
+                raise ValueError(msg.format(fs, fs))
+            for i in range(h.shape[0]):
+                for j in range(h.shape[1]):
+                    p = positions[k] if permute else k
+                    data[p] = h[i, j]
+                    if store_indices:
+                        rows_cols[0, k] = i + off[fs]
+                        rows_cols[1, k] = j + off[fs]
+                    k += 1
+
+        nbors = gr.out_neighbors(fs)
+        for nb in range(nbors.size):
+            ts = nbors.data[nb]
+            if ts < fs:
+                continue
+            if (hopping_mask is not None and
+                hopping_mask[gr.heads_idxs[fs] + nb]):
+                continue
+            h = matrix(ham(ts, fs, *args, params=params), complex)
+            if h.shape[0] != norb[ts] or h.shape[1] != norb[fs]:
+                raise ValueError(msg.format(fs, ts))
+            for i in range(h.shape[0]):
+                for j in range(h.shape[1]):
+                    if permute:
+                        data[positions[k]] = h[i, j]
+                        data[positions[k + 1]] = h[i, j].conjugate()
+                    else:
+                        data[k] = h[i, j]
+                        data[k + 1] = h[i, j].conjugate()
+                    if store_indices:
+                        rows_cols[1, k + 1] = rows_cols[0, k] = i + off[ts]
+                        rows_cols[0, k + 1] = rows_cols[1, k] = j + off[fs]
+                    k += 2
+
+    if vectorized is not None:
+        if store_indices:
+            vec_rows, vec_cols, vec_data = vectorized_entries(
+                vectorized, norb, off, norb, off)
+            m = len(vec_data)
+            np_rows_cols = np.asarray(rows_cols)
+            np_rows_cols[0, k : k + m] = vec_rows
+            np_rows_cols[1, k : k + m] = vec_cols
+        else:
+            vec_data = vectorized_entries(vectorized, norb, off, norb, off,
+                                          indices=False)
+            m = len(vec_data)
+        if permute:
+            np.asarray(data)[np.asarray(positions)[k : k + m]] = vec_data
+        else:
+            np.asarray(data)[k : k + m] = vec_data
+        k += m
+
+    if k != data.shape[0]:
+        raise RuntimeError('Unexpected number of Hamiltonian entries.')
+
+
+class AssemblyPlan:
+    """For internal use by hamiltonian_csc.
+
+    Sparsity pattern of the full Hamiltonian of a system in CSC format,
+    together with the position in the CSC data array of every entry as
+    enumerated by `fill_sparse_full`.  Once a plan is made, the Hamiltonian
+    for other parameter values is obtained by filling a single data array in
+    place, without sorting or otherwise recomputing any indices.
+
+    The pattern contains all the entries of the onsite and hopping matrices,
+    including those that vanish for the parameter values with which the plan
+    was made.  The sparsity pattern of the resulting matrices is hence
+    independent of the parameter values.
+    """
+
+    def __init__(self, CGraph gr, norb, rows_cols):
+        self.norb = norb
+        n = np.sum(norb)
+        self.shape = (n, n)
+        rows, cols = rows_cols
+        order = np.lexsort((rows, cols))
+        self.indices = rows[order]
+        self.indptr = np.zeros(n + 1, gint_dtype)
+        self.indptr[1:] = np.cumsum(np.bincount(cols, minlength=n))
+        self.positions = np.empty_like(order, dtype=gint_dtype)
+        self.positions[order] = np.arange(len(order), dtype=gint_dtype)
+        # Each site contributes a full onsite block, so all the diagonal
+        # entries are present.
+        diagonal = np.flatnonzero(rows == cols)
+        self.diagonal = self.positions[diagonal]
+        self.graph = gr
+
+    def matches(self, CGraph gr, norb):
+        return gr is self.graph and np.array_equal(norb, self.norb)
+
+    def make_matrix(self, data):
+        # The index arrays are copied such that in-place operations on the
+        # returned matrix cannot corrupt the plan.
+        mat = sp.csc_matrix((data, self.indices.copy(), self.indptr.copy()),
+                            shape=self.shape)
+        mat.has_sorted_indices = True
+        return mat
+
+
+def hamiltonian_csc(self, args=(), params=None, energy=0):
+    """For internal use by FiniteSystem.
+
+    Return the full Hamiltonian minus ``energy`` times the identity as a
+    `scipy.sparse.csc_matrix`, and the numbers of orbitals of the sites.  The
+    `AssemblyPlan` is stored on the system and reused as long as the graph and
+    the numbers of orbitals do not change.
+    """
+    if args and params:
+        raise TypeError("'args' and 'params' are mutually exclusive.")
+    vectorized = None
+    if getattr(self, '_vectorized_terms', None) is not None:
+        vectorized = self._eval_vectorized_terms(args, params)
+    diag, norb = full_diag(self, args, params, vectorized)
+    off = np.zeros(len(norb) + 1, gint_dtype)
+    off[1:] = np.cumsum(norb)
+
+    plan = getattr(self, '_assembly_plan', None)
+    if plan is None or not plan.matches(self.graph, norb):
+        num_entries = np.sum(norb.astype(int) ** 2)
+        for fs, ts in self.graph:
+            if fs < ts:
+                num_entries += 2 * int(norb[fs]) * int(norb[ts])
+        data = np.empty(num_entries, complex)
+        rows_cols = np.empty((2, num_entries), gint_dtype)
+        fill_sparse_full(self.hamiltonian, args, params, self.graph, diag,
+                         norb, off, vectorized, data, rows_cols=rows_cols)
+        plan = AssemblyPlan(self.graph, norb, rows_cols)
+        self._assembly_plan = plan
+        csc_data = np.empty_like(data)
+        csc_data[plan.positions] = data
+        data = csc_data
+    else:
+        data = np.empty(len(plan.positions), complex)
+        fill_sparse_full(self.hamiltonian, args, params, self.graph, diag,
+                         norb, off, vectorized, data,
+                         positions=plan.positions)
+
+    if energy:
+        data[plan.diagonal] -= energy
+    return plan.make_matrix(data), norb
+
+
 @cython.embedsignature(True)
 def hamiltonian_submatrix(self, args=(), to_sites=None, from_sites=None,
                           sparse=False, return_norb=False, *, params=None):
@@ -287,13 +590,15 @@ def hamiltonian_submatrix(self, args=(), to_sites=None, from_sites=None,
     n = self.graph.num_nodes
     matrix = ta.matrix
 
+    # Vectorized value functions are only evaluated in bulk when the full
+    # Hamiltonian is requested.
+    vectorized = None
+    if (to_sites is from_sites is None
+        and getattr(self, '_vectorized_terms', None) is not None):
+        vectorized = self._eval_vectorized_terms(args, params)
+
     if from_sites is None:
-        diag = n * [None]
-        from_norb = np.empty(n, gint_dtype)
-        for site in range(n):
-            diag[site] = h = matrix(ham(site, site, *args, params=params),
-                                    complex)
-            from_norb[site] = h.shape[0]
+        diag, from_norb = full_diag(self, args, params, vectorized)
     else:
         diag = len(from_sites) * [None]
         from_norb = np.empty(len(from_sites), gint_dtype)
@@ -331,7 +636,7 @@ def hamiltonian_submatrix(self, args=(), to_sites=None, from_sites=None,
     if to_sites is from_sites is None:
         func = make_sparse_full if sparse else make_dense_full
         mat = func(ham, args, params, self.graph, diag, to_norb, to_off,
-                   from_norb, from_off)
+                   from_norb, from_off, vectorized)
     else:
         if to_sites is None:
             to_sites = np.arange(n, dtype=gint_dtype)
@@ -7,6 +7,7 @@
 # http://kwant-project.org/authors.
 
 import abc
+import bisect
 import warnings
 import operator
 import collections
@@ -16,7 +17,7 @@ from itertools import islice, chain
 import inspect
 import tinyarray as ta
 import numpy as np
-from scipy import sparse
+from scipy import sparse, spatial
 from . import system, graph, KwantDeprecationWarning, UserCodeError
 from .linalg import lll
 from .operator import Density
@@ -25,8 +26,9 @@ from ._common import (ensure_isinstance, get_parameters, reraise_warnings,
                       interleave)
 
 
-__all__ = ['Builder', 'Site', 'SiteFamily', 'SimpleSiteFamily', 'Symmetry',
-           'HoppingKind', 'Lead', 'BuilderLead', 'SelfEnergyLead', 'ModesLead']
+__all__ = ['Builder', 'Site', 'SiteArray', 'SiteFamily', 'SimpleSiteFamily',
+           'Symmetry', 'HoppingKind', 'Lead', 'BuilderLead', 'SelfEnergyLead',
+           'ModesLead', 'Vectorized']
 
 
 ################ Sites and site families
@@ -97,6 +99,492 @@ class Site(tuple):
         return self.family.pos(self.tag)
 
 
+class SiteArray:
+    """An array of sites, members of a single `SiteFamily`.
+
+    Site arrays are passed to `Vectorized` value functions in place of
+    individual `Site` instances.
+
+    Parameters
+    ----------
+    family : an instance of `SiteFamily`
+        The 'type' of all the sites in the array.
+    tags : 2d array-like
+        ``tags[i]`` is the tag of the i-th site of the array.
+
+    Notes
+    -----
+    Indexing a site array with an integer returns the corresponding `Site`
+    instance and iterating over it yields all its sites.
+    """
+    __slots__ = ('family', 'tags')
+
+    def __init__(self, family, tags):
+        self.family = family
+        self.tags = np.asarray(tags)
+
+    def __repr__(self):
+        return 'SiteArray({0}, {1})'.format(repr(self.family),
+                                            repr(self.tags))
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getitem__(self, i):
+        return Site(self.family, self.tags[i])
+
+    def __iter__(self):
+        for tag in self.tags:
+            yield Site(self.family, tag)
+
+    @property
+    def positions(self):
+        """Real space positions of the sites as an array.
+
+        Site families that provide a method ``positions(tags)`` are queried
+        for all the positions at once, otherwise ``pos`` is called for each
+        site.
+        """
+        positions = getattr(self.family, 'positions', None)
+        if positions is not None:
+            return positions(self.tags)
+        return np.array([self.family.pos(tag) for tag in self.tags])
+
+
+def _int_tag_array(tags):
+    """Return a sequence of integer tags of equal length as a 2d array."""
+    if not len(tags):
+        return np.zeros((0, 0), int)
+    # This is much faster than 'np.array(tags)' for tinyarrays.
+    dim = len(tags[0])
+    if np.any(np.fromiter(map(len, tags), int, len(tags)) != dim):
+        raise ValueError('Tags must be of equal length.')
+    return np.fromiter(chain.from_iterable(tags), int,
+                       dim * len(tags)).reshape(-1, dim)
+
+
+def _tag_array(tags):
+    """Return the tags as a 2d integer array, or as a 1d object array.
+
+    The integer array is only used if all the tags are tinyarrays of integers
+    of the same length.
+    """
+    array = None
+    if len(tags) and all(isinstance(tag, ta.ndarray_int) for tag in tags):
+        try:
+            array = _int_tag_array(tags)
+        except ValueError:
+            pass
+    if array is not None:
+        return _narrow_int_tags(array)
+    array = np.empty(len(tags), object)
+    for i, tag in enumerate(tags):
+        array[i] = tag
+    return array
+
+
+def _narrow_int_tags(array):
+    """Return an array of integer tags as 32 bit integers if they fit."""
+    small = np.iinfo(np.int32)
+    if array.min() >= small.min and array.max() <= small.max:
+        array = array.astype(np.int32)
+    return array
+
+
+def _concatenate_tags(arrays):
+    """Concatenate arrays of tags as returned by `_tag_array`."""
+    arrays = [array for array in arrays if len(array)]
+    if not arrays:
+        return np.zeros((0, 0), int)
+    if (all(array.dtype != object for array in arrays)
+            and len(set(array.shape[1] for array in arrays)) == 1):
+        return _narrow_int_tags(np.concatenate(arrays))
+    result = np.empty(sum(map(len, arrays)), object)
+    i = 0
+    for array in arrays:
+        for tag in array:
+            result[i] = tag if array.dtype == object else ta.array(tag)
+            i += 1
+    return result
+
+
+class _SiteList(collections.abc.Sequence):
+    """The sites of a finalized system, stored compactly as arrays.
+
+    The sites are stored as one `SiteArray` per family.  `Site` instances are
+    only created when the sequence is indexed or iterated over.
+
+    Parameters
+    ----------
+    site_arrays : sequence of `SiteArray`
+        The sites, each family may occur only once.
+    """
+
+    def __init__(self, site_arrays):
+        self.site_arrays = tuple(site_arrays)
+        self._offsets = [0]
+        for site_array in self.site_arrays:
+            self._offsets.append(self._offsets[-1] + len(site_array))
+
+    @classmethod
+    def from_sites(cls, sites):
+        """Create a `_SiteList` from `Site` instances.
+
+        The sites of each family must be contiguous.
+        """
+        site_arrays = []
+        start = 0
+        for end in range(1, len(sites) + 1):
+            if end < len(sites) and sites[end].family == sites[start].family:
+                continue
+            family = sites[start].family
+            tags = _tag_array([site.tag for site in sites[start:end]])
+            site_arrays.append(SiteArray(family, tags))
+            start = end
+        return cls(site_arrays)
+
+    def __getstate__(self):
+        # The index is cheaper to rebuild than to pickle.
+        state = self.__dict__.copy()
+        state.pop('_id_by_site', None)
+        state.pop('_spatial_index', None)
+        return state
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self[j] for j in range(*i.indices(len(self))))
+        i = operator.index(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Site index out of range.')
+        k = bisect.bisect_right(self._offsets, i) - 1
+        site_array = self.site_arrays[k]
+        tag = site_array.tags[i - self._offsets[k]]
+        if site_array.tags.dtype != object:
+            tag = ta.array(tag)
+        return Site(site_array.family, tag, True)
+
+    def __iter__(self):
+        for site_array in self.site_arrays:
+            family, tags = site_array.family, site_array.tags
+            if tags.dtype != object:
+                tags = map(ta.array, tags)
+            for tag in tags:
+                yield Site(family, tag, True)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in
+                                                zip(self, other))
+
+    def __repr__(self):
+        return '<{0} of {1} sites>'.format(self.__class__.__name__, len(self))
+
+    @property
+    def id_by_site(self):
+        """The `_SiteIdMap` of the sites, created when first needed."""
+        try:
+            return self._id_by_site
+        except AttributeError:
+            self._id_by_site = _SiteIdMap(self)
+            return self._id_by_site
+
+    def index(self, site):
+        try:
+            return self.id_by_site[site]
+        except KeyError:
+            raise ValueError('{0} is not in the sequence.'.format(site))
+
+    def updated(self, removed, added):
+        """Return a copy with some sites removed and others added.
+
+        The sites of the copy are ordered by family and tag, like the sites
+        of a `FiniteSystem`.
+
+        Parameters
+        ----------
+        removed : array of integers
+            The indices of the sites that are removed.
+        added : sequence of `Site`
+            The sites that are added.  They must not be present yet.
+
+        Returns
+        -------
+        sites : `_SiteList`
+        new_ids : array of integers
+            The index in ``sites`` of each site of ``self``, or -1 for the
+            removed sites.
+        added_ids : array of integers
+            The indices in ``sites`` of the added sites.
+        """
+        keep = np.ones(len(self), bool)
+        keep[removed] = False
+        # The tags of each family together with their origin: the old index
+        # of a site, or -1 - i for the i-th added site.
+        parts = {}
+        for offset, site_array in zip(self._offsets, self.site_arrays):
+            which = np.flatnonzero(keep[offset:offset + len(site_array)])
+            parts[site_array.family] = [(site_array.tags[which],
+                                         which + offset)]
+        families, family_of_site = _group_by_family(added)
+        for code, family in enumerate(families):
+            which = np.flatnonzero(family_of_site == code)
+            tags = _tag_array([added[i][1] for i in which])
+            parts.setdefault(family, []).append((tags, -1 - which))
+
+        site_arrays = []
+        origins = [np.zeros(0, int)]
+        for family in sorted(parts):
+            tags, origin = zip(*parts[family])
+            tags = _concatenate_tags(tags)
+            if not len(tags):
+                continue
+            if tags.dtype == object:
+                perm = sorted(range(len(tags)), key=tags.__getitem__)
+            else:
+                perm = np.lexsort(tags.T[::-1])
+            site_arrays.append(SiteArray(family, tags[perm]))
+            origins.append(np.concatenate(origin)[perm])
+        origins = np.concatenate(origins)
+
+        ids = np.arange(len(origins))
+        old = origins >= 0
+        new_ids = np.full(len(self), -1, int)
+        new_ids[origins[old]] = ids[old]
+        added_ids = np.empty(len(added), int)
+        added_ids[-1 - origins[~old]] = ids[~old]
+        return _SiteList(site_arrays), new_ids, added_ids
+
+    @property
+    def positions(self):
+        """Real space positions of all the sites as an array."""
+        return np.concatenate([site_array.positions
+                               for site_array in self.site_arrays])
+
+    @property
+    def spatial_index(self):
+        """The `_SpatialIndex` of the sites, created when first needed."""
+        try:
+            return self._spatial_index
+        except AttributeError:
+            if self.site_arrays:
+                positions = self.positions
+            else:
+                positions = np.zeros((0, 0))
+            self._spatial_index = _SpatialIndex(positions)
+            return self._spatial_index
+
+
+class _SiteIdMap(collections.abc.Mapping):
+    """Mapping from the sites of a `_SiteList` to their indices.
+
+    For families with integer tags, the tags are looked up by bisection in
+    an array of keys that encode the tags as single integers.  The tags of
+    other families are looked up in a dictionary.
+
+    Parameters
+    ----------
+    sites : `_SiteList`
+    """
+
+    def __init__(self, sites):
+        self.sites = sites
+        self._lookup = {}
+        for offset, site_array in zip(sites._offsets, sites.site_arrays):
+            tags = site_array.tags
+            lookup = None
+            if tags.dtype != object:
+                lo = tags.min(axis=0)
+                radix = tags.max(axis=0) - lo + 1
+                # Only use keys if they fit into 63 bit integers.
+                if np.sum(np.log2(radix.astype(float))) < 62:
+                    strides = np.cumprod(np.r_[radix[1:], 1][::-1])[::-1]
+                    keys = (tags - lo).dot(strides)
+                    # The tags are usually sorted already.
+                    if np.all(keys[1:] > keys[:-1]):
+                        order = None
+                    else:
+                        order = np.argsort(keys, kind='mergesort')
+                        keys = keys[order]
+                    lookup = (lo, radix, strides, keys, order)
+            if lookup is None:
+                lookup = {tag: i for i, tag in
+                          enumerate(map(site_array.family.normalize_tag,
+                                        tags))}
+            self._lookup[site_array.family] = (offset, lookup)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def __iter__(self):
+        return iter(self.sites)
+
+    def __getitem__(self, site):
+        try:
+            family, tag = site
+            offset, lookup = self._lookup[family]
+        except (TypeError, ValueError, KeyError):
+            raise KeyError(site)
+        if isinstance(lookup, dict):
+            try:
+                return offset + lookup[tag]
+            except (KeyError, TypeError):
+                raise KeyError(site)
+        ids = self.ids(family, np.array(tag, ndmin=2))
+        if ids[0] < 0:
+            raise KeyError(site)
+        return int(ids[0])
+
+    def ids(self, family, tags):
+        """Return the indices of many sites of the same family.
+
+        Parameters
+        ----------
+        family : `SiteFamily`
+        tags : 2d array-like of integers
+            ``tags[i]`` is the tag of the i-th site.
+
+        Returns
+        -------
+        ids : 1d array of integers
+            The indices of the sites, or -1 for sites that are not present.
+        """
+        ids = np.full(len(tags), -1, int)
+        if family not in self._lookup:
+            return ids
+        offset, lookup = self._lookup[family]
+        if isinstance(lookup, dict):
+            for i, tag in enumerate(tags):
+                tag = family.normalize_tag(tag)
+                ids[i] = offset + lookup.get(tag, -1 - offset)
+            return ids
+        if not isinstance(tags, np.ndarray):
+            try:
+                tags = _int_tag_array(tags)
+            except (TypeError, ValueError):
+                return ids
+        lo, radix, strides, keys, order = lookup
+        if tags.ndim != 2 or tags.shape[1] != len(lo):
+            return ids
+        tags = tags - lo
+        inside = np.all((tags >= 0) & (tags < radix), axis=1)
+        candidates = tags[inside].dot(strides)
+        where = np.searchsorted(keys, candidates)
+        where[where == len(keys)] = 0
+        found = keys[where] == candidates
+        ids_inside = np.full(len(candidates), -1, int)
+        where = where[found]
+        if order is not None:
+            where = order[where]
+        ids_inside[found] = offset + where
+        ids[inside] = ids_inside
+        return ids
+
+
+class _SpatialIndex:
+    """k-d tree of site positions for closest-site and radius queries.
+
+    Parameters
+    ----------
+    positions : 2d array of floats
+        ``positions[i]`` is the position of the i-th site.
+    """
+
+    def __init__(self, positions):
+        positions = np.asarray(positions, float)
+        self.num_sites, self.dim = positions.shape
+        self.tree = spatial.cKDTree(positions) if self.num_sites else None
+
+    def _positions(self, pos):
+        pos = np.asarray(pos, float)
+        if pos.ndim not in (1, 2) or (self.num_sites
+                                      and pos.shape[-1] != self.dim):
+            raise ValueError('Expecting a position or a 2d array of '
+                             'positions of dimension {0}.'.format(self.dim))
+        return pos
+
+    def closest(self, pos):
+        """Return the index of the site closest to each position.
+
+        Returns an integer for a single position and an array of integers
+        for a 2d array of positions.  For an empty index, -1 is returned.
+        """
+        pos = self._positions(pos)
+        if self.tree is None:
+            return -1 if pos.ndim == 1 else np.full(len(pos), -1, int)
+        return self.tree.query(pos)[1]
+
+    def within(self, pos, radius):
+        """Return the indices of the sites within `radius` of each position.
+
+        Returns a sorted array of integers for a single position and a list
+        of such arrays for a 2d array of positions.
+        """
+        pos = self._positions(pos)
+        if self.tree is None:
+            ids = [[]] * len(pos) if pos.ndim == 2 else []
+        else:
+            ids = self.tree.query_ball_point(pos, radius)
+        if pos.ndim == 1:
+            return np.array(sorted(ids), int)
+        return [np.array(sorted(i), int) for i in ids]
+
+
+def _group_by_family(sites):
+    """Group sites by their family.
+
+    Returns
+    -------
+    families : list of `SiteFamily`
+        The distinct families of the sites.
+    family_of_site : array of integers
+        ``families[family_of_site[i]]`` is the family of ``sites[i]``.
+    """
+    # Comparing families is slow, so the sites are grouped by the identity of
+    # their family first.  Distinct, but equal, families are merged after.
+    ids = np.fromiter(map(id, map(operator.itemgetter(0), sites)), np.intp,
+                      len(sites))
+    ids, first, family_of_site = np.unique(ids, return_index=True,
+                                           return_inverse=True)
+    families = []
+    code_by_family = {}
+    codes = np.empty(len(ids), int)
+    for k, i in enumerate(first):
+        family = sites[i][0]
+        codes[k] = code_by_family.setdefault(family, len(families))
+        if codes[k] == len(families):
+            families.append(family)
+    return families, codes[family_of_site]
+
+
+def _site_ids(id_by_site, sites, strict=True):
+    """Look up the indices of many sites in a `_SiteIdMap`.
+
+    Raises `KeyError` if a site is not present, or returns -1 for it if
+    `strict` is false.
+    """
+    ids = np.empty(len(sites), int)
+    if not len(sites):
+        return ids
+    families, family_of_site = _group_by_family(sites)
+    for code, family in enumerate(families):
+        if len(families) == 1:
+            which = slice(None)
+            tags = list(map(operator.itemgetter(1), sites))
+        else:
+            which = np.flatnonzero(family_of_site == code)
+            tags = [sites[i][1] for i in which]
+        ids[which] = id_by_site.ids(family, tags)
+    if strict and np.any(ids < 0):
+        raise KeyError(sites[np.flatnonzero(ids < 0)[0]])
+    return ids
+
+
 @total_ordering
 class SiteFamily(metaclass=abc.ABCMeta):
     """Abstract base class for site families.
@@ -329,6 +817,27 @@ class Symmetry(metaclass=abc.ABCMeta):
                 return False
         return True
 
+    def _which_tags(self, family, tags):
+        """Apply `which` to the sites of a family given by integer tags.
+
+        Returns a 2d array of group elements.  Subclasses may override this
+        and `_act_tags` by vectorized versions.
+        """
+        result = [self.which(Site(family, ta.array(tag), True))
+                  for tag in tags.tolist()]
+        return np.array(result, int).reshape(len(tags), self.num_directions)
+
+    def _act_tags(self, elements, family, tags):
+        """Apply `act` to the sites of a family given by integer tags.
+
+        ``elements[i]`` is the group element acting on ``tags[i]``.  Returns
+        the tags of the resulting sites as a 2d array.
+        """
+        result = [self.act(ta.array(element),
+                           Site(family, ta.array(tag), True)).tag
+                  for element, tag in zip(elements.tolist(), tags.tolist())]
+        return np.array(result, int).reshape(tags.shape)
+
     @abc.abstractmethod
     def subgroup(self, *generators):
         """Return the subgroup generated by a sequence of group elements."""
@@ -380,6 +889,12 @@ class NoSymmetry(Symmetry):
     def in_fd(self, site):
         return True
 
+    def _which_tags(self, family, tags):
+        return np.zeros((len(tags), 0), int)
+
+    def _act_tags(self, elements, family, tags):
+        return tags
+
     def subgroup(self, *generators):
         if any(generators):
             raise ValueError('Generators must be empty for NoSymmetry.')
@@ -428,6 +943,12 @@ class HoppingKind(tuple):
 
         kinds = [kwant.builder.HoppingKind(v, lat) for v in [(1, 0), (0, 1)]]
         syst[kinds] = 1
+
+    When a hopping kind or a list of them (like the one returned by
+    `~kwant.lattice.Polyatomic.neighbors`) is used as key for setting
+    hoppings, and the site families have integer tinyarray tags (e.g.
+    lattices), all the kinds are matched together using array operations and
+    the hoppings are set in bulk.
     """
     __slots__ = ()
 
@@ -514,6 +1035,144 @@ class HermConjOfFunc:
     def __call__(self, i, j, *args, **kwargs):
         return herm_conj(self.function(j, i, *args, **kwargs))
 
+
+################ Vectorized value functions
+
+class Vectorized:
+    """Mark a value function as being able to evaluate many sites at once.
+
+    Parameters
+    ----------
+    function : callable
+        An onsite or hopping value function.  Instead of one or two `Site`
+        instances it receives one or two `SiteArray` instances of equal length
+        (all the sites of a site array belong to the same family), followed by
+        the usual parameters.  It must return an array of shape ``(N, norbs_a,
+        norbs_b)``, where ``N`` is the length of the site arrays.  Returning an
+        array of shape ``(N,)`` is allowed for single-orbital sites.  A scalar
+        or a single matrix is used for all the sites.
+
+    Notes
+    -----
+    When the full Hamiltonian of a finalized system is evaluated (e.g. by
+    `~kwant.system.System.hamiltonian_submatrix` without specifying sites, as
+    done by the solvers), a vectorized value function is called once for each
+    group of sites (or hoppings) that have the same site families and the same
+    value function.  This is much faster than a Python function call per site
+    when the system is large.
+
+    In any other situation the value function is called with site arrays of
+    length one, so vectorized value functions may be used anywhere ordinary
+    value functions are allowed.
+
+    Shape functions passed to `~kwant.lattice.Polyatomic.shape` or
+    `Builder.fill` may be wrapped as well.  They receive an array of shape
+    ``(N, dim)`` with the positions of the sites instead of a site array.
+
+    Examples
+    --------
+    >>> def onsite(site, V):
+    ...     x, y = site.positions.T
+    ...     return 4 + V * np.exp(-x**2 - y**2)
+    ...
+    >>> syst[lat.shape(rectangle, (0, 0))] = kwant.builder.Vectorized(onsite)
+    """
+    __slots__ = ('function', '__signature__')
+
+    def __init__(self, function):
+        if isinstance(function, Vectorized):
+            function = function.function
+        self.function = function
+        self.__signature__ = inspect.signature(function)
+
+    def __eq__(self, other):
+        if not isinstance(other, Vectorized):
+            return False
+        return self.function == other.function
+
+    def __hash__(self):
+        return hash((Vectorized, self.function))
+
+    def __repr__(self):
+        return 'Vectorized({0})'.format(repr(self.function))
+
+    @property
+    def __name__(self):
+        return getattr(self.function, '__name__', repr(self.function))
+
+    def __call__(self, *args, **kwargs):
+        bound = self.__signature__.bind(*args, **kwargs)
+        arguments = bound.arguments
+        single = False
+        for name, value in arguments.items():
+            if not isinstance(value, Site):
+                break
+            arguments[name] = SiteArray(value.family, [value.tag])
+            single = True
+        result = self.function(*bound.args, **bound.kwargs)
+        if not single:
+            return result
+        result = np.asarray(result)
+        return result if result.ndim in (0, 2) else result[0]
+
+
+def _is_vectorized(value):
+    if isinstance(value, ParameterSubstitution):
+        value = value.function
+    return isinstance(value, Vectorized)
+
+
+def _vectorized_groups(values):
+    """Group the indices of a sequence of values by the vectorized values.
+
+    Returns a dictionary that maps each `Vectorized` value to the array of
+    indices where it occurs.
+    """
+    first, inverse = _distinct_values(values, True)
+    groups = {}
+    for k, i in enumerate(first):
+        value = values[i]
+        if value is not Other and _is_vectorized(value):
+            groups[value] = np.flatnonzero(inverse == k)
+    return groups
+
+
+def _distinct_values(values, return_indices=False):
+    """Return the distinct values of a sequence.
+
+    Values are compared by identity, which also works for unhashable ones.
+    If 'return_indices' is true, the index of the first occurrence of each
+    distinct value and the array that maps every value to its distinct value
+    are returned instead.
+    """
+    ids = np.fromiter(map(id, values), np.intp, len(values))
+    ids, first, inverse = np.unique(ids, return_index=True,
+                                    return_inverse=True)
+    if return_indices:
+        return first, inverse
+    return [values[i] for i in first]
+
+
+def _normalize_vectorized_value(value, n):
+    """Bring the output of a vectorized value function into the shape
+    ``(n, norbs_a, norbs_b)``."""
+    value = np.asarray(value, complex)
+    if value.ndim == 0:
+        value = value.reshape(1, 1, 1)
+    elif value.ndim == 1:
+        value = value.reshape(-1, 1, 1)
+    elif value.ndim == 2:
+        value = value.reshape((1,) + value.shape)
+    elif value.ndim != 3:
+        raise ValueError('Vectorized value functions must return arrays '
+                         'with at most 3 dimensions.')
+    if value.shape[0] == 1 and n != 1:
+        value = np.broadcast_to(value, (n,) + value.shape[1:])
+    elif value.shape[0] != n:
+        raise ValueError('Vectorized value function returned {0} values for '
+                         '{1} sites.'.format(value.shape[0], n))
+    return value
+
 
 ################ Leads
 
@@ -693,6 +1352,18 @@ def _site_ranges(sites):
     """
     # we shall start a new range of different `SiteFamily`s separately,
     # even if they happen to contain the same number of orbitals.
+    if isinstance(sites, _SiteList):
+        site_ranges = []
+        total_norbs = 0
+        for offset, site_array in zip(sites._offsets, sites.site_arrays):
+            norbs = site_array.family.norbs
+            if not norbs:
+                return None
+            site_ranges.append((offset, norbs, total_norbs))
+            total_norbs += norbs * len(site_array)
+        site_ranges.append((len(sites), 0, total_norbs))
+        return site_ranges
+
     total_norbs = 0
     current_fam = None
     site_ranges = []
@@ -806,6 +1477,264 @@ def _substitute_parameters(value_func, relevant_params, subs):
     return ParameterSubstitution(value_func, relevant_subs)
 
 
+def _int_tag_arg(family, tags):
+    """Validate the tags passed to the bulk methods of `Builder`.
+
+    Returns the tags as a 2d integer array, or None if there are no tags.
+    """
+    ensure_isinstance(family, SiteFamily)
+    tags = np.asarray(tags)
+    if not tags.size:
+        return None
+    if tags.ndim != 2:
+        raise ValueError('Tags must be given as a 2d array.')
+    if tags.dtype.kind not in 'iu':
+        raise TypeError('Tags must be integers.')
+    return tags.astype(int)
+
+
+def _has_array_tags(family, tags):
+    """Tell whether `family` accepts the rows of `tags` as tinyarrays."""
+    tag = Site(family, ta.array(tags[0])).tag
+    return isinstance(tag, ta.ndarray_int) and len(tag) == tags.shape[1]
+
+
+class _SiteIndex:
+    """Index of the sites of a builder by their tags.
+
+    The sites of each family are looked up by their integer tags with array
+    operations.  The index is only valid as long as no sites are added to or
+    removed from the builder.
+
+    Parameters
+    ----------
+    H : dict
+        The graph of a `Builder`.
+    """
+
+    def __init__(self, H):
+        self._sites = list(H)
+        self._hvhvs = list(H.values())
+        if self._sites:
+            families, self._family_of_site = _group_by_family(self._sites)
+        else:
+            families = []
+        self._codes = {family: code for code, family in enumerate(families)}
+        self._families = {}
+
+    def _family_data(self, family):
+        try:
+            return self._families[family]
+        except KeyError:
+            pass
+        data = None
+        code = self._codes.get(family)
+        if code is not None:
+            which = np.flatnonzero(self._family_of_site == code).tolist()
+            sites = [self._sites[i] for i in which]
+            if isinstance(sites[0].tag, ta.ndarray_int):
+                tags = _int_tag_array([site.tag for site in sites])
+                id_map = _SiteIdMap(_SiteList([SiteArray(family, tags)]))
+                data = (sites, [self._hvhvs[i] for i in which], tags, id_map)
+        self._families[family] = data
+        return data
+
+    def has_sites(self, family):
+        """Tell whether there are sites of `family`."""
+        return family in self._codes
+
+    def has_array_tags(self, family):
+        """Tell whether the sites of `family` are indexed.
+
+        Sites are indexed if they are present and have integer tinyarray tags.
+        """
+        return self._family_data(family) is not None
+
+    def sites(self, family):
+        """Return the sites of an indexed family."""
+        return self._family_data(family)[0]
+
+    def hvhvs(self, family):
+        """Return the lists of heads and values of the sites of a family."""
+        return self._family_data(family)[1]
+
+    def tags(self, family):
+        """Return the tags of the sites of an indexed family as an array."""
+        return self._family_data(family)[2]
+
+    def ids(self, family, tags):
+        """Return the indices of sites of a family, or -1 for missing ones."""
+        data = self._family_data(family)
+        if data is None:
+            return np.full(len(tags), -1, int)
+        return data[3].ids(family, tags)
+
+
+def _match_hopping_kinds(builder, kinds, index):
+    """Find the hoppings of a builder that match several `HoppingKind`.
+
+    Parameters
+    ----------
+    builder : `Builder`
+    kinds : sequence of `HoppingKind`
+    index : `_SiteIndex`
+        The index of the sites of `builder`.
+
+    Returns
+    -------
+    matches : list
+        One entry for each kind.  The entry is None if the sites of the
+        families of the kind do not have integer tinyarray tags.  Otherwise it
+        is a pair ``(ids, tags_b)``: ``ids`` are the indices of the matching
+        sites among ``index.sites(kind.family_a)``, and ``tags_b`` the tags of
+        the corresponding second sites of the hoppings.
+    """
+    sym = builder.symmetry
+    matches = []
+    for delta, family_a, family_b in kinds:
+        if not (index.has_sites(family_a) and index.has_sites(family_b)):
+            matches.append((np.zeros(0, int), np.zeros((0, len(delta)), int)))
+            continue
+        if not (index.has_array_tags(family_a)
+                and index.has_array_tags(family_b)):
+            matches.append(None)
+            continue
+        tags_b = index.tags(family_a) - np.array(delta, int)
+        shifts = -sym._which_tags(family_b, tags_b)
+        ids = index.ids(family_b, sym._act_tags(shifts, family_b, tags_b))
+        ids = np.flatnonzero(ids >= 0)
+        matches.append((ids, tags_b[ids]))
+    return matches
+
+
+def _in_sorted(sorted_keys, keys):
+    """Return a boolean mask of the `keys` present in `sorted_keys`."""
+    if not len(sorted_keys):
+        return np.zeros(len(keys), bool)
+    pos = np.searchsorted(sorted_keys, keys)
+    pos[pos == len(sorted_keys)] = 0
+    return sorted_keys[pos] == keys
+
+
+def _pack_tags(tags, bits, high=None):
+    """Pack the rows of a 2d integer array into 64 bit integer keys.
+
+    Each component of the tags occupies `bits` bits of the keys.  The optional
+    non-negative integers `high` are stored in the remaining high bits.
+    """
+    half = 1 << (bits - 1)
+    if tags.size and (tags.min() < -half or tags.max() >= half):
+        raise ValueError('Tags are too large to be packed into 64 bit keys.')
+    if high is None:
+        keys = np.zeros(len(tags), np.int64)
+    else:
+        keys = high.astype(np.int64)
+    for column in tags.T:
+        keys = (keys << bits) | (column + half)
+    return keys
+
+
+class _FillTemplate:
+    """The sites and hoppings of a `Builder.fill` template as arrays.
+
+    Sites are represented by a family index and an integer tag.  Both are
+    packed into single 64 bit integer keys, such that sets of sites can be
+    handled as sorted arrays of keys.
+
+    Parameters
+    ----------
+    template : `Builder`
+
+    Raises
+    ------
+    ValueError
+        If the template contains tags that are not integer tinyarrays of
+        equal length.
+    """
+
+    def __init__(self, template):
+        self.symmetry = template.symmetry
+        self.families = families = []
+        self.family_index = family_index = {}
+        dim = None
+        for hvhv in template.H.values():
+            for family, tag in islice(hvhv, 0, None, 2):
+                if family not in family_index:
+                    family_index[family] = len(families)
+                    families.append(family)
+                if not isinstance(tag, ta.ndarray_int):
+                    raise ValueError('Tags must be integer tinyarrays.')
+                if dim is None:
+                    dim = len(tag)
+                elif len(tag) != dim:
+                    raise ValueError('Tags must be of equal length.')
+        if dim is None:
+            raise ValueError('The template is empty.')
+        self.dim = dim
+        family_bits = len(families).bit_length()
+        self.bits = (63 - family_bits) // max(dim, 1)
+        if self.bits < 16:
+            raise ValueError('Tags have too many components.')
+
+        tails = list(template.H)
+        self.onsite_values = [template.H[tail][1] for tail in tails]
+        self.tail_families, tail_tags = self.site_arrays(tails)
+        keys = self.keys(self.tail_families, tail_tags)
+        self._order = np.argsort(keys)
+        self._keys = keys[self._order]
+
+        hvhvs = [template.H[tail] for tail in tails]
+        counts = np.fromiter((len(hvhv) // 2 - 1 for hvhv in hvhvs), int,
+                             len(hvhvs))
+        self.edge_ptr = np.r_[0, np.cumsum(counts)]
+        self.heads = list(chain.from_iterable(hvhv[2::2] for hvhv in hvhvs))
+        self.values = list(chain.from_iterable(hvhv[3::2] for hvhv in hvhvs))
+        self.head_families, self.head_tags = self.site_arrays(self.heads)
+        self.tails = [tail for tail, count in zip(tails, counts.tolist())
+                      for i in range(count)]
+        self._template = template
+        self._reverse_values = {}
+
+    def site_arrays(self, sites):
+        """Return the family indices and the tags of sites as arrays."""
+        family_index = self.family_index
+        families = np.fromiter((family_index[s.family] for s in sites), int,
+                               len(sites))
+        tags = np.fromiter(chain.from_iterable(s.tag for s in sites), int,
+                           self.dim * len(sites))
+        return families, tags.reshape(len(sites), self.dim)
+
+    def packable(self, tags):
+        """Return which of the tags can be packed into keys."""
+        half = 1 << (self.bits - 1)
+        return np.all((tags >= -half) & (tags < half), axis=1)
+
+    def keys(self, families, tags):
+        """Pack family indices and tags into integer keys."""
+        return _pack_tags(tags, self.bits, families)
+
+    def tail_ids(self, families, tags):
+        """Return the indices of template sites, or -1 for missing ones."""
+        keys = self.keys(families, tags)
+        found = _in_sorted(self._keys, keys)
+        pos = np.searchsorted(self._keys, keys[found])
+        ids = np.full(len(keys), -1, int)
+        ids[found] = self._order[pos]
+        return ids
+
+    def reverse_value(self, edge):
+        """Return the value of the template hopping opposite to `edge`."""
+        try:
+            return self._reverse_values[edge]
+        except KeyError:
+            pass
+        sym = self.symmetry
+        value = self._template._get_edge(
+            *sym.to_fd(self.heads[edge], self.tails[edge]))
+        self._reverse_values[edge] = value
+        return value
+
+
 class Builder:
     """A tight binding system defined on a graph.
 
@@ -929,6 +1858,9 @@ class Builder:
         self.chiral = chiral
         self.leads = []
         self.H = {}
+        self._spatial_cache = None
+        self._change_log = None
+        self._change_log_token = None
 
     #### Note on H ####
     #
@@ -952,6 +1884,12 @@ class Builder:
     # associated with the tail node itself, and it is necessary for the
     # method getkey_tail which helps to conserve memory by storing equal
     # node label only once.
+    #
+    # After the builder has been finalized, the tails whose entries in H are
+    # modified are appended to the list '_change_log' (it is None when
+    # modifications are not tracked).  A finalized system remembers the
+    # length of the log when it was made.  This allows 'refinalized' to
+    # update the finalized system instead of building it anew.
 
     def _get_edge(self, tail, head):
         for h, value in edges(self.H[tail]):
@@ -968,6 +1906,8 @@ class Builder:
 
     def _set_edge(self, tail, head, value):
         hvhv = self.H[tail]
+        if self._change_log is not None:
+            self._change_log.append(tail)
         heads = hvhv[2::2]
         if head in heads:
             i = 2 + 2 * heads.index(head)
@@ -979,6 +1919,8 @@ class Builder:
 
     def _del_edge(self, tail, head):
         hvhv = self.H[tail]
+        if self._change_log is not None:
+            self._change_log.append(tail)
         heads = hvhv[2::2]
 
         try:
@@ -1012,6 +1954,10 @@ class Builder:
         result.chiral = self.chiral
         result.leads = self.leads
         result.H = self.H
+        result._spatial_cache = None
+        # The copies share H, so their modifications cannot be tracked.
+        result._change_log = self._change_log = None
+        result._change_log_token = None
         return result
 
     # TODO: write a test for this method.
@@ -1118,6 +2064,8 @@ class Builder:
             raise TypeError('Expecting a site, got {0} instead.'.format(type(site).__name__))
         site = self.symmetry.to_fd(site)
         hvhv = self.H.setdefault(site, [])
+        if self._change_log is not None:
+            self._change_log.append(site)
         if hvhv:
             hvhv[1] = value
         else:
@@ -1152,6 +2100,12 @@ class Builder:
 
     def __setitem__(self, key, value):
         """Set a single site/hopping or a bunch of them."""
+        if isinstance(key, HoppingKind):
+            key = [key]
+        if (isinstance(key, list) and key
+                and all(isinstance(kind, HoppingKind) for kind in key)):
+            self._set_hopping_kinds(key, value)
+            return
         func = None
         for sh in self.expand(key):
             if func is None:
@@ -1159,6 +2113,203 @@ class Builder:
                         else self._set_hopping)
             func(sh, value)
 
+    def _set_hopping_kinds(self, kinds, value):
+        """Set all the hoppings that match a sequence of `HoppingKind`."""
+        index = _SiteIndex(self.H)
+        matches = _match_hopping_kinds(self, kinds, index)
+        for kind, match in zip(kinds, matches):
+            delta, family_a, family_b = kind
+            if match is None:
+                for hopping in kind(self):
+                    self._set_hopping(hopping, value)
+            elif len(match[0]):
+                tags_a = index.tags(family_a)[match[0]]
+                self._add_hoppings(family_a, tags_a, family_b, match[1],
+                                   value, index)
+
+    def add_sites(self, family, tags, value):
+        """Add many sites of a family at once, given their tags as an array.
+
+        This is equivalent to ``syst[(family(*tag) for tag in tags)] = value``
+        but much faster for large numbers of sites.
+
+        Parameters
+        ----------
+        family : `SiteFamily`
+            The family of all the sites.
+        tags : 2d array-like of integers
+            ``tags[i]`` is the tag of the i-th site.
+        value
+            The value of all the sites, e.g. a number, a matrix, or a value
+            function (possibly `Vectorized`).
+
+        Notes
+        -----
+        Validation and mapping to the fundamental domain of the symmetry are
+        done with array operations if the family has integer tinyarray tags,
+        as is the case for lattices.  Otherwise the sites are added one by
+        one.
+        """
+        tags = _int_tag_arg(family, tags)
+        if tags is None:
+            return
+        if not _has_array_tags(family, tags):
+            self[(Site(family, tag) for tag in tags.tolist())] = value
+            return
+
+        sym = self.symmetry
+        tags = sym._act_tags(-sym._which_tags(family, tags), family, tags)
+        H = self.H
+        change_log = self._change_log
+        for tag in tags.tolist():
+            site = Site(family, ta.array(tag), True)
+            hvhv = H.get(site)
+            if hvhv is None:
+                H[site] = [site, value]
+            else:
+                hvhv[1] = value
+            if change_log is not None:
+                change_log.append(site)
+
+    def add_hoppings(self, family_a, tags_a, family_b, tags_b, value):
+        """Add many hoppings at once, given the tags of their sites as arrays.
+
+        This is equivalent to ``syst[((family_a(*a), family_b(*b)) for a, b in
+        zip(tags_a, tags_b))] = value`` but much faster for large numbers of
+        hoppings.
+
+        Parameters
+        ----------
+        family_a, family_b : `SiteFamily`
+            The families of the first and second sites of the hoppings.
+        tags_a, tags_b : 2d arrays-like of integers
+            ``(tags_a[i], tags_b[i])`` are the tags of the i-th hopping.
+        value
+            The value of all the hoppings, e.g. a number, a matrix, or a value
+            function (possibly `Vectorized`).
+
+        Raises
+        ------
+        KeyError
+            If a site of the hoppings is not present in the builder.  In that
+            case no hopping is added.
+        ValueError
+            If a hopping connects a site to itself.
+
+        Notes
+        -----
+        Validation and mapping to the fundamental domain of the symmetry are
+        done with array operations if the families have integer tinyarray
+        tags, as is the case for lattices.  Otherwise the hoppings are added
+        one by one.
+        """
+        self._add_hoppings(family_a, tags_a, family_b, tags_b, value)
+
+    def _add_hoppings(self, family_a, tags_a, family_b, tags_b, value,
+                      index=None):
+        """Implementation of `add_hoppings`.
+
+        `index` is an optional `_SiteIndex` of the builder.
+        """
+        tags_a = _int_tag_arg(family_a, tags_a)
+        tags_b = _int_tag_arg(family_b, tags_b)
+        if tags_a is None or tags_b is None:
+            if (tags_a is None) != (tags_b is None):
+                raise ValueError('tags_a and tags_b must have equal length.')
+            return
+        if len(tags_a) != len(tags_b):
+            raise ValueError('tags_a and tags_b must have equal length.')
+        if not (_has_array_tags(family_a, tags_a)
+                and _has_array_tags(family_b, tags_b)):
+            self[((Site(family_a, a), Site(family_b, b)) for a, b in
+                  zip(tags_a.tolist(), tags_b.tolist()))] = value
+            return
+        if family_a == family_b:
+            loops = np.all(tags_a == tags_b, axis=1)
+            if np.any(loops):
+                a = Site(family_a, ta.array(tags_a[np.argmax(loops)]), True)
+                raise ValueError("A hopping connects the following site to "
+                                 "itself:\n{0}".format(a))
+
+        # Map the hoppings to the fundamental domain, and the hoppings whose
+        # second site is not in the fundamental domain also the other way.
+        sym = self.symmetry
+        shifts = -sym._which_tags(family_a, tags_a)
+        tags_a = sym._act_tags(shifts, family_a, tags_a)
+        tags_b = sym._act_tags(shifts, family_b, tags_b)
+        shifts = -sym._which_tags(family_b, tags_b)
+        in_fd = np.all(shifts == 0, axis=1)
+        tags_a2 = sym._act_tags(shifts, family_a, tags_a)
+        tags_b2 = sym._act_tags(shifts, family_b, tags_b)
+
+        # Look up all the sites before modifying anything.  Sites that are
+        # present are replaced by the instances that are stored in the
+        # builder, such that no space is wasted by identical sites.  For many
+        # hoppings, it is faster to index the sites of the builder by their
+        # tags than to look up each site in its dictionary.
+        H = self.H
+        if index is None and 8 * len(tags_a) > len(H):
+            index = _SiteIndex(H)
+
+        def lookup(family, tags):
+            if index is None:
+                hvhvs = []
+                for tag in tags.tolist():
+                    site = Site(family, ta.array(tag), True)
+                    try:
+                        hvhvs.append(H[site])
+                    except KeyError:
+                        raise KeyError(site)
+                return hvhvs
+            ids = index.ids(family, tags)
+            if np.any(ids < 0):
+                tag = ta.array(tags[np.argmax(ids < 0)])
+                raise KeyError(Site(family, tag, True))
+            hvhvs = index.hvhvs(family)
+            return [hvhvs[i] for i in ids.tolist()]
+
+        tail_hvhvs = lookup(family_a, tags_a)
+        tails = [hvhv[0] for hvhv in tail_hvhvs]
+        heads = [None] * len(tails)
+        # The reverse hoppings.  Those whose head is not in the fundamental
+        # domain are mapped to it the other way.
+        rev_hvhvs = [None] * len(heads)
+        rev_heads = tails
+        out_fd = np.flatnonzero(~in_fd)
+        if len(out_fd):
+            rev_heads = list(tails)
+            for i, hvhv, tag, tag2 in zip(out_fd.tolist(),
+                                          lookup(family_b, tags_b2[out_fd]),
+                                          tags_b[out_fd].tolist(),
+                                          tags_a2[out_fd].tolist()):
+                heads[i] = Site(family_b, ta.array(tag), True)
+                rev_hvhvs[i] = hvhv
+                rev_heads[i] = Site(family_a, ta.array(tag2), True)
+        in_fd = np.flatnonzero(in_fd)
+        for i, hvhv in zip(in_fd.tolist(), lookup(family_b, tags_b[in_fd])):
+            rev_hvhvs[i] = hvhv
+            heads[i] = hvhv[0]
+
+        if isinstance(value, HermConjOfFunc):
+            # Avoid nested HermConjOfFunc instances.
+            value, other = Other, value.function
+        else:
+            other = Other
+        # This does the same as 'self._set_edge' for each edge.
+        if self._change_log is not None:
+            self._change_log.extend(tails)
+            self._change_log.extend(hvhv[0] for hvhv in rev_hvhvs)
+        for edge_hvhvs, edge_heads, edge_value in [
+                (tail_hvhvs, heads, value), (rev_hvhvs, rev_heads, other)]:
+            for hvhv, head in zip(edge_hvhvs, edge_heads):
+                if len(hvhv) > 2 and head in hvhv[2::2]:
+                    i = 2 + 2 * hvhv[2::2].index(head)
+                    hvhv[i] = head
+                    hvhv[i + 1] = edge_value
+                else:
+                    hvhv.append(head)
+                    hvhv.append(edge_value)
+
     def _del_site(self, site):
         """Delete a single site and all associated hoppings."""
         if not isinstance(site, Site):
@@ -1178,6 +2329,9 @@ class Builder:
                 self._del_edge(*tfd(neighbor, site))
 
         del self.H[site]
+        self._spatial_cache = None
+        if self._change_log is not None:
+            self._change_log.append(site)
 
     def _del_hopping(self, hopping):
         """Delete a single hopping."""
@@ -1220,6 +2374,9 @@ class Builder:
                 else:
                     neighbor = False
                 del self.H[site]
+                self._spatial_cache = None
+                if self._change_log is not None:
+                    self._change_log.append(site)
                 site = neighbor
 
     def __iter__(self):
@@ -1304,12 +2461,29 @@ class Builder:
         This function takes into account the symmetry of the builder.  It is
         assumed that the symmetry is a translational symmetry.
 
-        This function executes in a time proportional to the number of sites,
-        so it is not efficient for large builders.  It is especially slow for
-        builders with a symmetry, but such systems often contain only a limited
-        number of sites.
+        `pos` may also be a 2d array of positions, one per row.  Then a list
+        of the closest sites is returned.
+
+        For builders without symmetry, the sites are looked up in a k-d tree
+        of their positions.  The tree is built when first needed and rebuilt
+        after sites have been added or deleted.  For builders with a symmetry,
+        this function executes in a time proportional to the number of sites,
+        so it is not efficient for large builders.  Such systems, however,
+        often contain only a limited number of sites.
 
         """
+        if isinstance(self.symmetry, NoSymmetry):
+            sites, index = self._spatial_index()
+            ids = index.closest(pos)
+            if np.ndim(ids) == 0:
+                return sites[ids] if ids >= 0 else None
+            return [sites[i] if i >= 0 else None for i in ids]
+        if np.ndim(pos) == 2:
+            return [self._closest_image(p) for p in pos]
+        return self._closest_image(pos)
+
+    def _closest_image(self, pos):
+        """Return the image of a site that is closest to `pos`."""
         errmsg = ("Builder.closest() requires site families that provide "
                   "pos().\nThe following one does not:\n")
         sym = self.symmetry
@@ -1352,6 +2526,55 @@ class Builder:
                 result = site
         return result
 
+    def sites_within(self, pos, radius):
+        """Return the sites that are within `radius` of the given position.
+
+        `pos` may also be a 2d array of positions, one per row.  Then a list
+        with the sites around each position is returned.
+
+        The sites are looked up in the same k-d tree as in `closest`.  This
+        function requires a builder without symmetry.
+        """
+        if not isinstance(self.symmetry, NoSymmetry):
+            raise ValueError('Builder.sites_within() requires a builder '
+                             'without symmetry.')
+        sites, index = self._spatial_index()
+        ids = index.within(pos, radius)
+        if isinstance(ids, list):
+            return [[sites[i] for i in group] for group in ids]
+        return [sites[i] for i in ids]
+
+    def _spatial_index(self):
+        """Return the sites of the builder and a `_SpatialIndex` of them.
+
+        The result is cached until sites are deleted, or until the number of
+        sites changes.
+        """
+        H = self.H
+        cache = self._spatial_cache
+        if cache is not None and cache[0] is H and cache[1] == len(H):
+            return cache[2:]
+        sites = list(H)
+        families, family_of_site = _group_by_family(sites)
+        positions = np.zeros((len(sites), 0))
+        for code, family in enumerate(families):
+            which = np.flatnonzero(family_of_site == code)
+            tags = _tag_array([sites[i].tag for i in which])
+            try:
+                family_positions = SiteArray(family, tags).positions
+            except AttributeError:
+                raise AttributeError("Builder.closest() requires site "
+                                     "families that provide pos().\nThe "
+                                     "following one does not:\n"
+                                     + str(family))
+            if not code:
+                positions = np.empty((len(sites),
+                                      family_positions.shape[1]))
+            positions[which] = family_positions
+        index = _SpatialIndex(positions)
+        self._spatial_cache = (H, len(H), sites, index)
+        return sites, index
+
     def update(self, other):
         """Update builder from `other`.
 
@@ -1467,7 +2690,10 @@ class Builder:
         shape : callable
             A boolean function of site returning whether the site should be
             added to the target builder or not. The shape must be compatible
-            with the symmetry of the target builder.
+            with the symmetry of the target builder.  If the shape is wrapped
+            in `Vectorized`, it is called with an array of site positions of
+            shape ``(N, dim)`` and must return a boolean array with one entry
+            per position, as for `~kwant.lattice.Polyatomic.shape`.
         start : `Site` instance or iterable thereof or iterable of numbers
             The site(s) at which the the flood-fill starts.  If start is an
             iterable of numbers, the starting site will be
@@ -1494,6 +2720,15 @@ class Builder:
         This function uses a flood-fill algorithm.  If the template builder
         consists of disconnected parts, the fill will stop at their boundaries.
 
+        When the shape is `Vectorized` and all the tags of the template are
+        integer tinyarrays of equal length (this is the case for lattices),
+        the flood-fill proceeds frontier by frontier: the sites added in one
+        step are treated together as arrays of tags, and the shape is
+        evaluated once per site family and step.  This is much faster for
+        large systems.  The result is the same as for an ordinary shape,
+        except for the order of the returned sites.  Should tags become too
+        large to be handled as arrays, the fill continues site by site.
+
         """
         if not max_sites > 0:
             raise ValueError("max_sites must be positive.")
@@ -1501,6 +2736,8 @@ class Builder:
         to_fd = self.symmetry.to_fd
         H = self.H
         templ_sym = template.symmetry
+        # The modifications made by the fill are not tracked.
+        self._change_log = None
 
         # Check that symmetries are commensurate.
         if not templ_sym.has_subgroup(self.symmetry):
@@ -1514,6 +2751,19 @@ class Builder:
             if start and not isinstance(start[0], Site):
                 start = [template.closest(start)]
 
+        fill_template = None
+        if isinstance(shape, Vectorized):
+            vectorized_shape = shape.function
+            try:
+                fill_template = _FillTemplate(template)
+            except ValueError:
+                # Fall back to calling the shape for each site.
+                pass
+
+            def shape(site):
+                inside = vectorized_shape(np.array([site.pos], float))
+                return bool(np.asarray(inside)[0])
+
         try:
             # "Active" are sites (mapped to the target's FD) that have been
             # verified to lie inside the shape, have been added to the target
@@ -1540,6 +2790,13 @@ class Builder:
                 return []
 
             done = []
+            if fill_template is not None:
+                # The vectorized fill returns the sites that remain to be
+                # filled if it cannot proceed.
+                done, active = self._fill_vectorized(
+                    fill_template, vectorized_shape, active, max_sites)
+                active = set(active)
+
             old_active = set()
             new_active = set()
 
@@ -1610,6 +2867,182 @@ class Builder:
 
         return done
 
+    def _fill_vectorized(self, templ, shape, active, max_sites):
+        """Flood-fill frontier by frontier using arrays of integer tags.
+
+        This is the implementation of `fill` for vectorized shapes.  `active`
+        are the starting sites that have already been added to the builder.
+
+        Returns the list of the sites that have been filled, and the list of
+        the sites of the current frontier, which have been added to the
+        builder but not filled yet.  The latter is empty unless the fill has
+        reached tags that cannot be packed into keys, in which case the fill
+        must be continued site by site.
+        """
+        H = self.H
+        sym = self.symmetry
+        templ_sym = templ.symmetry
+        families = templ.families
+        family_index = templ.family_index
+
+        for site in active:
+            if site.family not in family_index:
+                raise KeyError(templ_sym.to_fd(site))
+        sites = list(active)
+        fams, tags = templ.site_arrays(sites)
+        if not templ.packable(tags).all():
+            return [], sites
+        keys = templ.keys(fams, tags)
+
+        # Sites that were present before the fill.  The sites added by the
+        # fill can only be reached from the current or the previous frontier
+        # because the graph of hoppings is symmetric.  Sites whose tags
+        # cannot be packed cannot be equal to any head with a packable tag.
+        old_sites = [site for site in H
+                     if site.family in family_index
+                     and isinstance(site.tag, ta.ndarray_int)
+                     and len(site.tag) == templ.dim]
+        old_fams, old_tags = templ.site_arrays(old_sites)
+        packable = templ.packable(old_tags)
+        existing = templ.keys(old_fams[packable], old_tags[packable])
+        existing = np.setdiff1d(existing, keys)
+        order = np.argsort(keys)
+        recent = keys[order]
+        recent_sites = [sites[i] for i in order.tolist()]
+
+        done = []
+        while sites:
+            n = len(sites)
+            if len(done) + n > max_sites:
+                raise RuntimeError("Maximal number of sites (max_sites "
+                                   "parameter of fill()) added.")
+
+            # Find the template sites corresponding to the tails.
+            shifts = np.empty((n, templ_sym.num_directions), int)
+            templ_tags = np.empty_like(tags)
+            for f in np.unique(fams):
+                which = fams == f
+                family = families[f]
+                shifts[which] = templ_sym._which_tags(family, tags[which])
+                templ_tags[which] = templ_sym._act_tags(-shifts[which],
+                                                        family, tags[which])
+            ids = templ.tail_ids(fams, templ_tags)
+            if np.any(ids < 0):
+                i = np.argmax(ids < 0)
+                raise KeyError(Site(families[fams[i]],
+                                    ta.array(templ_tags[i]), True))
+
+            # Translate the template hoppings of the tails.
+            starts = templ.edge_ptr[ids]
+            counts = templ.edge_ptr[ids + 1] - starts
+            offsets = np.cumsum(counts) - counts
+            edges = (np.arange(np.sum(counts))
+                     + np.repeat(starts - offsets, counts))
+            edge_tails = np.repeat(np.arange(n), counts)
+            head_fams = templ.head_families[edges]
+            head_tags = templ.head_tags[edges]
+            fd_tags = np.empty_like(head_tags)
+            for f in np.unique(head_fams):
+                which = head_fams == f
+                family = families[f]
+                h = templ_sym._act_tags(shifts[edge_tails[which]], family,
+                                        head_tags[which])
+                head_tags[which] = h
+                fd_tags[which] = sym._act_tags(-sym._which_tags(family, h),
+                                               family, h)
+            if not (templ.packable(head_tags).all()
+                    and templ.packable(fd_tags).all()):
+                # Nothing has been modified in this step yet.
+                return done, sites
+            head_keys = templ.keys(head_fams, fd_tags)
+
+            done.extend(sites)
+            onsite_values = templ.onsite_values
+            for site, i in zip(sites, ids.tolist()):
+                H[site][1] = onsite_values[i]
+
+            # Classify the heads.
+            pending = ~_in_sorted(recent, head_keys)
+            present = pending & _in_sorted(existing, head_keys)
+            pending &= ~present
+            new_keys, first, inverse = np.unique(
+                head_keys[pending], return_index=True, return_inverse=True)
+            new_fams = head_fams[pending][first]
+            new_tags = fd_tags[pending][first]
+            inside = np.zeros(len(new_keys), bool)
+            for f in np.unique(new_fams):
+                which = new_fams == f
+                positions = SiteArray(families[f], new_tags[which]).positions
+                mask = np.asarray(shape(positions), bool)
+                if mask.shape != (np.sum(which),):
+                    raise ValueError('A vectorized shape must return a '
+                                     'boolean array with one entry per '
+                                     'position.')
+                inside[which] = mask
+            keep = np.ones(len(edges), bool)
+            keep[pending] = inside[inverse]
+
+            # The heads that were present before get the incoming edge as
+            # well, in order to balance the hopping.
+            for i in np.flatnonzero(present).tolist():
+                head = Site(families[head_fams[i]], ta.array(head_tags[i]),
+                            True)
+                self._set_edge(*sym.to_fd(head, sites[edge_tails[i]])
+                               + (templ.reverse_value(edges[i]),))
+
+            # Add the sites of the next frontier.
+            next_fams = new_fams[inside]
+            next_tags = new_tags[inside]
+            next_keys = new_keys[inside]
+            next_sites = [Site(families[f], ta.array(tag), True)
+                          for f, tag in zip(next_fams.tolist(),
+                                            next_tags.tolist())]
+            for site in next_sites:
+                H[site] = [site, None]
+
+            # Fill the outgoing edges.  Heads that lie in the fundamental
+            # domain share the site objects of the keys of the builder.
+            lookup_keys = np.concatenate((recent, next_keys))
+            lookup_sites = recent_sites + next_sites
+            order = np.argsort(lookup_keys)
+            lookup_keys = lookup_keys[order]
+            head_keys = head_keys[keep]
+            shared = (np.all(head_tags[keep] == fd_tags[keep], axis=1)
+                      & ~present[keep])
+            heads = [None] * len(head_keys)
+            for i, j in zip(np.flatnonzero(shared).tolist(),
+                            order[np.searchsorted(
+                                lookup_keys, head_keys[shared])].tolist()):
+                heads[i] = lookup_sites[j]
+            for i, f, tag in zip(np.flatnonzero(~shared).tolist(),
+                                 head_fams[keep][~shared].tolist(),
+                                 head_tags[keep][~shared].tolist()):
+                heads[i] = Site(families[f], ta.array(tag), True)
+            values = templ.values
+            values = [values[i] for i in edges[keep].tolist()]
+            bounds = np.searchsorted(edge_tails[keep], np.arange(n + 1))
+            for site, a, b in zip(sites, bounds[:-1].tolist(),
+                                  bounds[1:].tolist()):
+                if a == b:
+                    continue
+                hvhv = H[site]
+                pairs = [None] * (2 * (b - a))
+                pairs[::2] = heads[a:b]
+                pairs[1::2] = values[a:b]
+                hvhv.extend(pairs)
+
+            # The sites of the current and the next frontier are those that
+            # may be reached as heads in the next step.
+            lookup_keys = np.concatenate((keys, next_keys))
+            lookup_sites = sites + next_sites
+            order = np.argsort(lookup_keys)
+            recent = lookup_keys[order]
+            recent_sites = [lookup_sites[i] for i in order.tolist()]
+            fams, tags, keys = next_fams, next_tags, next_keys
+            sites = next_sites
+
+        return done, []
+
     def attach_lead(self, lead_builder, origin=None, add_cells=0):
         """Attach a lead to the builder, possibly adding missing sites.
 
@@ -1793,15 +3226,81 @@ class Builder:
 
         Currently, only Builder instances without or with a 1D translational
         `Symmetry` can be finalized.
+
+        After finalizing a builder without symmetry, its modifications are
+        tracked such that the finalized system can be updated with
+        `refinalized`.
         """
         if self.symmetry.num_directions == 0:
-            return FiniteSystem(self)
+            fsyst = FiniteSystem(self)
+            self._track_changes(fsyst)
+            return fsyst
         elif self.symmetry.num_directions == 1:
             return InfiniteSystem(self)
         else:
             raise ValueError('Currently, only builders without or with a 1D '
                              'translational symmetry can be finalized.')
 
+    def refinalized(self, fsyst):
+        """Update a finalized system after modifications of the builder.
+
+        Only the sites whose values or hoppings have been modified since
+        `fsyst` was finalized are processed, the rest of `fsyst` is reused.
+        For a large system of which only a small part changes, this is much
+        faster than finalizing the builder anew.
+
+        Parameters
+        ----------
+        fsyst : `FiniteSystem`
+            The result of the last call to `finalized` or `refinalized` of
+            this builder.  It is not modified.
+
+        Returns
+        -------
+        finalized_system : `FiniteSystem`
+            The same system as the one returned by `finalized`.
+        changed : 1d array of integers
+            The sorted indices in ``finalized_system.sites`` of the sites whose
+            onsite value or hoppings may differ from `fsyst`.  The
+            corresponding rows of the Hamiltonian are located with
+            ``finalized_system.site_ranges``; all other rows are the same as in
+            `fsyst`, up to the renumbering of the sites when sites have been
+            added or deleted.
+
+        Notes
+        -----
+        Modifications are tracked when sites and hoppings are set or deleted
+        with the ``[]`` syntax, with `add_sites` or `add_hoppings`, and with
+        `eradicate_dangling`.  Modifications with `fill` or `attach_lead` are
+        not tracked.  If the modifications have not been tracked, or if
+        `fsyst` is not the result of the last finalization of this builder,
+        the builder is finalized anew and all sites are reported as changed.
+
+        The leads are always finalized anew.
+        """
+        result = None
+        token, start = getattr(fsyst, '_change_log_position', (None, 0))
+        if (type(self).finalized is Builder.finalized
+                and self._change_log is not None
+                and token is self._change_log_token):
+            result, changed = fsyst._updated(
+                self, set(self._change_log[start:]))
+        if result is None:
+            result = self.finalized()
+            return result, np.arange(len(result.sites))
+        self._track_changes(result)
+        return result, changed
+
+    def _track_changes(self, fsyst):
+        """Track the modifications of the builder after finalizing it."""
+        # Once the log is longer than the system is large, it is not useful
+        # anymore, and the older finalized systems are forgotten.
+        if self._change_log is None or len(self._change_log) > len(self.H):
+            self._change_log_token = object()
+            self._change_log = []
+        fsyst._change_log_position = (self._change_log_token,
+                                      len(self._change_log))
+
     # Protect novice users from confusing error messages if they
     # forget to finalize their Builder.
 
@@ -1861,6 +3360,63 @@ def _translate_cons_law(cons_law):
     return vals, vecs
 
 
+def _find_ham_params(ham_param_map, hams, skip):
+    """Add the parameters taken by value functions to 'ham_param_map'.
+
+    'skip' is the number of site arguments of the value functions.
+    """
+    for ham in hams:
+        if (not callable(ham) or ham is Other or
+            ham in ham_param_map):
+            continue
+        # parameters come in the same order as in the function signature
+        params, defaults, takes_kwargs = get_parameters(ham)
+        params = params[skip:]  # remove site argument(s)
+        ham_param_map[ham] = (params, defaults, takes_kwargs)
+
+
+def _finalize_leads(builder, sites):
+    """Finalize the leads of a builder and find their interfaces.
+
+    Returns
+    -------
+    finalized_leads : list of finalized leads
+    lead_interfaces : list of arrays of integers
+        The indices of the interface sites of each lead in `sites`.
+    """
+    finalized_leads = []
+    lead_interfaces = []
+    for lead_nr, lead in enumerate(builder.leads):
+        try:
+            with warnings.catch_warnings(record=True) as ws:
+                warnings.simplefilter("always")
+                # The following line is the whole "payload" of the entire
+                # try-block.
+                finalized_leads.append(lead.finalized())
+            for w in ws:
+                # Re-raise any warnings with an additional message and the
+                # proper stacklevel.
+                w = w.message
+                msg = 'When finalizing lead {0}:'.format(lead_nr)
+                warnings.warn(w.__class__(' '.join((msg,) + w.args)),
+                              stacklevel=4)
+        except ValueError as e:
+            # Re-raise the exception with an additional message.
+            msg = 'Problem finalizing lead {0}:'.format(lead_nr)
+            e.args = (' '.join((msg,) + e.args),)
+            raise
+        try:
+            interface = [sites.id_by_site[isite]
+                         for isite in lead.interface]
+        except KeyError as e:
+            msg = ("Lead {0} is attached to a site that does not "
+                   "belong to the scattering region:\n {1}")
+            raise ValueError(msg.format(lead_nr, e.args[0]))
+
+        lead_interfaces.append(np.array(interface))
+    return finalized_leads, lead_interfaces
+
+
 class _FinalizedBuilderMixin:
     """Common functionality for all finalized builders"""
 
@@ -1869,17 +3425,130 @@ class _FinalizedBuilderMixin:
         """
         ham_param_map = {}
         for hams, skip in [(self.onsite_hamiltonians, 1), (self.hoppings, 2)]:
-            for ham in hams:
-                if (not callable(ham) or ham is Other or
-                    ham in ham_param_map):
-                    continue
-                # parameters come in the same order as in the function signature
-                params, defaults, takes_kwargs = get_parameters(ham)
-                params = params[skip:]  # remove site argument(s)
-                ham_param_map[ham] = (params, defaults, takes_kwargs)
+            _find_ham_params(ham_param_map, _distinct_values(hams), skip)
 
         self._ham_param_map = ham_param_map
 
+    def _init_vectorized_terms(self):
+        """Group the sites and hoppings that have vectorized values
+
+        Sites are grouped by family and value function, hoppings by the
+        families of both sites and value function.  Each hopping is stored only
+        once, in the direction in which its value function is defined.
+        """
+        sites = self.sites
+        onsite_groups = _vectorized_groups(self.onsite_hamiltonians)
+        hopping_groups = _vectorized_groups(self.hoppings)
+        if not (onsite_groups or hopping_groups):
+            self._vectorized_terms = None
+            return
+
+        if isinstance(sites, _SiteList):
+            families = [site_array.family for site_array in sites.site_arrays]
+            family_of_site = np.repeat(np.arange(len(families)),
+                                       np.diff(sites._offsets))
+        else:
+            families, family_of_site = _group_by_family(sites)
+
+        def site_array(code, site_ids):
+            if isinstance(sites, _SiteList):
+                site_array = sites.site_arrays[code]
+                tags = site_array.tags[site_ids - sites._offsets[code]]
+                if tags.dtype != object:
+                    tags = tags.astype(int)
+                return SiteArray(site_array.family, tags)
+            return SiteArray(families[code],
+                             np.array([sites[i].tag for i in site_ids]))
+
+        onsite_mask = np.zeros(self.graph.num_nodes, np.int8)
+        onsite_terms = []
+        for value, site_ids in onsite_groups.items():
+            codes = family_of_site[site_ids]
+            for code in np.unique(codes):
+                ids = site_ids[codes == code].astype(graph.gint_dtype)
+                onsite_mask[ids] = 1
+                onsite_terms.append((value, ids, site_array(code, ids)))
+
+        # 'hamiltonian_submatrix' visits each hopping once, through the edge
+        # whose tail is not larger than its head.  That is the edge that is
+        # marked.  The reversed edges are found by bisection in the sorted
+        # keys of all the edges.
+        hopping_mask = np.zeros(self.graph.num_edges, np.int8)
+        hopping_terms = []
+        all_tails, all_heads = self.graph.edge_arrays()
+        num_nodes = self.graph.num_nodes
+        edge_keys = all_tails.astype(np.int64) * num_nodes + all_heads
+        edge_order = np.argsort(edge_keys, kind='mergesort')
+        edge_keys = edge_keys[edge_order]
+        for value, edge_ids in hopping_groups.items():
+            tails, heads = all_tails[edge_ids], all_heads[edge_ids]
+            lo, hi = np.minimum(tails, heads), np.maximum(tails, heads)
+            first = np.searchsorted(edge_keys,
+                                    lo.astype(np.int64) * num_nodes + hi)
+            hopping_mask[edge_order[first]] = 1
+            codes = (family_of_site[tails] * len(families) +
+                     family_of_site[heads])
+            for code in np.unique(codes):
+                which = codes == code
+                code_a, code_b = divmod(code, len(families))
+                hopping_terms.append((value, tails[which], heads[which],
+                                      site_array(code_a, tails[which]),
+                                      site_array(code_b, heads[which])))
+
+        self._vectorized_terms = (onsite_mask, hopping_mask,
+                                  onsite_terms, hopping_terms)
+
+    def _eval_vectorized(self, value, site_arrays, args, params):
+        n = len(site_arrays[0])
+        if params:
+            required, defaults, takes_kw = self._ham_param_map[value]
+            invalid_params = set(params).intersection(set(defaults))
+            if invalid_params:
+                raise ValueError("Parameters {} have default values "
+                                 "and may not be set with 'params'"
+                                 .format(', '.join(invalid_params)))
+            if not takes_kw:
+                params = {pn: params[pn] for pn in required}
+            try:
+                value = value(*site_arrays, **params)
+            except Exception as exc:
+                _raise_user_error(exc, value)
+        else:
+            try:
+                value = value(*site_arrays, *args)
+            except Exception as exc:
+                _raise_user_error(exc, value)
+        return _normalize_vectorized_value(value, n)
+
+    def _eval_vectorized_terms(self, args=(), params=None):
+        """Evaluate all the vectorized value functions of the system.
+
+        Returns
+        -------
+        onsite_mask : array of int8
+            Nonzero for the sites whose onsite value is included in 'onsites'.
+        hopping_mask : array of int8
+            Nonzero for the edges whose hopping value is included in
+            'hoppings'.
+        onsites : list of pairs
+            Each pair consists of an array of site ids and the stacked
+            values ``(N, norbs, norbs)`` of these sites.
+        hoppings : list of triples
+            Each triple consists of two arrays of site ids ``i``, ``j`` and
+            the stacked hopping values ``(N, norbs_i, norbs_j)``.
+        """
+        if args and params:
+            raise TypeError("'args' and 'params' are mutually exclusive.")
+        onsite_mask, hopping_mask, onsite_terms, hopping_terms = \
+            self._vectorized_terms
+        onsites = [(site_ids, self._eval_vectorized(value, (sites,),
+                                                    args, params))
+                   for value, site_ids, sites in onsite_terms]
+        hoppings = [(tails, heads,
+                     self._eval_vectorized(value, (sites_a, sites_b),
+                                           args, params))
+                    for value, tails, heads, sites_a, sites_b in hopping_terms]
+        return onsite_mask, hopping_mask, onsites, hoppings
 
     def _init_discrete_symmetries(self, builder):
         def operator(op):
@@ -1987,81 +3656,191 @@ class FiniteSystem(_FinalizedBuilderMixin, system.FiniteSystem):
     sites : sequence
         ``sites[i]`` is the `~kwant.builder.Site` instance that corresponds
         to the integer-labeled site ``i`` of the low-level system. The sites
-        are ordered first by their family and then by their tag.
-    id_by_site : dict
-        The inverse of ``sites``; maps from ``i`` to ``sites[i]``.
+        are ordered first by their family and then by their tag.  They are
+        stored compactly as one `~kwant.builder.SiteArray` per family (in the
+        attribute ``sites.site_arrays``), and the `~kwant.builder.Site`
+        instances are only created when needed.  ``sites.positions`` is an
+        array of the positions of all the sites.
+    id_by_site : mapping
+        The inverse of ``sites``; maps from ``sites[i]`` to ``i``.
     """
 
     def __init__(self, builder):
         assert builder.symmetry.num_directions == 0
 
+        H = builder.H
+        keys = list(H)
+        hvhvs = list(H.values())
+
         #### Make translation tables.
-        sites = tuple(sorted(builder.H))
-        id_by_site = {}
-        for site_id, site in enumerate(sites):
-            id_by_site[site] = site_id
+        # The sites are sorted by family and then by tag.  The tags of
+        # families with integer tags are sorted as arrays.
+        families, family_of_key = _group_by_family(keys)
+        order = [np.zeros(0, int)]
+        site_arrays = []
+        for code in sorted(range(len(families)), key=families.__getitem__):
+            which = np.flatnonzero(family_of_key == code)
+            tags = _tag_array([keys[i][1] for i in which])
+            if tags.dtype == object:
+                perm = sorted(range(len(tags)), key=tags.__getitem__)
+            else:
+                perm = np.lexsort(tags.T[::-1])
+            order.append(which[perm])
+            site_arrays.append(SiteArray(families[code], tags[perm]))
+        order = np.concatenate(order)
+        sites = _SiteList(site_arrays)
+        id_by_key = np.empty(len(keys), int)
+        id_by_key[order] = np.arange(len(keys))
 
         #### Make graph.
+        # The edges are sorted by their tail, like in the compressed graph,
+        # such that the hoppings can be ordered in the same way.
+        num_heads = np.fromiter(map(len, hvhvs), int, len(hvhvs)) // 2 - 1
+        heads = list(chain.from_iterable(hvhv[2::2] for hvhv in hvhvs))
+        values = list(chain.from_iterable(hvhv[3::2] for hvhv in hvhvs))
+        tails = np.repeat(id_by_key, num_heads)
+        heads = _site_ids(sites.id_by_site, heads)
+        edge_order = np.argsort(tails, kind='mergesort')
+        edge_order = edge_order[tails[edge_order] != heads[edge_order]]
         g = graph.Graph()
         g.num_nodes = len(sites)  # Some sites could not appear in any edge.
-        for tail, hvhv in builder.H.items():
-            for head in islice(hvhv, 2, None, 2):
-                if tail == head:
-                    continue
-                g.add_edge(id_by_site[tail], id_by_site[head])
+        g.add_edges(np.column_stack([tails[edge_order], heads[edge_order]]))
         g = g.compressed()
 
-        #### Connect leads.
-        finalized_leads = []
-        lead_interfaces = []
-        for lead_nr, lead in enumerate(builder.leads):
-            try:
-                with warnings.catch_warnings(record=True) as ws:
-                    warnings.simplefilter("always")
-                    # The following line is the whole "payload" of the entire
-                    # try-block.
-                    finalized_leads.append(lead.finalized())
-                for w in ws:
-                    # Re-raise any warnings with an additional message and the
-                    # proper stacklevel.
-                    w = w.message
-                    msg = 'When finalizing lead {0}:'.format(lead_nr)
-                    warnings.warn(w.__class__(' '.join((msg,) + w.args)),
-                                  stacklevel=3)
-            except ValueError as e:
-                # Re-raise the exception with an additional message.
-                msg = 'Problem finalizing lead {0}:'.format(lead_nr)
-                e.args = (' '.join((msg,) + e.args),)
-                raise
-            try:
-                interface = [id_by_site[isite] for isite in lead.interface]
-            except KeyError as e:
-                msg = ("Lead {0} is attached to a site that does not "
-                       "belong to the scattering region:\n {1}")
-                raise ValueError(msg.format(lead_nr, e.args[0]))
-
-            lead_interfaces.append(np.array(interface))
-
-        onsite_hamiltonians = [builder.H[site][1] for site in sites]
-        hoppings = [builder._get_edge(sites[tail], sites[head])
-                           for tail, head in g]
+        onsite_hamiltonians = [hvhvs[i][1] for i in order]
+        hoppings = [values[i] for i in edge_order]
 
         self.graph = g
         self.sites = sites
         self.site_ranges = _site_ranges(sites)
-        self.id_by_site = id_by_site
         self.hoppings = hoppings
         self.onsite_hamiltonians = onsite_hamiltonians
         self.symmetry = builder.symmetry
-        self.leads = finalized_leads
-        self.lead_interfaces = lead_interfaces
+        self.leads, self.lead_interfaces = _finalize_leads(builder, sites)
         self._init_ham_param_maps()
+        self._init_vectorized_terms()
         self._init_discrete_symmetries(builder)
 
+    def _updated(self, builder, changed_sites):
+        """Return a copy of the system updated to the state of `builder`.
+
+        The system must have been finalized from `builder`, and since then
+        only the values and hoppings of the sites in `changed_sites` may have
+        been modified.  These sites may also have been added or deleted.
+
+        Returns
+        -------
+        syst : `FiniteSystem` or None
+            None if the modifications are inconsistent with `changed_sites`.
+        changed : array of integers
+            The sorted indices of the changed sites in ``syst.sites``.
+        """
+        H = builder.H
+        changed_sites = list(changed_sites)
+        old_ids = _site_ids(self.id_by_site, changed_sites, strict=False)
+        present = np.fromiter((site in H for site in changed_sites), bool,
+                              len(changed_sites))
+        dirty = np.zeros(len(self.sites), bool)
+        dirty[old_ids[old_ids >= 0]] = True
+        if np.all(present == (old_ids >= 0)):
+            sites = self.sites
+            new_ids = np.arange(len(sites))
+            added_ids = np.zeros(0, int)
+        else:
+            removed = old_ids[(old_ids >= 0) & ~present]
+            added = [changed_sites[i]
+                     for i in np.flatnonzero((old_ids < 0) & present)]
+            sites, new_ids, added_ids = self.sites.updated(removed, added)
+        changed_sites = [changed_sites[i] for i in np.flatnonzero(present)]
+        old_ids = old_ids[present]
+        changed = np.empty(len(changed_sites), int)
+        changed[old_ids >= 0] = new_ids[old_ids[old_ids >= 0]]
+        changed[old_ids < 0] = added_ids
+        hvhvs = [H[site] for site in changed_sites]
+
+        #### Update the graph.
+        # The edges of the unchanged sites are kept.  Edges of the same tail
+        # keep their order when sorted, as in the constructor.
+        old_tails, old_heads = self.graph.edge_arrays()
+        kept = np.flatnonzero(~dirty[old_tails])
+        num_heads = np.fromiter(map(len, hvhvs), int, len(hvhvs)) // 2 - 1
+        heads = list(chain.from_iterable(hvhv[2::2] for hvhv in hvhvs))
+        new_values = list(chain.from_iterable(hvhv[3::2] for hvhv in hvhvs))
+        tails = np.concatenate([new_ids[old_tails[kept]],
+                                np.repeat(changed, num_heads)])
+        heads = np.concatenate([new_ids[old_heads[kept]],
+                                _site_ids(sites.id_by_site, heads)])
+        if np.any(heads < 0):
+            # An unchanged site has a hopping to a deleted one.
+            return None, None
+        edge_order = np.argsort(tails, kind='mergesort')
+        edge_order = edge_order[tails[edge_order] != heads[edge_order]]
+        g = graph.Graph()
+        g.num_nodes = len(sites)
+        g.add_edges(np.column_stack([tails[edge_order], heads[edge_order]]))
+        g = g.compressed()
+        origins = np.concatenate([kept, len(self.hoppings)
+                                  + np.arange(len(new_values))])
+        values = self.hoppings + new_values
+        hoppings = list(map(values.__getitem__, origins[edge_order].tolist()))
+
+        #### Update the values of the sites.
+        origins = np.empty(len(sites), int)
+        old = np.flatnonzero(new_ids >= 0)
+        origins[new_ids[old]] = old
+        origins[changed] = len(self.onsite_hamiltonians) + np.arange(
+            len(changed))
+        new_onsites = [hvhv[1] for hvhv in hvhvs]
+        values = self.onsite_hamiltonians + new_onsites
+        onsite_hamiltonians = list(map(values.__getitem__, origins.tolist()))
+
+        result = object.__new__(FiniteSystem)
+        result.graph = g
+        result.sites = sites
+        result.site_ranges = _site_ranges(sites)
+        result.hoppings = hoppings
+        result.onsite_hamiltonians = onsite_hamiltonians
+        result.symmetry = builder.symmetry
+        result.leads, result.lead_interfaces = _finalize_leads(builder, sites)
+        result._ham_param_map = dict(self._ham_param_map)
+        _find_ham_params(result._ham_param_map, new_onsites, 1)
+        _find_ham_params(result._ham_param_map, new_values, 2)
+        if (self._vectorized_terms is None
+                and not any(map(_is_vectorized, new_onsites + new_values))):
+            result._vectorized_terms = None
+        else:
+            result._init_vectorized_terms()
+        result._init_discrete_symmetries(builder)
+        return result, np.sort(changed)
+
+
+    @property
+    def id_by_site(self):
+        return self.sites.id_by_site
 
     def pos(self, i):
         return self.sites[i].pos
 
+    def closest(self, pos):
+        """Return the index of the site that is closest to a position.
+
+        `pos` may also be a 2d array of positions, one per row.  Then an
+        array with the indices of the closest sites is returned.
+
+        The sites are looked up in a k-d tree of their positions that is
+        built when first needed.
+        """
+        return self.sites.spatial_index.closest(pos)
+
+    def sites_within(self, pos, radius):
+        """Return the indices of the sites within `radius` of a position.
+
+        The indices are returned as a sorted array.  `pos` may also be a 2d
+        array of positions, one per row.  Then a list with such an array for
+        each position is returned.
+        """
+        return self.sites.spatial_index.within(pos, radius)
+
 
 class InfiniteSystem(_FinalizedBuilderMixin, system.InfiniteSystem):
     """Finalized infinite system, extracted from a `Builder`.
@@ -2211,6 +3990,36 @@ class InfiniteSystem(_FinalizedBuilderMixin, system.InfiniteSystem):
         self.cell_size = cell_size
         self._init_ham_param_maps()
         self._init_discrete_symmetries(builder)
+        self._init_relevant_param_names()
+
+    def _init_relevant_param_names(self):
+        """Find the names of all parameters that the lead may depend on.
+
+        These are the parameters of the value functions and of the discrete
+        symmetries.  If any of them takes arbitrary keyword arguments, all
+        parameters are relevant, signalled by ``None``.
+        """
+        infos = list(self._ham_param_map.values())
+        operators = list(self._symmetries)
+        if self._cons_law is not None:
+            operators.extend(self._cons_law)
+        infos.extend(op._onsite_params_info for op in operators
+                     if op is not None)
+        names = set()
+        for required, defaults, takes_kwargs in infos:
+            if takes_kwargs:
+                self._relevant_param_names = None
+                return
+            # Parameters with default values may be passed as well.
+            names.update(required, defaults)
+        self._relevant_param_names = names
+
+    def _relevant_params(self, params):
+        names = getattr(self, '_relevant_param_names', None)
+        if names is None:
+            return params
+        return {name: value for name, value in params.items()
+                if name in names}
 
 
     def hamiltonian(self, i, j, *args, params=None):
@@ -503,6 +503,26 @@ cdef class CGraph:
             raise EdgeDoesNotExistError()
         return result
 
+    def edge_arrays(self):
+        """Return the tails and heads of all the edges as arrays.
+
+        Returns
+        -------
+        tails, heads : arrays of integers
+            ``tails[i]`` and ``heads[i]`` are the tail and the head of the
+            edge with ID ``i``.  Only edges with non-negative tails are
+            included.
+        """
+        cdef gint num_edges = self.heads_idxs[self.num_nodes]
+        heads_idxs = np.array(<gint[:self.num_nodes + 1]>self.heads_idxs)
+        tails = np.repeat(np.arange(self.num_nodes, dtype=heads_idxs.dtype),
+                          np.diff(heads_idxs))
+        if num_edges:
+            heads = np.array(<gint[:num_edges]>self.heads)
+        else:
+            heads = np.zeros(0, heads_idxs.dtype)
+        return tails, heads
+
     def first_edge_id(self, gint tail, gint head):
         """Return the edge ID of the first edge (tail, head).
 
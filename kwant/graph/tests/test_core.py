@@ -182,6 +182,18 @@ def test_edge_ids():
     raises(EdgeDoesNotExistError, g.edge_id, 1)
 
 
+def test_edge_arrays():
+    gr = Graph(allow_negative_nodes=True)
+    gr.add_edges([(2, 0), (0, 1), (0, -1), (-1, 2), (2, 1), (1, 2)])
+    for g in [gr.compressed(twoway=True), gr.compressed(allow_lost_edges=True)]:
+        tails, heads = g.edge_arrays()
+        assert list(zip(tails, heads)) == [(0, 1), (0, -1), (1, 2),
+                                           (2, 0), (2, 1)]
+
+    tails, heads = Graph().compressed().edge_arrays()
+    assert len(tails) == len(heads) == 0
+
+
 def test_pickle():
     gr = Graph(allow_negative_nodes=True)
     edges = [(0, -1), (-1, 0), (1, 2), (1, 2), (0, -1), (-1, 0), (-1, 0)]
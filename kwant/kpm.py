@@ -8,16 +8,19 @@
 # http://kwant-project.org/authors.
 
 import math
+import warnings
 import numpy as np
 import scipy
+import scipy.special
 import scipy.sparse.linalg as sla
 import scipy.fftpack as fft
 
 from . import system
 from ._common import ensure_rng
 from .operator import _LocalOperator
+from .linalg.spmv import SparseOperator, uniform_blocksize
 
-__all__ = ['SpectralDensity']
+__all__ = ['SpectralDensity', 'Correlator', 'conductivity']
 
 
 class SpectralDensity:
@@ -79,6 +82,22 @@ class SpectralDensity:
 
     Notes
     -----
+    All the random vectors that are added at once (on creation or by
+    `add_vectors`) are advanced together through the Chebyshev
+    recursion: for each moment, the rescaled Hamiltonian is multiplied
+    with a dense ``(N, num_vectors)`` block of vectors, such that the
+    matrix elements of the Hamiltonian are read from memory only once for
+    all the vectors.  Two such blocks are kept in memory during the
+    calculation.  The products are computed with several threads, if Kwant
+    has been compiled with OpenMP support.  The number of threads can be set by
+    the environment variable ``OMP_NUM_THREADS``.  If all the sites of a
+    system have the same number of orbitals, the Hamiltonian is stored in
+    the block sparse row format.
+
+    The state of the calculation can be written to disk with `save` and
+    resumed with `load`.  Calculations with different random vectors, for
+    example on different nodes of a cluster, can be combined with `merge`.
+
     When passing an ``operator`` defined in `~kwant.operator`, the
     result of ``operator(bra, ket)`` depends on the attribute ``sum``
     of such operator. If ``sum=True``, densities will be scalars, that
@@ -132,6 +151,11 @@ class SpectralDensity:
         the range of the spectrum.
     densities : array of floats
         Spectral density of the ``operator`` evaluated at the energies.
+    errors : array of floats
+        Standard errors of the ``densities`` due to the stochastic
+        evaluation of the trace, estimated from the spread of the densities
+        of the individual random vectors. NaN if there is only one random
+        vector.
     """
 
     def __init__(self, hamiltonian, params=None, operator=None,
@@ -147,41 +171,15 @@ class SpectralDensity:
         # spectrum strictly in the interval (-1,1).
         self.eps = eps
 
-        # Normalize the format of 'ham'
-        if isinstance(hamiltonian, system.System):
-            hamiltonian = hamiltonian.hamiltonian_submatrix(params=params,
-                                                            sparse=True)
-        try:
-            hamiltonian = scipy.sparse.csr_matrix(hamiltonian)
-        except Exception:
-            raise ValueError("'hamiltonian' is neither a matrix "
-                             "nor a Kwant system.")
-
-        # Normalize 'operator' to a common format.
-        if operator is None:
-            self.operator = None
-        elif isinstance(operator, _LocalOperator):
-            self.operator = operator.bind(params=params)
-        elif callable(operator):
-            self.operator = operator
-        elif hasattr(operator, 'dot'):
-            operator = scipy.sparse.csr_matrix(operator)
-            self.operator = lambda bra, ket: np.vdot(bra, operator.dot(ket))
-        else:
-            raise ValueError('Parameter `operator` has no `.dot` '
-                             'attribute and is not callable.')
-
-        self._vector_factory = vector_factory or \
-            (lambda n: np.exp(2j * np.pi * rng.random_sample(n)))
+        hamiltonian, blocksize = self._prepare(hamiltonian, params, operator,
+                                               vector_factory, rng)
         # store this vector for reproducibility
         self._v0 = np.exp(2j * np.pi * rng.random_sample(hamiltonian.shape[0]))
         self._rand_vect_list = []
         # Hamiltonian rescaled as in Eq. (24)
-        self.hamiltonian, (self._a, self._b) = _rescale(hamiltonian,
-                                                        eps=self.eps,
-                                                        v0=self._v0,
-                                                        bounds=bounds)
-        self.bounds = (self._b - self._a, self._b + self._a)
+        _, (a, b) = _rescale(hamiltonian, eps=self.eps, v0=self._v0,
+                             bounds=bounds)
+        self._set_scale(hamiltonian, blocksize, a, b)
 
         if energy_resolution:
             num_moments = math.ceil((1.6 * self._a) / energy_resolution)
@@ -206,12 +204,43 @@ class SpectralDensity:
         self.num_vectors = 0  # new random vectors will be used
         self._update_moments_list(self.num_moments, num_vectors)
         self.num_vectors = num_vectors
+        self._update_densities()
 
-        moments = self._moments()
-        xk_rescaled, rho, self._gammas = _calc_fft_moments(
-            moments, 2 * self.num_moments)
-        self.energies = xk_rescaled * self._a + self._b
-        self.densities = rho
+    def _prepare(self, hamiltonian, params, operator, vector_factory, rng):
+        """Normalize the Hamiltonian and the operator, and set the vector
+        factory.  Return the Hamiltonian as a CSR matrix and its block size.
+        """
+        hamiltonian, blocksize = _normalize_hamiltonian(hamiltonian, params)
+
+        # Normalize 'operator' to a common format.
+        if operator is None:
+            self.operator = None
+        elif isinstance(operator, _LocalOperator):
+            self.operator = operator.bind(params=params)
+        elif callable(operator):
+            self.operator = operator
+        elif hasattr(operator, 'dot'):
+            operator = scipy.sparse.csr_matrix(operator)
+            self.operator = lambda bra, ket: np.vdot(bra, operator.dot(ket))
+        else:
+            raise ValueError('Parameter `operator` has no `.dot` '
+                             'attribute and is not callable.')
+
+        self._rng = rng
+        self._vector_factory = vector_factory or \
+            (lambda n: np.exp(2j * np.pi * rng.random_sample(n)))
+        return hamiltonian, blocksize
+
+    def _set_scale(self, hamiltonian, blocksize, a, b):
+        """Set the Hamiltonian, rescaled with 'a' and 'b' as in Eq. (24)."""
+        self._a, self._b = a, b
+        self.bounds = (b - a, b + a)
+        # Twice the rescaled Hamiltonian, as used by the Chebyshev recursion.
+        # The rescaled Hamiltonian is expressed through it, such that only
+        # one copy of the matrix is kept.
+        self._chebyshev_matrix = _chebyshev_matrix(hamiltonian, a, b,
+                                                   blocksize)
+        self.hamiltonian = 0.5 * self._chebyshev_matrix
 
     def __call__(self, energy=None):
         """Return the spectral density evaluated at ``energy``.
@@ -241,13 +270,7 @@ class SpectralDensity:
 
             moments = self._moments()
 
-            m = np.arange(self.num_moments)
-
-            kernel = ((self.num_moments - m + 1) *
-                      np.cos(np.pi * m/(self.num_moments + 1)) +
-                      np.sin(np.pi * m/(self.num_moments + 1)) /
-                      np.tan(np.pi/(self.num_moments + 1)))
-            kernel = kernel / (self.num_moments + 1)
+            kernel = _jackson_kernel(self.num_moments)
 
             # transposes handle the case where operators have vector outputs
             coef_cheb = np.transpose(moments.transpose() * kernel)
@@ -256,26 +279,38 @@ class SpectralDensity:
             return np.transpose(np.polynomial.chebyshev.chebval(
                     rescaled_energy, coef_cheb) / g_e).real
 
-    def integrate(self, distribution_function=None):
+    def integrate(self, distribution_function=None, return_error=False):
         """Returns the total spectral density.
 
         Returns the integral over the whole spectrum with an optional
         distribution function. ``distribution_function`` should be able
         to take arrays as input. Defined using Gauss-Chebyshev
         integration.
+
+        If ``return_error`` is true, a tuple is returned that contains in
+        addition the standard error of the integral due to the stochastic
+        evaluation of the trace.
         """
         # This factor divides the sum to normalize the Gauss integral
         # and rescales the integral back with ``self._a`` to normal
         # scale.
         factor = self._a / (2 * self.num_moments)
         if distribution_function is None:
-            rho = self._gammas
+            weights = 1
         else:
             # The evaluation of the distribution function should be at
             # the energies without rescaling.
-            distribution_array = distribution_function(self.energies)
-            rho = np.transpose(self._gammas.transpose() * distribution_array)
-        return factor * np.sum(rho, axis=0)
+            weights = distribution_function(self.energies)
+
+        def integral(gammas):
+            return factor * np.sum(np.transpose(gammas.transpose()
+                                                * weights), axis=0)
+
+        result = integral(self._gammas)
+        if not return_error:
+            return result
+        samples = (integral(gammas) for _, gammas in self._vector_spectra())
+        return result, _standard_error(samples, result, self.num_vectors)
 
     def add_moments(self, num_moments=None, *, energy_resolution=None):
         """Increase the number of Chebyshev moments.
@@ -316,21 +351,57 @@ class SpectralDensity:
                                   self.num_vectors)
         self.num_moments += num_moments
 
-        # recalculate quantities derived from the moments
-        moments = self._moments()
-        xk_rescaled, rho, self._gammas = _calc_fft_moments(
-            moments, 2 * self.num_moments)
-        self.energies = xk_rescaled * self._a + self._b
-        self.densities = rho
+        self._update_densities()
 
-    def add_vectors(self, num_vectors):
+    def add_vectors(self, num_vectors=None, *, rtol=None, batch_size=10,
+                    max_vectors=1000):
         """Increase the number of random vectors.
 
         Parameters
         ----------
         num_vectors: positive int
-            The number of random vectors to add.
+            The number of random vectors to add. Mutually exclusive
+            with 'rtol'.
+        rtol: positive float, optional
+            Add random vectors until the relative error of the densities
+            is smaller than 'rtol'. The relative error is the largest of
+            the ``errors`` divided by the largest absolute value of the
+            ``densities``, and zero if all the errors vanish. Mutually
+            exclusive with 'num_vectors'.
+        batch_size: positive int, default: 10
+            The number of random vectors that are added at once if 'rtol'
+            is provided.
+        max_vectors: positive int, default: 1000
+            The largest total number of random vectors if 'rtol' is
+            provided. A warning is issued if 'rtol' is not reached.
         """
+        if not ((num_vectors is None) ^ (rtol is None)):
+            raise TypeError("either 'num_vectors' or 'rtol' "
+                            "must be provided.")
+        if rtol is None:
+            self._add_vectors(num_vectors)
+            return
+
+        if rtol <= 0:
+            raise ValueError("'rtol' must be positive")
+        if batch_size <= 0 or batch_size != int(batch_size):
+            raise ValueError("'batch_size' must be a positive integer")
+        if max_vectors <= 0 or max_vectors != int(max_vectors):
+            raise ValueError("'max_vectors' must be a positive integer")
+        # The comparison is false while the error is not known, that is
+        # for a single random vector.
+        while not self._relative_error() <= rtol:
+            num_vectors = min(batch_size, max_vectors - self.num_vectors)
+            if num_vectors <= 0:
+                warnings.warn('The relative error {:.3g} is larger than '
+                              "'rtol' with {} random vectors."
+                              .format(self._relative_error(),
+                                      self.num_vectors),
+                              RuntimeWarning, stacklevel=2)
+                break
+            self._add_vectors(num_vectors)
+
+    def _add_vectors(self, num_vectors):
         if num_vectors <= 0 or num_vectors != int(num_vectors):
             raise ValueError("'num_vectors' must be a positive integer")
         for r in range(num_vectors):
@@ -342,12 +413,169 @@ class SpectralDensity:
                                   self.num_vectors + num_vectors)
         self.num_vectors += num_vectors
 
-        # recalculate quantities derived from the moments
+        self._update_densities()
+
+    def _relative_error(self):
+        """Return the largest error relative to the largest density.
+
+        The result is NaN while the errors are not known, zero if all the
+        errors vanish, and infinite if only the densities vanish.
+        """
+        error = np.max(self.errors)
+        if error == 0:
+            return 0.
+        scale = np.max(np.abs(self.densities))
+        return error / scale if scale else np.inf
+
+    def save(self, file, save_vectors=False):
+        """Save the state of the calculation to a file.
+
+        The moments of every random vector and the state of the random
+        number generator are written in the NumPy ``.npz`` format, such
+        that the calculation can be resumed with `load`, or combined with
+        other calculations with `merge`.
+
+        Parameters
+        ----------
+        file : str or file
+            File name or file object, as accepted by `numpy.savez`.
+        save_vectors : bool, default: False
+            Whether to save the random vectors and the last two vectors of
+            the Chebyshev recursion for every random vector.  They take
+            ``3 * num_vectors`` times the memory of a vector, but are
+            required to add moments after loading.
+        """
+        data = dict(version=_CHECKPOINT_VERSION, eps=self.eps,
+                    a=self._a, b=self._b,
+                    moments=np.asarray(self._moments_list))
+        get_state = getattr(self._rng, 'get_state', None)
+        if get_state is not None:
+            name, keys, pos, has_gauss, cached_gaussian = get_state()
+            if name == 'MT19937':
+                data.update(rng_keys=keys, rng_pos=pos,
+                            rng_has_gauss=has_gauss,
+                            rng_cached_gaussian=cached_gaussian)
+        if save_vectors:
+            if not self._has_vectors():
+                raise ValueError('The random vectors are not available.')
+            data['vectors'] = np.asarray(self._rand_vect_list)
+            data['alphas'] = np.asarray(self._last_two_alphas)
+        np.savez(file, **data)
+
+    @classmethod
+    def load(cls, file, hamiltonian, params=None, operator=None,
+             vector_factory=None, rng=None):
+        """Resume a calculation saved with `save`.
+
+        Parameters
+        ----------
+        file : str or file
+            File name or file object, as accepted by `numpy.load`.
+        hamiltonian : `~kwant.system.FiniteSystem` or matrix Hamiltonian
+            The Hamiltonian of the saved calculation.
+        params : dict, optional
+            Additional parameters to pass to the Hamiltonian and operator.
+        operator : operator, dense matrix, or sparse matrix, optional
+            The operator of the saved calculation.
+        vector_factory : function, optional
+            The function that generates new random vectors, see
+            `SpectralDensity`.
+        rng : seed, or random number generator, optional
+            If not provided, the saved state of the random number generator
+            is restored, if it has been saved.
+
+        Returns
+        -------
+        spectrum : `SpectralDensity`
+            If the vectors have not been saved, random vectors can be added,
+            but not moments.
+        """
+        with np.load(file) as data:
+            data = dict(data)
+        if int(data['version']) != _CHECKPOINT_VERSION:
+            raise ValueError('Unsupported file format version.')
+        if rng is None and 'rng_keys' in data:
+            rng = np.random.RandomState()
+            rng.set_state(('MT19937', data['rng_keys'],
+                           int(data['rng_pos']), int(data['rng_has_gauss']),
+                           float(data['rng_cached_gaussian'])))
+        rng = ensure_rng(rng)
+
+        self = cls.__new__(cls)
+        self.eps = float(data['eps'])
+        hamiltonian, blocksize = self._prepare(hamiltonian, params, operator,
+                                               vector_factory, rng)
+        self._set_scale(hamiltonian, blocksize, float(data['a']),
+                        float(data['b']))
+
+        moments = data['moments']
+        self.num_vectors, self.num_moments = moments.shape[:2]
+        self._moments_list = list(moments)
+        if 'vectors' in data:
+            if data['vectors'].shape[1] != hamiltonian.shape[0]:
+                raise ValueError('The Hamiltonian does not match the saved '
+                                 'vectors.')
+            self._rand_vect_list = list(data['vectors'])
+            self._last_two_alphas = [tuple(alphas)
+                                     for alphas in data['alphas']]
+        else:
+            self._rand_vect_list = [None] * self.num_vectors
+            self._last_two_alphas = [None] * self.num_vectors
+        self._update_densities()
+        return self
+
+    def merge(self, *others):
+        """Add the random vectors of other spectral densities.
+
+        The other spectral densities must have been computed for the same
+        Hamiltonian and operator, with the same number of moments and the
+        same rescaling of the Hamiltonian, for example by passing the same
+        ``bounds`` and ``eps``.  They should use different random vectors,
+        for example by using different seeds for ``rng``.  The moments are
+        averaged over all the random vectors.
+
+        Parameters
+        ----------
+        *others : `SpectralDensity` instances
+        """
+        for other in others:
+            if (other._a, other._b) != (self._a, self._b):
+                raise ValueError('The spectral densities must use the same '
+                                 'rescaling of the Hamiltonian; provide the '
+                                 'same bounds to all of them.')
+            if other.num_moments != self.num_moments:
+                raise ValueError('The spectral densities must have the same '
+                                 'number of moments.')
+            if np.shape(other._moments_list[0]) != \
+                    np.shape(self._moments_list[0]):
+                raise ValueError('The spectral densities must be computed '
+                                 'for the same operator.')
+        for other in others:
+            self._rand_vect_list.extend(other._rand_vect_list)
+            self._last_two_alphas.extend(other._last_two_alphas)
+            self._moments_list.extend(other._moments_list)
+            self.num_vectors += other.num_vectors
+        self._update_densities()
+
+    def _has_vectors(self):
+        """Return whether the states of all random vectors are known."""
+        return all(alphas is not None for alphas in self._last_two_alphas)
+
+    def _update_densities(self):
+        """Recalculate the quantities derived from the moments."""
         moments = self._moments()
         xk_rescaled, rho, self._gammas = _calc_fft_moments(
             moments, 2 * self.num_moments)
         self.energies = xk_rescaled * self._a + self._b
         self.densities = rho
+        samples = (rho for rho, _ in self._vector_spectra())
+        self.errors = _standard_error(samples, rho, self.num_vectors)
+
+    def _vector_spectra(self):
+        """Yield the densities and gammas of every random vector."""
+        for moments in self._moments_list:
+            moments = np.asarray(moments).real / self._a
+            yield _calc_fft_moments(moments, 2 * self.num_moments)[1:]
 
     def _moments(self):
         # sum moments of all random vectors
@@ -397,64 +625,521 @@ class SpectralDensity:
             if new_rand_vect != 0:
                 raise ValueError("Only 'num_moments' *or* 'num_vectors' "
                                  "may be updated at a time.")
-
-        for r in range(r_start, n_rand):
-            alpha_zero = self._rand_vect_list[r]
-
-            one_moment = [0.] * n_moments
-            if new_rand_vect > 0:
-                alpha = alpha_zero
-                alpha_next = self.hamiltonian.matvec(alpha)
-                if self.operator is None:
-                    one_moment[0] = np.vdot(alpha_zero, alpha_zero)
-                    one_moment[1] = np.vdot(alpha_zero, alpha_next)
-                else:
-                    one_moment[0] = self.operator(alpha_zero, alpha_zero)
-                    one_moment[1] = self.operator(alpha_zero, alpha_next)
-
-            if new_moments > 0:
-                (alpha, alpha_next) = self._last_two_alphas[r]
+            if not self._has_vectors():
+                raise ValueError('The random vectors have not been saved, '
+                                 'moments cannot be added.')
+
+        vectors = range(r_start, n_rand)
+        moments = [[0.] * n_moments for r in vectors]
+        alpha_zero = [self._rand_vect_list[r] for r in vectors]
+        if new_rand_vect > 0:
+            alpha = np.ascontiguousarray(np.transpose(alpha_zero))
+        else:
+            alpha = np.ascontiguousarray(np.transpose(
+                [self._last_two_alphas[r][0] for r in vectors]))
+            for one_moment, r in zip(moments, vectors):
                 one_moment[0:self.num_moments] = self._moments_list[r]
-            # Iteration over the moments
-            # Two cases can occur, depicted in Eq. (28) and in Eq. (29),
-            # respectively.
-            # ----
-            # In the first case, self.operator is None and we can use
-            # Eqs. (34) and (35) to obtain the density of states, with
-            # two moments ``one_moment`` for every new alpha.
-            # ----
-            # In the second case, the operator is not None and a matrix
-            # multiplication should be used.
+
+        matrix = self._chebyshev_matrix
+        dtype = np.result_type(matrix.dtype, alpha.dtype)
+        if matrix.dtype != dtype:
+            matrix = self._chebyshev_matrix = matrix.astype(dtype)
+        alpha = alpha.astype(dtype, copy=False)
+        alpha_next = np.zeros_like(alpha)
+        work = np.empty((min(_DOT_CHUNK, len(alpha)), len(vectors)), dtype)
+
+        if new_rand_vect > 0:
+            matrix.add_matmat(alpha, alpha_next)
+            alpha_next *= 0.5
             if self.operator is None:
-                for n in range(m_start//2, n_moments//2):
-                    alpha_save = alpha_next
-                    alpha_next = (2 * self.hamiltonian.matvec(alpha_next)
-                                  - alpha)
-                    alpha = alpha_save
-                    # Following Eqs. (34) and (35)
-                    one_moment[2*n] = (2 * np.vdot(alpha, alpha)
-                                       - one_moment[0])
-                    one_moment[2*n+1] = (2 * np.vdot(alpha_next, alpha)
-                                         - one_moment[1])
-                if n_moments % 2:
-                    # odd moment
-                    one_moment[n_moments - 1] = (
-                        2 * np.vdot(alpha_next, alpha_next) - one_moment[0])
-            else:
-                for n in range(m_start, n_moments):
-                    alpha_save = alpha_next
-                    alpha_next = (2 * self.hamiltonian.matvec(alpha_next)
-                                  - alpha)
-                    alpha = alpha_save
-                    one_moment[n] = self.operator(alpha_zero, alpha_next)
-
-            self._last_two_alphas[r] = (alpha, alpha_next)
-            self._moments_list[r] = one_moment[:]
+                zeroth = _column_dots(alpha, alpha, work)
+                first = _column_dots(alpha, alpha_next, work)
+                for i, one_moment in enumerate(moments):
+                    one_moment[0:2] = zeroth[i], first[i]
+        else:
+            alpha_next[...] = np.transpose(
+                [self._last_two_alphas[r][1] for r in vectors])
+        if new_rand_vect > 0 and self.operator is not None:
+            for i, one_moment in enumerate(moments):
+                one_moment[0] = self.operator(alpha_zero[i], alpha_zero[i])
+                one_moment[1] = self.operator(
+                    alpha_zero[i], np.ascontiguousarray(alpha_next[:, i]))
+
+        # Iteration over the moments
+        # Two cases can occur, depicted in Eq. (28) and in Eq. (29),
+        # respectively.
+        # ----
+        # In the first case, self.operator is None and we can use
+        # Eqs. (34) and (35) to obtain the density of states, with
+        # two moments ``one_moment`` for every new alpha.
+        # ----
+        # In the second case, the operator is not None and a matrix
+        # multiplication should be used.
+        # ----
+        # The step ``alpha_next = 2 * H @ alpha_next - alpha`` is done in
+        # place, in the memory of ``alpha``, and the two blocks are swapped
+        # afterwards.
+        if self.operator is None:
+            for n in range(m_start//2, n_moments//2):
+                alpha *= -1
+                matrix.add_matmat(alpha_next, alpha)
+                alpha, alpha_next = alpha_next, alpha
+                # Following Eqs. (34) and (35)
+                even = _column_dots(alpha, alpha, work)
+                odd = _column_dots(alpha_next, alpha, work)
+                for i, one_moment in enumerate(moments):
+                    one_moment[2*n] = 2 * even[i] - one_moment[0]
+                    one_moment[2*n+1] = 2 * odd[i] - one_moment[1]
+            if n_moments % 2:
+                # odd moment
+                last = _column_dots(alpha_next, alpha_next, work)
+                for i, one_moment in enumerate(moments):
+                    one_moment[n_moments - 1] = (2 * last[i]
+                                                 - one_moment[0])
+        else:
+            for n in range(m_start, n_moments):
+                alpha *= -1
+                matrix.add_matmat(alpha_next, alpha)
+                alpha, alpha_next = alpha_next, alpha
+                for i, one_moment in enumerate(moments):
+                    one_moment[n] = self.operator(
+                        alpha_zero[i], np.ascontiguousarray(alpha_next[:, i]))
+
+        for i, (one_moment, r) in enumerate(zip(moments, vectors)):
+            self._last_two_alphas[r] = (alpha[:, i].copy(),
+                                        alpha_next[:, i].copy())
+            self._moments_list[r] = one_moment
+
+
+class Correlator:
+    """Calculate the Kubo-Bastin correlation function of two operators.
+
+    This class makes use of the kernel polynomial method (KPM), as presented
+    in [1]_, to obtain the correlation function
+
+    .. math::
+       σ_{AB}(μ, T) = i \\int dE f(E) \\mathrm{Tr}\\left[A\\,δ(E-H)\\,B\\,
+           \\frac{dG^+(E)}{dE} - A\\,\\frac{dG^-(E)}{dE}\\,B\\,δ(E-H)\\right],
+
+    where :math:`f` is the Fermi function at chemical potential :math:`μ`
+    and temperature :math:`T`, and :math:`G^\\pm` are the retarded and
+    advanced Green's functions.  If :math:`A` and :math:`B` are velocity
+    operators, this is the Kubo-Bastin formula for the conductivity tensor,
+    in units where :math:`e = \\hbar = 1` and without dividing by the volume
+    of the system, see `conductivity`.
+
+    The correlation function is expanded in two-dimensional Chebyshev
+    moments
+
+    .. math::
+       μ_{mn} = \\mathrm{Tr}[A T_m(\\tilde{H}) B T_n(\\tilde{H})],
+
+    which are estimated stochastically with random vectors, as in [2]_.
+
+    Parameters
+    ----------
+    hamiltonian : `~kwant.system.FiniteSystem` or matrix Hamiltonian
+        If a system is passed, it should contain no leads.
+    operator1, operator2 : dense matrix, sparse matrix or local operator
+        The operators :math:`A` and :math:`B`. The identity is used if
+        an operator is not provided. Operators from `kwant.operator` are
+        assumed to be Hermitian.
+    params : dict, optional
+        Additional parameters to pass to the Hamiltonian and operators.
+    num_vectors : positive int, default: 10
+        Number of random vectors for the KPM method.
+    num_moments : positive int, default: 100
+        Number of moments in each of the two dimensions of the KPM
+        expansion. Mutually exclusive with 'energy_resolution'.
+    energy_resolution : positive float, optional
+        The resolution in energy of the KPM approximation. Mutually
+        exclusive with 'num_moments'.
+    vector_factory : function, optional
+        The user defined function ``f(n)`` generates random vectors of
+        length ``n`` that will be used in the algorithm.
+        If not provided, random phase vectors are used.
+    bounds : pair of floats, optional
+        Lower and upper bounds for the eigenvalue spectrum of the system.
+        If not provided, they are computed.
+    eps : positive float, default: 0.05
+        Parameter to ensure that the rescaled spectrum lies in the
+        interval ``(-1, 1)``; required for stability.
+    rng : seed, or random number generator, optional
+        Random number generator used by ``vector_factory``.
+        If not provided, numpy's rng will be used; if it is an Integer,
+        it will be used to seed numpy's rng, and if it is a random
+        number generator, this is the one used.
+    memory_budget : positive int, default: 2**30
+        The maximal number of bytes used for storing Chebyshev vectors.
+        The moments are computed in chunks that respect this limit; a
+        smaller budget requires more sparse matrix products.
+
+    Notes
+    -----
+    The moments are calculated for all random vectors at once.  For every
+    chunk of moments :math:`n` that fits into the memory budget, the vectors
+    :math:`B T_n(\\tilde{H})|r⟩` are stored while the vectors
+    :math:`T_m(\\tilde{H}) A^\\dagger|r⟩` are generated by the Chebyshev
+    recursion.  As with `SpectralDensity`, the moments can be refined with
+    `add_moments` and `add_vectors`, reusing the moments that have already
+    been computed.
+
+    .. [1] `Rev. Mod. Phys., Vol. 78, No. 1 (2006)
+       <https://arxiv.org/abs/cond-mat/0504627>`_.
+    .. [2] `Phys. Rev. Lett. 114, 116602 (2015)
+       <https://arxiv.org/abs/1410.8140>`_.
+
+    Attributes
+    ----------
+    energies : array of floats
+        Array of sampling points with length ``2 * num_moments`` in
+        the range of the spectrum, used for the energy integral.
+    """
+
+    def __init__(self, hamiltonian, operator1=None, operator2=None,
+                 params=None, num_vectors=10, num_moments=None,
+                 energy_resolution=None, vector_factory=None, bounds=None,
+                 eps=0.05, rng=None, memory_budget=2**30):
+
+        if num_moments and energy_resolution:
+            raise TypeError("either 'num_moments' or 'energy_resolution' "
+                            "must be provided.")
+        if eps <= 0:
+            raise ValueError('eps must be positive')
+        if memory_budget <= 0:
+            raise ValueError('memory_budget must be positive')
+
+        rng = ensure_rng(rng)
+        self.eps = eps
+        self.memory_budget = memory_budget
+
+        hamiltonian, blocksize = _normalize_hamiltonian(hamiltonian, params)
+        self._operator1 = _block_operator(operator1, params, adjoint=True)
+        self._operator2 = _block_operator(operator2, params)
+
+        self._vector_factory = vector_factory or \
+            (lambda n: np.exp(2j * np.pi * rng.random_sample(n)))
+        v0 = np.exp(2j * np.pi * rng.random_sample(hamiltonian.shape[0]))
+        self._rand_vect_list = []
+        _, (self._a, self._b) = _rescale(hamiltonian, eps=eps, v0=v0,
+                                         bounds=bounds)
+        self.bounds = (self._b - self._a, self._b + self._a)
+        # The operators make the vectors complex in general.
+        self._chebyshev_matrix = _chebyshev_matrix(
+            hamiltonian, self._a, self._b, blocksize).astype(complex)
+
+        if energy_resolution:
+            num_moments = math.ceil((1.6 * self._a) / energy_resolution)
+        elif num_moments is None:
+            num_moments = 100
+
+        must_be_positive_int = ['num_vectors', 'num_moments']
+        for var in must_be_positive_int:
+            val = locals()[var]
+            if val <= 0 or val != int(val):
+                raise ValueError('{} must be a positive integer'.format(var))
+
+        self.num_moments = num_moments
+        self.num_vectors = 0
+        # Only the sum of the moments over the random vectors is kept.
+        self._moment_sum = np.zeros((num_moments, num_moments), complex)
+        self.add_vectors(num_vectors)
+
+    def __call__(self, mu=0, temperature=0):
+        """Return the correlation function.
+
+        Parameters
+        ----------
+        mu : float or array of floats, default: 0
+            Chemical potential.
+        temperature : float, default: 0
+            Temperature of the Fermi distribution.
+
+        Returns
+        -------
+        float, or array of floats with the shape of ``mu``.
+        """
+        if temperature < 0:
+            raise ValueError('temperature must be non-negative')
+        mu = np.asarray(mu, dtype=float)
+        energies = self.energies.reshape((-1,) + (1,) * mu.ndim)
+        if temperature == 0:
+            occupation = (energies < mu) + 0.5 * (energies == mu)
+            surface = self._surface_density(mu)
+        else:
+            occupation = scipy.special.expit((mu - energies) / temperature)
+            surface = np.reshape([self._thermal_surface(m, temperature)
+                                  for m in mu.flat], mu.shape)
+        sea = np.tensordot(self._sea_weights, occupation, axes=1)
+        return (sea + surface)[()]
+
+    def add_moments(self, num_moments=None, *, energy_resolution=None):
+        """Increase the number of Chebyshev moments in both dimensions.
+
+        Parameters
+        ----------
+        num_moments: positive int
+            The number of Chebyshev moments to add. Mutually
+            exclusive with 'energy_resolution'.
+        energy_resolution: positive float, optional
+            Features wider than this resolution are resolved by the
+            expansion. Mutually exclusive with 'num_moments'.
+        """
+        if not ((num_moments is None) ^ (energy_resolution is None)):
+            raise TypeError("either 'num_moments' or 'energy_resolution' "
+                            "must be provided.")
+
+        if energy_resolution:
+            if energy_resolution <= 0:
+                raise ValueError("'energy_resolution' must be positive")
+            present_resolution = self._a * 1.6 / self.num_moments
+            if present_resolution < energy_resolution:
+                raise ValueError('Energy resolution is already smaller '
+                                 'than the requested resolution')
+            num_moments = (math.ceil((1.6 * self._a) / energy_resolution)
+                           - self.num_moments)
+
+        if (num_moments is None or num_moments <= 0
+            or num_moments != int(num_moments)):
+            raise ValueError("'num_moments' must be a positive integer")
+
+        old, new = self.num_moments, self.num_moments + num_moments
+        vectors = self._rand_vect_list
+        extended = np.empty((new, new), complex)
+        extended[:old, :old] = self._moment_sum
+        # The new moments are the two stripes m >= old and n >= old.
+        extended[:, old:] = self._moment_block(vectors, range(new),
+                                               range(old, new))
+        extended[old:, :old] = self._moment_block(vectors, range(old, new),
+                                                  range(old))
+        self._moment_sum = extended
+        self.num_moments = new
+        self._update_integrals()
+
+    def add_vectors(self, num_vectors):
+        """Increase the number of random vectors.
+
+        Parameters
+        ----------
+        num_vectors: positive int
+            The number of random vectors to add.
+        """
+        if num_vectors <= 0 or num_vectors != int(num_vectors):
+            raise ValueError("'num_vectors' must be a positive integer")
+        dim = self._chebyshev_matrix.shape[0]
+        vectors = [self._vector_factory(dim) for r in range(num_vectors)]
+        moments = range(self.num_moments)
+        self._moment_sum += self._moment_block(vectors, moments, moments)
+        self._rand_vect_list.extend(vectors)
+        self.num_vectors += num_vectors
+        self._update_integrals()
+
+    def _moments(self):
+        """Return the average of the moments over the random vectors."""
+        return self._moment_sum / self.num_vectors
+
+    def _moment_block(self, vectors, m_range, n_range):
+        """Return the moments ``μ_mn`` summed over 'vectors'.
+
+        Returns an array of shape ``(len(m_range), len(n_range))``.
+        'm_range' and 'n_range' are ranges with unit step.
+        """
+        matrix = self._chebyshev_matrix
+        block = np.ascontiguousarray(np.transpose(vectors), complex)
+        dim, num_vecs = block.shape
+        result = np.zeros((len(m_range), len(n_range)), complex)
+        if not len(m_range) or not len(n_range):
+            return result
+        bra_zero = self._operator1(block)
+        chunk = max(1, int(self.memory_budget // (16 * dim * num_vecs)))
+        stored = np.empty((min(chunk, len(n_range)), num_vecs, dim), complex)
+
+        kets = _chebyshev_blocks(matrix, block)
+        for n in range(n_range.start):
+            next(kets)
+        for start in range(n_range.start, n_range.stop, chunk):
+            stop = min(start + chunk, n_range.stop)
+            # Store the vectors ``B T_n(H) |r⟩`` of this chunk ...
+            for i in range(stop - start):
+                stored[i] = self._operator2(next(kets)).T
+            # ... and project them on ``T_m(H) A^† |r⟩``, summing over the
+            # random vectors.
+            kets_flat = stored[:stop - start].reshape(stop - start, -1)
+            bras = _chebyshev_blocks(matrix, bra_zero)
+            for m, bra in zip(range(m_range.stop), bras):
+                if m < m_range.start:
+                    continue
+                result[m - m_range.start,
+                       start - n_range.start:stop - n_range.start] = \
+                    np.dot(kets_flat, bra.T.conj().ravel())
+        return result
+
+    def _update_integrals(self):
+        """Compute the weights of the energy integrals of the moments.
+
+        The integrand of the Kubo-Bastin formula is split into a Fermi sea
+        term, that contains the real part of the derivative of the Green's
+        function, and a Fermi surface term, that is a total derivative.
+        In contrast to the integrand itself, both terms are free of the
+        ``1 / (1 - x**2)**2`` singularities of the truncated Chebyshev
+        expansion at the bounds of the rescaled spectrum.
+        """
+        num_moments = self.num_moments
+        num_points = 2 * num_moments
+        kernel = _jackson_kernel(num_moments)
+        self._kernel = kernel.copy()
+        self._kernel[1:] *= 2
+        moments = self._moments()
+
+        # Gauss-Chebyshev abscissas, in ascending order
+        k = np.arange(num_points)[::-1]
+        theta = np.pi * (k + 0.5) / num_points
+        x = np.cos(theta)
+        # Coefficients of the delta function and of the derivative of the
+        # real part of the Green's function, ``-2 U'_{n-1}(x)``.
+        delta = self._kernel * np.cos(np.outer(theta, np.arange(num_moments)))
+        green = np.zeros((num_points, num_moments))
+        u_prev, u, du_prev, du = 0, np.ones_like(x), 0, np.zeros_like(x)
+        for n in range(1, num_moments):
+            green[:, n] = -2 * kernel[n] * du
+            u_prev, u, du_prev, du = (u, 2 * x * u - u_prev, du,
+                                      2 * u + 2 * x * du - du_prev)
+        sea = (np.sum(np.dot(delta, moments) * green, axis=1)
+               - np.sum(np.dot(green, moments) * delta, axis=1))
+
+        self._moment_matrix = moments
+        self._sea_weights = -sea.imag / (num_points * self._a**2)
+        self.energies = x * self._a + self._b
+
+    def _surface_density(self, mu):
+        """Return the Fermi surface term at zero temperature."""
+        x = (mu - self._b) / self._a
+        inside = np.abs(x) < 1
+        x = np.where(inside, x, 0)
+        delta = self._kernel * np.cos(
+            np.multiply.outer(np.arccos(x), np.arange(self.num_moments)))
+        surface = np.sum(np.dot(delta, self._moment_matrix) * delta,
+                         axis=-1).real
+        return inside * surface / (np.pi * (1 - x**2) * self._a**2)
+
+    def _thermal_surface(self, mu, temperature):
+        """Return the Fermi surface term at finite temperature.
+
+        The surface density is integrated with the derivative of the Fermi
+        function by Gauss-Legendre quadrature in an energy window around
+        'mu', such that the result is accurate for any temperature.
+        """
+        # Bounds of the window, inside of the margin of the rescaled
+        # spectrum where the expansion of the surface density is singular.
+        margin = self._a * (1 - self.eps / 4)
+        lower = max(mu - _FERMI_CUTOFF * temperature, self._b - margin)
+        upper = min(mu + _FERMI_CUTOFF * temperature, self._b + margin)
+        if lower >= upper:
+            return 0.
+        # The points resolve the smaller of the resolution of the expansion
+        # and the width of the derivative of the Fermi function.
+        resolution = np.pi * self._a / (2 * self.num_moments)
+        num_points = 32 + math.ceil(2 * (upper - lower)
+                                    / min(resolution, temperature))
+        points, weights = np.polynomial.legendre.leggauss(num_points)
+        energies = lower + (upper - lower) * (points + 1) / 2
+        occupation = scipy.special.expit((mu - energies) / temperature)
+        derivative = occupation * (1 - occupation) / temperature
+        return ((upper - lower) / 2
+                * np.sum(weights * derivative
+                         * self._surface_density(energies)))
+
+
+def conductivity(hamiltonian, alpha='x', beta='x', positions=None,
+                 **kwargs):
+    """Return a `Correlator` for an element of the conductivity tensor.
+
+    The velocity operators :math:`v_α = i[H, x_α]` are constructed from the
+    Hamiltonian and the positions of its orbitals, and the Kubo-Bastin
+    conductivity :math:`σ_{αβ}` is computed by `Correlator`, in units where
+    :math:`e = \\hbar = 1`.  The result is not divided by the volume of the
+    system.
+
+    Parameters
+    ----------
+    hamiltonian : `~kwant.system.FiniteSystem` or matrix Hamiltonian
+        If a system is passed, it should contain no leads.
+    alpha, beta : 'x', 'y' or 'z'
+        The directions of the conductivity tensor element.
+    positions : array of shape ``(num_orbitals, dim)``, optional
+        The positions of the orbitals. Required if 'hamiltonian' is a
+        matrix. For a system, the positions of the sites are used.
+    **kwargs
+        Further arguments are passed to `Correlator`.
+
+    Returns
+    -------
+    correlator : `Correlator`
+        Call it with a chemical potential and temperature to obtain the
+        conductivity.
+    """
+    directions = {'x': 0, 'y': 1, 'z': 2}
+    for direction in (alpha, beta):
+        if direction not in directions:
+            raise ValueError("'alpha' and 'beta' must be one of 'x', 'y' "
+                             "or 'z'.")
+    params = kwargs.get('params')
+    if isinstance(hamiltonian, system.System):
+        matrix, norbs = hamiltonian.hamiltonian_submatrix(
+            params=params, sparse=True, return_norb=True)[:2]
+        if positions is None:
+            try:
+                site_positions = hamiltonian.sites.positions
+            except AttributeError:
+                site_positions = [hamiltonian.pos(i)
+                                  for i in range(hamiltonian.graph.num_nodes)]
+            positions = np.repeat(np.asarray(site_positions, float),
+                                  norbs, axis=0)
+    else:
+        if positions is None:
+            raise ValueError("'positions' must be provided if 'hamiltonian' "
+                             "is a matrix.")
+        matrix, _ = _normalize_hamiltonian(hamiltonian, params)
+
+    positions = np.asarray(positions, float)
+    if positions.ndim == 1:
+        positions = positions[:, None]
+    if positions.shape[0] != matrix.shape[0]:
+        raise ValueError("'positions' must have one row per orbital.")
+    operators = []
+    for direction in (alpha, beta):
+        index = directions[direction]
+        if index >= positions.shape[1]:
+            raise ValueError('The system has no direction {}.'
+                             .format(direction))
+        operators.append(_velocity(matrix, positions[:, index]))
+    return Correlator(hamiltonian, *operators, **kwargs)
 
 
 # ### Auxiliary functions
 
 
+def _normalize_hamiltonian(hamiltonian, params):
+    """Return a Hamiltonian as a CSR matrix, together with its block size.
+
+    The block size is the number of orbitals per site if 'hamiltonian' is a
+    Kwant system whose sites all have the same number of orbitals, and 1
+    otherwise.
+    """
+    blocksize = 1
+    if isinstance(hamiltonian, system.System):
+        blocksize = uniform_blocksize(
+            getattr(hamiltonian, 'site_ranges', None))
+        hamiltonian = hamiltonian.hamiltonian_submatrix(params=params,
+                                                        sparse=True)
+    try:
+        hamiltonian = scipy.sparse.csr_matrix(hamiltonian)
+    except Exception:
+        raise ValueError("'hamiltonian' is neither a matrix "
+                         "nor a Kwant system.")
+    return hamiltonian, blocksize
+
+
 def _rescale(hamiltonian, eps, v0, bounds):
     """Rescale a Hamiltonian and return a LinearOperator
 
@@ -479,9 +1164,12 @@ def _rescale(hamiltonian, eps, v0, bounds):
     if bounds:
         lmin, lmax = bounds
     else:
-        lmax = float(sla.eigsh(hamiltonian, k=1, which='LA',
+        operator = hamiltonian
+        if scipy.sparse.issparse(hamiltonian):
+            operator = SparseOperator(hamiltonian)
+        lmax = float(sla.eigsh(operator, k=1, which='LA',
                                return_eigenvectors=False, tol=tol, v0=v0))
-        lmin = float(sla.eigsh(hamiltonian, k=1, which='SA',
+        lmin = float(sla.eigsh(operator, k=1, which='SA',
                                return_eigenvectors=False, tol=tol, v0=v0))
 
     a = np.abs(lmax-lmin) / (2. - eps)
@@ -500,6 +1188,116 @@ def _rescale(hamiltonian, eps, v0, bounds):
     return rescaled_ham, (a, b)
 
 
+def _chebyshev_matrix(hamiltonian, a, b, blocksize=1):
+    """Return ``2 * (hamiltonian - b) / a`` as a `SparseOperator`."""
+    identity = scipy.sparse.identity(hamiltonian.shape[0], format='csr')
+    return SparseOperator((2 / a) * (hamiltonian - b * identity), blocksize)
+
+
+# The Fermi surface term is integrated over energies within this many
+# temperatures from the chemical potential.
+_FERMI_CUTOFF = 40
+
+# Version of the file format of `SpectralDensity.save`.
+_CHECKPOINT_VERSION = 1
+
+# Number of rows of the blocks of vectors that are processed at once by
+# `_column_dots`.
+_DOT_CHUNK = 4096
+
+
+def _column_dots(a, b, work):
+    """Return the dot products of the columns of 'a' and 'b'.
+
+    The columns of 'a' are complex conjugated.  'work' is an array with the
+    number of columns of 'a' and at most the number of rows of 'a'.
+    """
+    result = np.zeros(a.shape[1], work.dtype)
+    chunk = work.shape[0]
+    for i in range(0, a.shape[0], chunk):
+        w = work[:min(chunk, a.shape[0] - i)]
+        np.conjugate(a[i : i + chunk], out=w)
+        w *= b[i : i + chunk]
+        result += w.sum(axis=0)
+    return result
+
+
+def _chebyshev_blocks(matrix, block):
+    """Yield ``T_n(H) @ block`` for n = 0, 1, 2, ...
+
+    'matrix' is the `SparseOperator` returned by `_chebyshev_matrix`.  The
+    yielded arrays are reused by the following iterations.
+    """
+    alpha = np.array(block, matrix.dtype, order='C')
+    yield alpha
+    alpha_next = np.zeros_like(alpha)
+    matrix.add_matmat(alpha, alpha_next)
+    alpha_next *= 0.5
+    yield alpha_next
+    while True:
+        alpha *= -1
+        matrix.add_matmat(alpha_next, alpha)
+        alpha, alpha_next = alpha_next, alpha
+        yield alpha_next
+
+
+def _block_operator(operator, params, adjoint=False):
+    """Return a function that applies 'operator' to a block of vectors.
+
+    The vectors are the columns of the block.  If 'adjoint' is true, the
+    function applies the Hermitian conjugate of 'operator'.  Local operators
+    are assumed to be Hermitian.
+    """
+    if operator is None:
+        return lambda block: block.copy()
+    elif isinstance(operator, _LocalOperator):
+        operator = operator.bind(params=params)
+        return lambda block: np.column_stack(
+            [operator.act(np.ascontiguousarray(column))
+             for column in block.T])
+    elif hasattr(operator, 'dot'):
+        operator = scipy.sparse.csr_matrix(operator)
+        if adjoint:
+            operator = operator.T.conj().tocsr()
+        return lambda block: np.ascontiguousarray(operator.dot(block),
+                                                  complex)
+    else:
+        raise ValueError('Operator is neither a matrix nor a local '
+                         'operator.')
+
+
+def _velocity(hamiltonian, positions):
+    """Return the velocity operator ``i[H, x]`` as a sparse matrix.
+
+    'positions' are the coordinates of the orbitals along one direction.
+    """
+    hamiltonian = scipy.sparse.coo_matrix(hamiltonian)
+    row, col = hamiltonian.row, hamiltonian.col
+    data = 1j * (positions[row] - positions[col]) * hamiltonian.data
+    return scipy.sparse.csr_matrix((data, (row, col)),
+                                   shape=hamiltonian.shape)
+
+
+def _jackson_kernel(n_moments):
+    """Return the Jackson kernel coefficients for 'n_moments' moments."""
+    m = np.arange(n_moments)
+    return ((n_moments - m + 1) * np.cos(np.pi * m / (n_moments + 1)) +
+            np.sin(np.pi * m / (n_moments + 1)) /
+            np.tan(np.pi / (n_moments + 1))) / (n_moments + 1)
+
+
+def _standard_error(samples, mean, count):
+    """Return the standard error of the mean of 'count' samples.
+
+    The result has the shape of 'mean', and is NaN if there are fewer than
+    two samples.
+    """
+    if count < 2:
+        return np.full(np.shape(mean), np.nan)
+    squares = sum(np.abs(sample - mean)**2 for sample in samples)
+    return np.sqrt(squares / ((count - 1) * count))
+
+
 def _calc_fft_moments(moments, n_sampling):
     """This function takes the normalised moments and returns an array
     of points and an array of the evaluated function at those points.
@@ -511,10 +1309,7 @@ def _calc_fft_moments(moments, n_sampling):
 
     # Jackson kernel, as in Eq. (71), and kernel improved moments,
     # as in Eq. (81).
-    m = np.arange(n_moments)
-    kernel = ((n_moments - m + 1) * np.cos(np.pi * m / (n_moments + 1)) +
-              np.sin(np.pi * m / (n_moments + 1)) /
-              np.tan(np.pi / (n_moments + 1))) / (n_moments + 1)
+    kernel = _jackson_kernel(n_moments)
 
     # special points at the abscissas of Chebyshev integration
     k = np.arange(0, n_sampling)
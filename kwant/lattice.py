@@ -169,6 +169,17 @@ class Polyatomic:
         >>> syst = kwant.Builder()
         >>> syst[lat.shape(circle, (0, 0))] = 0
         >>> syst[lat.neighbors()] = 1
+
+        A shape that is wrapped in `~kwant.builder.Vectorized` is called with
+        an array of shape ``(N, dim)`` that contains the positions of many
+        sites at once, and must return a boolean array of length ``N``.  This
+        is much faster for large shapes:
+
+        >>> def circle(pos):
+        ...     x, y = pos.T
+        ...     return x**2 + y**2 < 100
+        ...
+        >>> syst[lat.shape(kwant.builder.Vectorized(circle), (0, 0))] = 0
         """
         def shape_sites(symmetry=None):
             Site = builder.Site
@@ -185,6 +196,10 @@ class Polyatomic:
             if dim != self._prim_vecs.shape[1]:
                 raise ValueError('Dimensionality of start position does not '
                                  'match the space dimensionality.')
+            if isinstance(function, builder.Vectorized):
+                yield from self._vectorized_shape_sites(function.function,
+                                                        start, symmetry)
+                return
             lats = self.sublattices
             deltas = list(self.voronoi)
 
@@ -224,6 +239,62 @@ class Polyatomic:
 
         return shape_sites
 
+    def _vectorized_shape_sites(self, function, start, symmetry):
+        """Flood-fill for `shape` with a vectorized shape function.
+
+        The flood-fill proceeds like the one for ordinary shape functions,
+        but treats all the sites of a step together as arrays of tags.  Sets
+        of tags are sorted arrays of tags packed into integer keys.
+        """
+        Site = builder.Site
+        lats = self.sublattices
+        lat_dim = len(self._prim_vecs)
+        deltas = np.array(self.voronoi, int).reshape(-1, lat_dim)
+        bits = 63 // max(lat_dim, 1)
+
+        def keys(tags):
+            return builder._pack_tags(tags, bits)
+
+        def unique(tags):
+            tag_keys, indices = np.unique(keys(tags), return_index=True)
+            return tags[indices], tag_keys
+
+        def inside(lat, tags):
+            fd_tags = symmetry._act_tags(-symmetry._which_tags(lat, tags),
+                                         lat, tags)
+            fd_tags, fd_keys = unique(fd_tags)
+            mask = np.asarray(function(lat.positions(fd_tags)), bool)
+            if mask.shape != (len(fd_tags),):
+                raise ValueError('A vectorized shape function must return a '
+                                 'boolean array with one entry per position.')
+            return fd_tags[mask], fd_keys[mask]
+
+        tags = np.array([lat.closest(start) for lat in lats], int)
+        tags = unique(tags.reshape(-1, lat_dim))[0]
+        sites = [inside(lat, tags)[0] for lat in lats]
+        if not any(len(lat_tags) for lat_tags in sites):
+            msg = 'No sites close to {0} are inside the desired shape.'
+            raise ValueError(msg.format(start))
+
+        old_keys = np.zeros(0, np.int64)
+        while any(len(lat_tags) for lat_tags in sites):
+            for lat, lat_tags in zip(lats, sites):
+                for tag in lat_tags.tolist():
+                    yield Site(lat, ta.array(tag), True)
+            tags, tag_keys = unique(np.concatenate(sites))
+            old_keys = np.union1d(old_keys, tag_keys)
+
+            new_tags = (tags[:, np.newaxis, :] + deltas).reshape(-1, lat_dim)
+            new_tags, new_keys = unique(new_tags)
+            new_tags = new_tags[~builder._in_sorted(old_keys, new_keys)]
+
+            sites = []
+            for lat in lats:
+                lat_tags, lat_keys = inside(lat, new_tags)
+                sites.append(lat_tags[~builder._in_sorted(old_keys,
+                                                          lat_keys)])
+            old_keys = tag_keys
+
     def wire(self, center, radius):
         """Return a key for all the lattice sites inside an infinite cylinder.
 
@@ -273,10 +344,11 @@ class Polyatomic:
 
             def wire_shape(pos):
                 rel_pos = pos - center
-                projection = rel_pos - direction * ta.dot(direction, rel_pos)
-                return sum(projection * projection) <= r_squared
+                projection = rel_pos - np.outer(
+                    np.sum(rel_pos * direction, axis=1), direction)
+                return np.sum(projection * projection, axis=1) <= r_squared
 
-            return self.shape(wire_shape, center)(sym)
+            return self.shape(builder.Vectorized(wire_shape), center)(sym)
 
         return wire_sites
 
@@ -461,7 +533,8 @@ class Monatomic(builder.SiteFamily, Polyatomic):
 
         # Precalculation of auxiliary arrays for real space calculations.
         self.reduced_vecs, self.transf = lll.lll(prim_vecs)
-        self.voronoi = ta.dot(lll.voronoi(self.reduced_vecs), self.transf)
+        self._voronoi_coords = lll.voronoi(self.reduced_vecs)
+        self.voronoi = ta.dot(self._voronoi_coords, self.transf)
 
         self.dim = dim
         self.lattice_dim = len(prim_vecs)
@@ -500,13 +573,62 @@ class Monatomic(builder.SiteFamily, Polyatomic):
     def closest(self, pos):
         """
         Find the lattice coordinates of the site closest to position ``pos``.
+
+        ``pos`` may also be a 2d array of positions, one per row.  Then a 2d
+        integer array with the tags of the closest sites is returned.
         """
-        return ta.array(self.n_closest(pos)[0])
+        pos = np.asarray(pos, float)
+        if pos.ndim not in (1, 2) or pos.shape[-1] != self.dim:
+            raise ValueError('Expecting a position or a 2d array of '
+                             'positions of dimension {0}.'.format(self.dim))
+        if pos.ndim == 1:
+            return ta.array(self._closest_tags(pos.reshape(1, -1))[0])
+        return self._closest_tags(pos)
+
+    def _closest_tags(self, pos):
+        # Round the coordinates in the reduced basis, and then move each point
+        # by Voronoi vectors while this brings it closer to its position.  A
+        # point that cannot be improved this way lies in the Voronoi cell of
+        # the position, i.e. it is the closest one.
+        reduced_vecs = np.array(self.reduced_vecs)
+        deltas = self._voronoi_coords
+        shifts = np.dot(deltas, reduced_vecs)
+        norms = np.sum(shifts**2, axis=1)
+        tol = 1e-12 * norms.min()
+        pos = pos - self.offset
+        coords = np.round(np.dot(pos, np.linalg.pinv(reduced_vecs)))
+        coords = coords.astype(int)
+        offsets = pos - np.dot(coords, reduced_vecs)
+        todo = np.arange(len(pos))
+        while len(todo):
+            gain = 2 * np.dot(offsets[todo], shifts.T) - norms
+            best = np.argmax(gain, axis=1)
+            improved = gain[np.arange(len(todo)), best] > tol
+            todo, best = todo[improved], best[improved]
+            coords[todo] += deltas[best]
+            offsets[todo] -= shifts[best]
+        return np.dot(coords, np.array(self.transf).T)
 
     def pos(self, tag):
         """Return the real-space position of the site with a given tag."""
         return ta.dot(tag, self._prim_vecs) + self.offset
 
+    def positions(self, tags):
+        """Return the real-space positions of the sites with given tags.
+
+        Parameters
+        ----------
+        tags : 2d array-like of integers
+            ``tags[i]`` is the tag of the i-th site.
+
+        Returns
+        -------
+        positions : 2d NumPy array of floats
+        """
+        tags = np.asarray(tags).reshape(-1, self.lattice_dim)
+        return (np.dot(tags, np.asarray(self._prim_vecs))
+                + np.asarray(self.offset))
+
 
 # The following class is designed such that it should avoid floating
 # point precision issues.
@@ -728,6 +850,16 @@ class TranslationalSymmetry(builder.Symmetry):
             return (builder.Site(a.family, a.tag + delta, True),
                     builder.Site(b.family, b.tag + delta2, True))
 
+    def _which_tags(self, family, tags):
+        det_x_inv_m_part, det_m = self._get_site_family_data(family)[-2:]
+        result = np.dot(tags, np.array(det_x_inv_m_part, int).T) // det_m
+        return -result if self.is_reversed else result
+
+    def _act_tags(self, elements, family, tags):
+        m_part = self._get_site_family_data(family)[0]
+        delta = np.dot(elements, np.array(m_part, int).T)
+        return tags - delta if self.is_reversed else tags + delta
+
     def reversed(self):
         """Return a reversed copy of the symmetry.
 
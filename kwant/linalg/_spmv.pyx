@@ -0,0 +1,125 @@
+# Copyright 2011-2017 Kwant authors.
+#
+# This file is part of Kwant.  It is subject to the license terms in the file
+# LICENSE.rst found in the top-level directory of this distribution and at
+# http://kwant-project.org/license.  A list of Kwant authors can be found in
+# the file AUTHORS.rst at the top-level directory of this distribution and at
+# http://kwant-project.org/authors.
+
+"""Multithreaded products of sparse matrices with dense vectors.
+
+The products are parallelized over the rows of the sparse matrix with
+OpenMP, if Kwant was compiled with OpenMP support.  Each row of the result is
+computed by a single thread, such that the result does not depend on the
+number of threads.
+"""
+
+__all__ = ['csr_add_matmat', 'bsr_add_matmat']
+
+from cython.parallel cimport prange
+
+ctypedef fused scalar:
+    double
+    double complex
+
+ctypedef fused index:
+    int
+    long long
+
+
+# The rows are computed by functions that take pointers, such that no
+# reference counting of memoryviews happens inside of the parallel loops.
+cdef inline void _csr_row(index i, const index *indptr, const index *indices,
+                          const scalar *data, const scalar *x, scalar *y,
+                          Py_ssize_t num_vecs) nogil:
+    cdef index jj
+    cdef Py_ssize_t r
+    cdef const scalar *x_row
+    cdef scalar *y_row = y + i * num_vecs
+    cdef scalar a
+    for jj in range(indptr[i], indptr[i + 1]):
+        x_row = x + indices[jj] * num_vecs
+        a = data[jj]
+        for r in range(num_vecs):
+            y_row[r] = y_row[r] + a * x_row[r]
+
+
+cdef inline void _bsr_row(index i, const index *indptr, const index *indices,
+                          const scalar *data, const scalar *x, scalar *y,
+                          Py_ssize_t num_vecs, Py_ssize_t rows,
+                          Py_ssize_t cols) nogil:
+    cdef index jj
+    cdef Py_ssize_t a, b, r
+    cdef const scalar *block
+    cdef const scalar *x_row
+    cdef scalar *y_row
+    cdef scalar v
+    for jj in range(indptr[i], indptr[i + 1]):
+        block = data + jj * rows * cols
+        for a in range(rows):
+            y_row = y + (i * rows + a) * num_vecs
+            for b in range(cols):
+                v = block[a * cols + b]
+                x_row = x + (indices[jj] * cols + b) * num_vecs
+                for r in range(num_vecs):
+                    y_row[r] = y_row[r] + v * x_row[r]
+
+
+def csr_add_matmat(const index[::1] indptr, const index[::1] indices,
+                   const scalar[::1] data, const scalar[:, ::1] x,
+                   scalar[:, ::1] y, int num_threads=0):
+    """Add the product of a CSR matrix and 'x' to 'y', in place.
+
+    'x' and 'y' are C-contiguous 2d arrays with one column per vector.  If
+    'num_threads' is not positive, the default number of OpenMP threads is
+    used.
+    """
+    cdef index i, num_rows = indptr.shape[0] - 1
+    cdef Py_ssize_t num_vecs = y.shape[1]
+    if x.shape[1] != num_vecs or y.shape[0] != num_rows:
+        raise ValueError('Shapes of matrix and vectors do not match.')
+    if num_rows == 0 or num_vecs == 0 or data.shape[0] == 0:
+        return
+    cdef const index *indptr_p = &indptr[0]
+    cdef const index *indices_p = &indices[0]
+    cdef const scalar *data_p = &data[0]
+    cdef const scalar *x_p = &x[0, 0]
+    cdef scalar *y_p = &y[0, 0]
+    if num_threads > 0:
+        for i in prange(num_rows, nogil=True, schedule='static',
+                        num_threads=num_threads):
+            _csr_row(i, indptr_p, indices_p, data_p, x_p, y_p, num_vecs)
+    else:
+        for i in prange(num_rows, nogil=True, schedule='static'):
+            _csr_row(i, indptr_p, indices_p, data_p, x_p, y_p, num_vecs)
+
+
+def bsr_add_matmat(const index[::1] indptr, const index[::1] indices,
+                   const scalar[:, :, ::1] data, const scalar[:, ::1] x,
+                   scalar[:, ::1] y, int num_threads=0):
+    """Add the product of a BSR matrix and 'x' to 'y', in place.
+
+    The parameters are the same as for `csr_add_matmat`, except that 'data'
+    holds the blocks of the matrix.
+    """
+    cdef index i, num_rows = indptr.shape[0] - 1
+    cdef Py_ssize_t num_vecs = y.shape[1]
+    cdef Py_ssize_t rows = data.shape[1], cols = data.shape[2]
+    if x.shape[1] != num_vecs or y.shape[0] != num_rows * rows:
+        raise ValueError('Shapes of matrix and vectors do not match.')
+    if num_rows == 0 or num_vecs == 0 or data.shape[0] == 0:
+        return
+    cdef const index *indptr_p = &indptr[0]
+    cdef const index *indices_p = &indices[0]
+    cdef const scalar *data_p = &data[0, 0, 0]
+    cdef const scalar *x_p = &x[0, 0]
+    cdef scalar *y_p = &y[0, 0]
+    if num_threads > 0:
+        for i in prange(num_rows, nogil=True, schedule='static',
+                        num_threads=num_threads):
+            _bsr_row(i, indptr_p, indices_p, data_p, x_p, y_p, num_vecs,
+                     rows, cols)
+    else:
+        for i in prange(num_rows, nogil=True, schedule='static'):
+            _bsr_row(i, indptr_p, indices_p, data_p, x_p, y_p, num_vecs,
+                     rows, cols)
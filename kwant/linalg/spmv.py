@@ -0,0 +1,128 @@
+# Copyright 2011-2017 Kwant authors.
+#
+# This file is part of Kwant.  It is subject to the license terms in the file
+# LICENSE.rst found in the top-level directory of this distribution and at
+# http://kwant-project.org/license.  A list of Kwant authors can be found in
+# the file AUTHORS.rst at the top-level directory of this distribution and at
+# http://kwant-project.org/authors.
+
+"""Multithreaded products of sparse matrices with dense vectors"""
+
+__all__ = ['SparseOperator', 'uniform_blocksize']
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg as sla
+from . import _spmv
+
+
+def uniform_blocksize(site_ranges):
+    """Return the number of orbitals per site if it is the same for all sites.
+
+    Parameters
+    ----------
+    site_ranges : sequence of triples of integers or ``None``
+        The site ranges of a system, see `~kwant.system.System`.
+
+    Returns
+    -------
+    blocksize : int
+        The common number of orbitals, or 1 if the sites have different
+        numbers of orbitals or if they are not known.
+    """
+    if site_ranges is None:
+        return 1
+    norbs = {norbs for first, norbs, offset in site_ranges[:-1]}
+    if len(norbs) == 1:
+        return max(norbs.pop(), 1)
+    return 1
+
+
+class SparseOperator(sla.LinearOperator):
+    """A sparse matrix with multithreaded products with dense vectors.
+
+    The products are computed row by row in parallel, if Kwant has been
+    compiled with OpenMP support.  The result does not depend on the number
+    of threads.
+
+    Parameters
+    ----------
+    matrix : sparse matrix or 2d array
+        The matrix.  It is converted to double or complex double precision.
+    blocksize : int, optional
+        If larger than one, the matrix is stored in the block sparse row
+        format with square blocks of this size.  This is most useful for
+        Hamiltonians of systems whose sites all have the same number of
+        orbitals, see `uniform_blocksize`.  Defaults to 1.
+    num_threads : int, optional
+        The number of threads.  By default the number of OpenMP threads is
+        used, which can be set by the environment variable
+        ``OMP_NUM_THREADS``.
+
+    Attributes
+    ----------
+    matrix : `scipy.sparse.csr_matrix` or `scipy.sparse.bsr_matrix`
+        The matrix, in the format in which it is used.
+    """
+
+    def __init__(self, matrix, blocksize=1, num_threads=None):
+        dtype = np.result_type(matrix.dtype, float)
+        if dtype != complex:
+            dtype = np.dtype(float)
+        if blocksize > 1 and matrix.shape[0] % blocksize == 0 and \
+                matrix.shape[1] % blocksize == 0:
+            matrix = scipy.sparse.bsr_matrix(matrix, dtype=dtype,
+                                             blocksize=(blocksize, blocksize))
+        else:
+            matrix = scipy.sparse.csr_matrix(matrix, dtype=dtype)
+        matrix.sort_indices()
+        if matrix.indices.dtype != matrix.indptr.dtype:
+            index_dtype = np.result_type(matrix.indices, matrix.indptr)
+            matrix.indices = matrix.indices.astype(index_dtype)
+            matrix.indptr = matrix.indptr.astype(index_dtype)
+        self.matrix = matrix
+        self.num_threads = num_threads or 0
+        super().__init__(dtype, matrix.shape)
+
+    def astype(self, dtype):
+        """Return a copy of the operator with another dtype."""
+        result = SparseOperator.__new__(SparseOperator)
+        result.matrix = self.matrix.astype(dtype)
+        result.num_threads = self.num_threads
+        sla.LinearOperator.__init__(result, result.matrix.dtype,
+                                    self.shape)
+        return result
+
+    def add_matmat(self, x, y):
+        """Add the product of the matrix and 'x' to 'y', in place.
+
+        Parameters
+        ----------
+        x, y : 2d arrays
+            C-contiguous arrays of the dtype of the operator, with one
+            column per vector.
+        """
+        if x.shape[0] != self.shape[1]:
+            raise ValueError('Shapes of matrix and vectors do not match.')
+        matrix = self.matrix
+        if matrix.format == 'bsr':
+            _spmv.bsr_add_matmat(matrix.indptr, matrix.indices, matrix.data,
+                                 x, y, self.num_threads)
+        else:
+            _spmv.csr_add_matmat(matrix.indptr, matrix.indices, matrix.data,
+                                 x, y, self.num_threads)
+
+    def _matmat(self, x):
+        dtype = np.result_type(self.dtype, x.dtype)
+        operator = self if dtype == self.dtype else self.astype(dtype)
+        x = np.ascontiguousarray(x, dtype)
+        y = np.zeros((self.shape[0], x.shape[1]), dtype)
+        operator.add_matmat(x, y)
+        return y
+
+    def _matvec(self, x):
+        return self._matmat(x.reshape(-1, 1)).reshape(-1)
+
+    def _adjoint(self):
+        return SparseOperator(self.matrix.T.conj(),
+                              num_threads=self.num_threads)
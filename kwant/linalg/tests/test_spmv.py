@@ -0,0 +1,76 @@
+# Copyright 2011-2017 Kwant authors.
+#
+# This file is part of Kwant.  It is subject to the license terms in the file
+# LICENSE.rst found in the top-level directory of this distribution and at
+# http://kwant-project.org/license.  A list of Kwant authors can be found in
+# the file AUTHORS.rst at the top-level directory of this distribution and at
+# http://kwant-project.org/authors.
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg as sla
+from pytest import raises
+
+import kwant
+from kwant.linalg.spmv import SparseOperator, uniform_blocksize
+
+
+def random_matrix(n, m, dtype, rng):
+    matrix = scipy.sparse.random(n, m, 0.2, random_state=rng).astype(dtype)
+    if dtype == complex:
+        matrix = matrix + 1j * scipy.sparse.random(n, m, 0.2,
+                                                   random_state=rng)
+    return matrix
+
+
+def test_products():
+    rng = np.random.RandomState(1)
+    for dtype in [float, complex]:
+        matrix = random_matrix(12, 12, dtype, rng)
+        x = rng.randn(12, 3)
+        for blocksize, fmt in [(1, 'csr'), (3, 'bsr'), (5, 'csr')]:
+            for num_threads in [None, 1, 3]:
+                op = SparseOperator(matrix, blocksize, num_threads)
+                assert op.matrix.format == fmt
+                assert op.dtype == dtype
+                expected = matrix.dot(x)
+                np.testing.assert_allclose(op.matmat(x), expected)
+                np.testing.assert_allclose(op.matvec(x[:, 0]),
+                                           expected[:, 0])
+                np.testing.assert_allclose(op.matmat(1j * x), 1j * expected)
+                np.testing.assert_allclose(op.H.matvec(x[:, 0]),
+                                           matrix.T.conj().dot(x[:, 0]))
+
+                # In place products are added to the output.
+                x_c = np.ascontiguousarray(x, dtype)
+                y = np.ones((12, 3), dtype)
+                op.add_matmat(x_c, y)
+                np.testing.assert_allclose(y, 1 + expected)
+                raises(ValueError, op.add_matmat, x_c[:5], y)
+                raises(ValueError, op.add_matmat, x_c, y[:, :2])
+
+    # The result does not depend on the number of threads.
+    matrix = random_matrix(500, 500, complex, rng)
+    x = rng.randn(500, 4) + 0j
+    results = [SparseOperator(matrix, num_threads=n).matmat(x)
+               for n in [1, 2, 7]]
+    assert all(np.array_equal(results[0], r) for r in results[1:])
+
+    # Usable by iterative solvers.
+    matrix = matrix + matrix.T.conj()
+    assert np.allclose(
+        sla.eigsh(SparseOperator(matrix), k=2, return_eigenvectors=False),
+        sla.eigsh(matrix, k=2, return_eigenvectors=False))
+
+
+def test_uniform_blocksize():
+    assert uniform_blocksize(None) == 1
+    for norbs, expected in [((2, 2), 2), ((2, 3), 1), ((1, 1), 1)]:
+        lat = kwant.lattice.general([(1, 0), (0, 1)], [(0, 0), (0.5, 0.5)],
+                                    norbs=norbs)
+        syst = kwant.Builder()
+        syst[(sl(i, j) for sl in lat.sublattices
+              for i in range(2) for j in range(2))] = (
+            lambda site: np.identity(site.family.norbs))
+        fsyst = syst.finalized()
+        assert uniform_blocksize(fsyst.site_ranges) == expected
@@ -201,7 +201,38 @@ class StabilizedModes:
 
 
 # Auxiliary functions that perform different parts of the calculation.
-def setup_linsys(h_cell, h_hop, tol=1e6, stabilization=None):
+
+def _block_hopping(hop, projector):
+    """Project the square hopping matrix `hop` onto a conservation law block.
+    """
+    # We need the extra transposes to ensure that sparse dot is used.
+    return (projector.T.dot((projector.T.conj().dot(hop)).T)).T
+
+
+def hopping_svds(h_hop, projectors=None):
+    """Return the singular value decompositions of the hopping `h_hop`.
+
+    There is one decomposition for each of the `projectors` (or a single one
+    if there are no projectors) of the block of `h_hop` selected by the
+    projector.  In an energy sweep only the cell Hamiltonian of a lead
+    changes, so the result may be passed to `modes` for all the energies.
+    """
+    def svd(block):
+        # Like `setup_linsys`, stay in real arithmetics when possible.
+        if not np.any(block.imag):
+            block = block.real
+        return la.svd(block)
+
+    n, m = h_hop.shape
+    hop = np.zeros((n, n), dtype=h_hop.dtype)
+    hop[:, :m] = h_hop
+    if projectors is None:
+        return [svd(hop)]
+    return [svd(_block_hopping(hop, projector)) for projector in projectors]
+
+
+def setup_linsys(h_cell, h_hop, tol=1e6, stabilization=None, *,
+                 hop_svd=None):
     """Make an eigenvalue problem for eigenvectors of translation operator.
 
     Parameters
@@ -225,6 +256,9 @@ def setup_linsys(h_cell, h_hop, tol=1e6, stabilization=None):
         Kwant to solve a generalized eigenvalue problem, and not to reduce it
         to the regular one.  If it is `False`, reduction to a regular problem
         is performed if possible.
+    hop_svd : tuple of 3 numpy arrays or None
+        The singular value decomposition ``(u, s, vh)`` of `h_hop`, as
+        returned by `scipy.linalg.svd`.  It is computed if not given.
 
     Returns
     -------
@@ -262,7 +296,9 @@ def setup_linsys(h_cell, h_hop, tol=1e6, stabilization=None):
     # (Close to zero is defined here as |x| < eps * tol * s[0] , where
     # s[0] is the largest singular value.)
 
-    u, s, vh = la.svd(h_hop)
+    if hop_svd is None:
+        hop_svd = la.svd(h_hop)
+    u, s, vh = hop_svd
     assert m == vh.shape[1], "Corrupt output of svd."
     n_nonsing = np.sum(s > eps * s[0])
 
@@ -273,7 +309,8 @@ def setup_linsys(h_cell, h_hop, tol=1e6, stabilization=None):
         A = h_hop / h_hop_sqrt
         B = h_hop_sqrt
         B_H_inv = 1.0 / B     # just a real scalar here
-        A_inv = la.inv(A)
+        # Invert A using the singular value decomposition of the hopping.
+        A_inv = h_hop_sqrt * dot(vh.T.conj() / s, u.T.conj())
 
         lhs = np.zeros((2*n, 2*n), dtype=np.common_type(h_cell, h_hop))
         lhs[:n, :n] = -dot(A_inv, h_cell) * B_H_inv
@@ -875,12 +912,13 @@ def make_proper_modes(lmbdainv, psi, extract, tol, particle_hole,
 
 
 def compute_block_modes(h_cell, h_hop, tol, stabilization,
-                        time_reversal, particle_hole, chiral):
+                        time_reversal, particle_hole, chiral, hop_svd=None):
     """Calculate modes corresponding to a single projector. """
     n, m = h_hop.shape
 
     # Defer most of the calculation to helper routines.
-    matrices, v, extract = setup_linsys(h_cell, h_hop, tol, stabilization)
+    matrices, v, extract = setup_linsys(h_cell, h_hop, tol, stabilization,
+                                        hop_svd=hop_svd)
     ev, evanselect, propselect, vec_gen, ord_schur = unified_eigenproblem(
         *(matrices + (tol,)))
 
@@ -990,7 +1028,7 @@ def transform_modes(modes_data, unitary=None, time_reversal=None,
 
 def modes(h_cell, h_hop, tol=1e6, stabilization=None, *,
           discrete_symmetry=None, projectors=None, time_reversal=None,
-          particle_hole=None, chiral=None):
+          particle_hole=None, chiral=None, hop_svds=None):
     """Compute the eigendecomposition of a translation operator of a lead.
 
     Parameters
@@ -1025,6 +1063,11 @@ def modes(h_cell, h_hop, tol=1e6, stabilization=None, *,
     projectors : an iterable of sparse or dense matrices
         Projectors that block diagonalize the Hamiltonian in accordance
         with a conservation law.
+    hop_svds : list of tuples or None
+        The singular value decompositions of the blocks of `h_hop`, as
+        returned by ``hopping_svds(h_hop, projectors)``.  They do not depend
+        on `h_cell`, and may be reused when computing the modes for many
+        energies.  They are computed if not given.
 
     Returns
     -------
@@ -1122,8 +1165,9 @@ def modes(h_cell, h_hop, tol=1e6, stabilization=None, *,
             if block_modes[i] is not None:
                 continue
             # We did not compute this block yet.
-            block_modes[i] = compute_block_modes(h, t, tol, stabilization,
-                                                 *symmetries)
+            block_modes[i] = compute_block_modes(
+                h, t, tol, stabilization, *symmetries,
+                hop_svd=None if hop_svds is None else hop_svds[i])
         else:
             if block_modes[j] is not None:
                 # Modes in the block already computed.
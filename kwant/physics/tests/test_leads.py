@@ -372,6 +372,35 @@ def test_for_all_evs_equal():
     assert modes.nmodes == 1
 
 
+def test_hopping_svds():
+    rng = ensure_rng(7)
+    n = 6
+    h_cell = rng.randn(n, n) + 1j * rng.randn(n, n)
+    h_cell += h_cell.T.conj()
+    h_hop = rng.randn(n, n) + 1j * rng.randn(n, n)
+    # Two uncoupled copies with a conservation law, and a hopping that
+    # is not square.
+    h_cell = la.block_diag(h_cell, h_cell + np.eye(n))
+    h_hop = la.block_diag(h_hop, 0.5 * h_hop)[:, :-1]
+    identity = sparse.identity(2 * n, format='csr')
+    projectors = [identity[:, :n], identity[:, n:]]
+
+    for projs in [None, projectors]:
+        svds = leads.hopping_svds(h_hop, projs)
+        assert len(svds) == (1 if projs is None else 2)
+        # Reusing the decompositions in an energy sweep does not change the
+        # modes.
+        for energy in (0.1, 0.2, 0.3):
+            ham = h_cell - energy * np.eye(2 * n)
+            prop, stab = leads.modes(ham, h_hop, projectors=projs,
+                                     hop_svds=svds)
+            prop_fresh, stab_fresh = leads.modes(ham, h_hop,
+                                                 projectors=projs)
+            assert_almost_equal(prop.velocities, prop_fresh.velocities)
+            assert_almost_equal(prop.momenta, prop_fresh.momenta)
+            assert_almost_equal(stab.selfenergy(), stab_fresh.selfenergy())
+
+
 def test_dtype_linsys():
     """Test that setup_linsys stays in real arithmetics when possible."""
     h_cell = np.array([[2.0, -1.0], [-1.0, 2.0]], dtype=np.float64)
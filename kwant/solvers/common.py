@@ -6,14 +6,21 @@
 # the file AUTHORS.rst at the top-level directory of this distribution and at
 # http://kwant-project.org/authors.
 
-__all__ = ['SparseSolver', 'SMatrix', 'GreensFunction']
+__all__ = ['SparseSolver', 'SMatrix', 'GreensFunction', 'BatchResult',
+           'EnsembleResult', 'PerturbationSolver']
 
 from collections import namedtuple
-from itertools import product
+from collections.abc import Mapping
+from itertools import product, chain
 import abc
+import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from functools import partial
 from  numbers import Integral
 import numpy as np
 import scipy.sparse as sp
+from scipy.sparse import csgraph
 from .._common import ensure_isinstance
 from .. import system
 from functools import reduce
@@ -33,6 +40,44 @@ from functools import reduce
 LinearSys = namedtuple('LinearSys', ['lhs', 'rhs', 'indices', 'num_orb'])
 
 
+def _available_memory():
+    """Return the physical memory that is available in bytes, or None."""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _check_leads(syst, out_leads, in_leads):
+    n = len(syst.lead_interfaces)
+    if in_leads is None:
+        in_leads = list(range(n))
+    else:
+        in_leads = list(in_leads)
+    if out_leads is None:
+        out_leads = list(range(n))
+    else:
+        out_leads = list(out_leads)
+    if (np.any(np.diff(in_leads) <= 0) or np.any(np.diff(out_leads) <= 0)):
+        raise ValueError("Lead lists must be sorted and "
+                         "with unique entries.")
+    if len(in_leads) == 0 or len(out_leads) == 0:
+        raise ValueError("No output is requested.")
+    return out_leads, in_leads
+
+
+def _check_ldos_applicable(syst, check_hermiticity):
+    if not check_hermiticity:
+        raise NotImplementedError("ldos for non-Hermitian Hamiltonians "
+                                  "is not implemented yet.")
+
+    for lead in syst.leads:
+        if not hasattr(lead, 'modes') and hasattr(lead, 'selfenergy'):
+            # TODO: fix this
+            raise NotImplementedError("ldos for leads with only "
+                                      "self-energy is not implemented yet.")
+
+
 class SparseSolver(metaclass=abc.ABCMeta):
     """Solver class for computing physical quantities based on solving
     a liner system of equations.
@@ -55,8 +100,27 @@ class SparseSolver(metaclass=abc.ABCMeta):
       kept_vars covers all entries in the solution). This should be not too big
       too avoid excessive memory usage, but for some solvers not too small for
       performance reasons.
+
+    The attribute `memory_budget` limits the memory in bytes that is used for
+    the solutions of the linear system when `ldos` and `WaveFunction.chunks`
+    process them chunk by chunk.  The width of the chunks is then adapted to
+    the size of the linear system and to the memory that is available.  If
+    the budget is infinite, which is the default, the chunks are `nrhs`
+    columns wide.
+
+    If the attribute `eliminate_interior` is set to ``True``, `smatrix` and
+    `greens_function` first eliminate the degrees of freedom of the scattering
+    region that are not coupled to the leads by computing a Schur complement
+    (see `_schur_complement`).  The remaining linear system, which only
+    involves the interface of the scattering region and the lead modes, is
+    then solved with dense linear algebra.  The elimination is reused as long
+    as the Hamiltonian of the interior of the scattering region stays the
+    same, for example if only parameters of the leads change.
     """
 
+    eliminate_interior = False
+    memory_budget = float('inf')
+
     @abc.abstractmethod
     def _factorized(self, a):
         """
@@ -96,6 +160,143 @@ class SparseSolver(metaclass=abc.ABCMeta):
         """
         pass
 
+    def _chunk_width(self, num_vars, dtype=complex):
+        """Return the number of columns that are solved for at once.
+
+        Parameters
+        ----------
+        num_vars : int
+            The number of variables of the linear system.
+        dtype : numpy dtype
+            The type of the solution.
+        """
+        budget = self.memory_budget
+        if budget == float('inf'):
+            return self.nrhs
+        available = _available_memory()
+        if available is not None:
+            budget = min(budget, available)
+        # Besides the kept part of the solution, the dense right hand side
+        # and the full solution of a chunk are held in memory at once.
+        column_bytes = 3 * np.dtype(dtype).itemsize * num_vars
+        return max(1, int(budget // column_bytes))
+
+    def _solve_chunks(self, factorized_a, b, kept_vars):
+        """Solve the linar system `a x = b` in chunks of columns of `b`.
+
+        This is a generator that yields the part of the solution indicated in
+        `kept_vars` for one chunk after the other.  The width of the chunks
+        is given by `_chunk_width`.  The arguments are the same as for
+        `_solve_linear_sys`.
+        """
+        width = self._chunk_width(b.shape[0])
+        for j in range(0, b.shape[1], width):
+            yield self._solve_linear_sys(
+                factorized_a, b[:, j:min(j + width, b.shape[1])], kept_vars)
+
+    def _schur_complement(self, a, indices, groups=()):
+        """Return the Schur complement of a matrix as a dense array.
+
+        Parameters
+        ----------
+        a : sparse matrix
+            Square matrix.
+        indices : 1d array of integers
+            Indices (row and column) of the Schur complement block.
+        groups : sequence of 1d arrays of integers
+            Subsets of `indices` that belong together, namely the orbitals
+            attached to the same lead.  Solvers may use them to order the
+            elimination of the other indices.
+
+        Returns
+        -------
+        s : NumPy array
+            The Schur complement ``a[b, b] - a[b, i] a[i, i]^-1 a[i, b]``,
+            where ``b`` are the `indices` and ``i`` all the other indices.
+        """
+        a = a.tocsr()
+        interior = np.ones(a.shape[0], bool)
+        interior[indices] = False
+        interior = np.flatnonzero(interior)
+        a_ii = a[interior][:, interior]
+        a_ib = a[interior][:, indices]
+        a_bi = a[indices][:, interior]
+        s = a[indices][:, indices].toarray()
+        if not len(interior):
+            return s
+        factorized = self._factorized(getattr(a_ii, 'to' + self.lhsformat)())
+        x = self._solve_linear_sys(factorized,
+                                   getattr(a_ib, 'to' + self.rhsformat)(),
+                                   slice(None))
+        return s - a_bi.dot(x)
+
+    def _solve_scattering(self, linsys, rhs, kept_vars):
+        """Solve a scattering problem, returning the variables `kept_vars`.
+
+        If `eliminate_interior` is set, the interior of the scattering region
+        is eliminated first, otherwise the full linear system is factorized.
+        """
+        if not self.eliminate_interior:
+            flhs = self._factorized(linsys.lhs)
+            return self._solve_linear_sys(flhs, rhs, kept_vars)
+
+        lhs = linsys.lhs.tocsr()
+        rhs = sp.csr_matrix(rhs)
+        num_orb = linsys.num_orb
+        kept_vars = np.asarray(kept_vars)
+
+        # The interface consists of the orbitals of the scattering region that
+        # are coupled to the leads, appear in the right hand side, or are part
+        # of the solution.
+        interface = np.zeros(num_orb, bool)
+        to_leads = lhs[:num_orb, num_orb:]
+        from_leads = lhs[num_orb:, :num_orb]
+        interface[np.diff(to_leads.indptr) > 0] = True
+        interface[from_leads.indices] = True
+        interface[np.diff(rhs[:num_orb].indptr) > 0] = True
+        for indices in linsys.indices + [kept_vars]:
+            indices = np.asarray(indices)
+            interface[indices[indices < num_orb]] = True
+        interface_idx = np.flatnonzero(interface)
+
+        # The orbitals attached to each lead.  The variables of different
+        # leads are not coupled to each other.
+        num_leads, which = csgraph.connected_components(
+            abs(lhs[num_orb:, num_orb:]))
+        groups = [np.union1d(np.flatnonzero(to_leads[:, which == i].getnnz(1)),
+                             from_leads[which == i].indices)
+                  for i in range(num_leads)]
+
+        # The elimination of the interior only depends on the matrix elements
+        # that involve interior orbitals.
+        ham = lhs[:num_orb, :num_orb].tocoo()
+        keep = ~(interface[ham.row] & interface[ham.col])
+        ham = sp.coo_matrix((ham.data[keep], (ham.row[keep], ham.col[keep])),
+                            shape=ham.shape)
+        key = (interface_idx, ham.row, ham.col, ham.data)
+        cached = getattr(self, '_interior_elimination', None)
+        if (cached is not None and len(cached[0]) == len(key[0]) and
+            len(cached[1]) == len(key[1]) and
+            all(np.array_equal(x, y) for x, y in zip(cached, key))):
+            correction = cached[-1]
+        else:
+            # With vanishing interface block, the Schur complement is minus
+            # the correction due to the interior.
+            correction = -self._schur_complement(ham, interface_idx, groups)
+            self._interior_elimination = key + (correction,)
+
+        variables = np.r_[interface_idx, np.arange(num_orb, lhs.shape[0])]
+        reduced_lhs = lhs[variables][:, variables].toarray()
+        reduced_lhs = reduced_lhs.astype(np.common_type(reduced_lhs,
+                                                        correction))
+        num_interface = len(interface_idx)
+        reduced_lhs[:num_interface, :num_interface] -= correction
+        solution = np.linalg.solve(reduced_lhs,
+                                   rhs[variables].toarray())
+        position = np.empty(lhs.shape[0], int)
+        position[variables] = np.arange(len(variables))
+        return solution[position[kept_vars]]
+
     def _make_linear_sys(self, sys, in_leads, energy=0, args=(),
                          check_hermiticity=True, realspace=False,
                          *, params=None):
@@ -159,11 +360,17 @@ class SparseSolver(metaclass=abc.ABCMeta):
 
         if not syst.lead_interfaces:
             raise ValueError('System contains no leads.')
-        lhs, norb = syst.hamiltonian_submatrix(args, sparse=True,
-                                               return_norb=True,
-                                               params=params)[:2]
-        lhs = getattr(lhs, 'to' + self.lhsformat)()
-        lhs = lhs - energy * sp.identity(lhs.shape[0], format=self.lhsformat)
+        if isinstance(syst, system.FiniteSystem):
+            lhs, norb = syst._hamiltonian_csc(args, params=params,
+                                              energy=energy)
+            lhs = getattr(lhs, 'to' + self.lhsformat)()
+        else:
+            lhs, norb = syst.hamiltonian_submatrix(args, sparse=True,
+                                                   return_norb=True,
+                                                   params=params)[:2]
+            lhs = getattr(lhs, 'to' + self.lhsformat)()
+            lhs = lhs - energy * sp.identity(lhs.shape[0],
+                                             format=self.lhsformat)
         num_orb = lhs.shape[0]
 
         if check_hermiticity and len(lhs.data):
@@ -351,22 +558,12 @@ class SparseSolver(metaclass=abc.ABCMeta):
 
         syst = sys  # ensure consistent naming across function bodies
         ensure_isinstance(syst, system.System)
+        out_leads, in_leads = _check_leads(syst, out_leads, in_leads)
+        return self._smatrix(syst, energy, args, out_leads, in_leads,
+                             check_hermiticity, check_hermiticity, params)
 
-        n = len(syst.lead_interfaces)
-        if in_leads is None:
-            in_leads = list(range(n))
-        else:
-            in_leads = list(in_leads)
-        if out_leads is None:
-            out_leads = list(range(n))
-        else:
-            out_leads = list(out_leads)
-        if (np.any(np.diff(in_leads) <= 0) or np.any(np.diff(out_leads) <= 0)):
-            raise ValueError("Lead lists must be sorted and "
-                             "with unique entries.")
-        if len(in_leads) == 0 or len(out_leads) == 0:
-            raise ValueError("No output is requested.")
-
+    def _smatrix(self, syst, energy, args, out_leads, in_leads,
+                 check_hermiticity, current_conserving, params):
         linsys, lead_info = self._make_linear_sys(syst, in_leads, energy, args,
                                                   check_hermiticity, False,
                                                   params=params)
@@ -380,15 +577,14 @@ class SparseSolver(metaclass=abc.ABCMeta):
         len_kv = len(kept_vars)
         if not(len_rhs and len_kv):
             return SMatrix(np.zeros((len_kv, len_rhs)), lead_info,
-                           out_leads, in_leads, check_hermiticity)
+                           out_leads, in_leads, current_conserving)
 
         # See comment about zero-shaped sparse matrices at the top of common.py.
         rhs = sp.bmat([[i for i in linsys.rhs if i.shape[1]]],
                       format=self.rhsformat)
-        flhs = self._factorized(linsys.lhs)
-        data = self._solve_linear_sys(flhs, rhs, kept_vars)
+        data = self._solve_scattering(linsys, rhs, kept_vars)
 
-        return SMatrix(data, lead_info, out_leads, in_leads, check_hermiticity)
+        return SMatrix(data, lead_info, out_leads, in_leads, current_conserving)
 
     def greens_function(self, sys, energy=0, args=(),
                         out_leads=None, in_leads=None, check_hermiticity=True,
@@ -448,22 +644,13 @@ class SparseSolver(metaclass=abc.ABCMeta):
 
         syst = sys  # ensure consistent naming across function bodies
         ensure_isinstance(syst, system.System)
+        out_leads, in_leads = _check_leads(syst, out_leads, in_leads)
+        return self._greens_function(syst, energy, args, out_leads, in_leads,
+                                     check_hermiticity, check_hermiticity,
+                                     params)
 
-        n = len(syst.lead_interfaces)
-        if in_leads is None:
-            in_leads = list(range(n))
-        else:
-            in_leads = list(in_leads)
-        if out_leads is None:
-            out_leads = list(range(n))
-        else:
-            out_leads = list(out_leads)
-        if (np.any(np.diff(in_leads) <= 0) or np.any(np.diff(out_leads) <= 0)):
-            raise ValueError("Lead lists must be sorted and "
-                             "with unique entries.")
-        if len(in_leads) == 0 or len(out_leads) == 0:
-            raise ValueError("No output is requested.")
-
+    def _greens_function(self, syst, energy, args, out_leads, in_leads,
+                         check_hermiticity, current_conserving, params):
         linsys, lead_info = self._make_linear_sys(syst, in_leads, energy, args,
                                                   check_hermiticity, True,
                                                   params=params)
@@ -477,16 +664,15 @@ class SparseSolver(metaclass=abc.ABCMeta):
         len_kv = len(kept_vars)
         if not(len_rhs and len_kv):
             return GreensFunction(np.zeros((len_kv, len_rhs)), lead_info,
-                                  out_leads, in_leads, check_hermiticity)
+                                  out_leads, in_leads, current_conserving)
 
         # See comment about zero-shaped sparse matrices at the top of common.py.
         rhs = sp.bmat([[i for i in linsys.rhs if i.shape[1]]],
                       format=self.rhsformat)
-        flhs = self._factorized(linsys.lhs)
-        data = self._solve_linear_sys(flhs, rhs, kept_vars)
+        data = self._solve_scattering(linsys, rhs, kept_vars)
 
         return GreensFunction(data, lead_info, out_leads, in_leads,
-                              check_hermiticity)
+                              current_conserving)
 
     def ldos(self, sys, energy=0, args=(), check_hermiticity=True,
              *, params=None):
@@ -520,16 +706,10 @@ class SparseSolver(metaclass=abc.ABCMeta):
 
         syst = sys  # ensure consistent naming across function bodies
         ensure_isinstance(syst, system.System)
-        if not check_hermiticity:
-            raise NotImplementedError("ldos for non-Hermitian Hamiltonians "
-                                      "is not implemented yet.")
-
-        for lead in syst.leads:
-            if not hasattr(lead, 'modes') and hasattr(lead, 'selfenergy'):
-                # TODO: fix this
-                raise NotImplementedError("ldos for leads with only "
-                                          "self-energy is not implemented yet.")
+        _check_ldos_applicable(syst, check_hermiticity)
+        return self._ldos(syst, energy, args, check_hermiticity, params)
 
+    def _ldos(self, syst, energy, args, check_hermiticity, params):
         linsys = self._make_linear_sys(syst, range(len(syst.leads)), energy,
                                        args, check_hermiticity,
                                        params=params)[0]
@@ -545,10 +725,7 @@ class SparseSolver(metaclass=abc.ABCMeta):
         # See comment about zero-shaped sparse matrices at the top of common.py.
         rhs = sp.bmat([[i for i in linsys.rhs if i.shape[1]]],
                       format=self.rhsformat)
-        for j in range(0, rhs.shape[1], self.nrhs):
-            jend = min(j + self.nrhs, rhs.shape[1])
-            psi = self._solve_linear_sys(factored, rhs[:, j:jend],
-                                         slice(linsys.num_orb))
+        for psi in self._solve_chunks(factored, rhs, slice(linsys.num_orb)):
             ldos += np.sum(np.square(abs(psi)), axis=1)
 
         return ldos * (0.5 / np.pi)
@@ -596,6 +773,10 @@ class SparseSolver(metaclass=abc.ABCMeta):
         scattering region) have *negative* velocity with respect to the
         lead's symmetry direction.
 
+        For leads with very many modes, the wave functions can be computed in
+        chunks of modes that are limited in size by the memory budget of the
+        solver, by iterating over ``wf.chunks(lead)``.
+
         Examples
         --------
         >>> wf = kwant.solvers.default.wave_function(some_syst, some_energy)
@@ -604,6 +785,455 @@ class SparseSolver(metaclass=abc.ABCMeta):
         """
         return WaveFunction(self, sys, energy, args, check_hermiticity, params)
 
+    def perturbation_solver(self, sys, energy=0, args=(), out_leads=None,
+                            in_leads=None, check_hermiticity=True, *,
+                            params=None):
+        """
+        Return an object for the computation of scattering matrices and
+        Green's functions of locally perturbed systems.
+
+        Parameters
+        ----------
+        sys : `kwant.system.FiniteSystem`
+            The reference system.
+        energy : number
+            Excitation energy at which to solve the scattering problem.
+        args : tuple, defaults to empty
+            Positional arguments to pass to the ``hamiltonian`` method.
+            Mutually exclusive with 'params'.
+        out_leads : sequence of integers or ``None``
+            Numbers of leads where current or wave function is extracted.  None
+            is interpreted as all leads. Default is ``None`` and means "all
+            leads".
+        in_leads : sequence of integers or ``None``
+            Numbers of leads in which current or wave function is injected.
+            None is interpreted as all leads. Default is ``None`` and means
+            "all leads".
+        check_hermiticity : ``bool``
+            Check if the Hamiltonian matrices and the perturbations are
+            Hermitian.  Enables deduction of missing transmission
+            coefficients.
+        params : dict, optional
+            Dictionary of parameter names and their values. Mutually exclusive
+            with 'args'.
+
+        Returns
+        -------
+        output : `~kwant.solvers.common.PerturbationSolver`
+
+        Notes
+        -----
+        The linear system of the reference system is factorized only once.
+        The scattering matrix or Green's function of a system whose
+        Hamiltonian differs from the reference only on a few orbitals of the
+        scattering region is then obtained by a low-rank (Woodbury) update of
+        the reference solution.  For ``k`` perturbed orbitals, this requires
+        ``k`` solutions of the factorized linear system and the solution of a
+        dense linear system of size ``k``, but no new factorization.
+
+        Examples
+        --------
+        >>> ps = kwant.solvers.default.perturbation_solver(syst, energy)
+        >>> orbitals = [syst.id_by_site[impurity]]
+        >>> smatrix = ps.smatrix(orbitals, [[0.5]])
+
+        """
+        return PerturbationSolver(self, sys, energy, args, out_leads,
+                                  in_leads, check_hermiticity, params)
+
+    def smatrix_batch(self, sys, energies, params_list=None,
+                      out_leads=None, in_leads=None, check_hermiticity=True,
+                      *, workers=None, threads=False):
+        """
+        Compute scattering matrices for many energies and parameter values.
+
+        Parameters
+        ----------
+        sys : `kwant.system.FiniteSystem`
+            Low level system, containing the leads and the Hamiltonian of a
+            scattering region.
+        energies : number or 1d array-like of numbers
+            Excitation energies at which to solve the scattering problem.
+        params_list : dict or sequence of dicts, optional
+            Parameter values for each of the energies.  A single dictionary
+            is used for all the energies.  If a sequence is given and
+            `energies` is a single number, that energy is used for all the
+            parameter values.
+        out_leads : sequence of integers or ``None``
+            Numbers of leads where current or wave function is extracted.
+            Default is ``None`` and means "all leads".
+        in_leads : sequence of integers or ``None``
+            Numbers of leads in which current or wave function is injected.
+            Default is ``None`` and means "all leads".
+        check_hermiticity : ``bool``
+            Check if the Hamiltonian matrices are Hermitian.
+            Enables deduction of missing transmission coefficients.
+        workers : int, optional
+            Number of worker processes (or threads) among which the points
+            are distributed.  By default all points are computed in the
+            calling process.
+        threads : bool
+            Use threads instead of processes as workers.  Threads do not
+            require the system to be pickleable, but the parts of the
+            calculation that hold the global interpreter lock (e.g. value
+            functions) are not sped up.  Defaults to ``False``.
+
+        Returns
+        -------
+        output : `~kwant.solvers.common.BatchResult`
+            The scattering matrices and transmissions of all the points.
+
+        Notes
+        -----
+        The points are split into contiguous chunks that are computed one
+        after the other by the same worker.  Within a chunk, all the data that
+        the solver caches on the system and on itself (e.g. the sparsity
+        pattern of the Hamiltonian) is reused, and the Hamiltonian is checked
+        for hermiticity only once for each distinct ``params`` object.  When
+        processes are used, the system and the solver are sent to each worker
+        only once.
+        """
+        syst = sys  # ensure consistent naming across function bodies
+        ensure_isinstance(syst, system.System)
+        out_leads, in_leads = _check_leads(syst, out_leads, in_leads)
+        energies, params_list = _batch_points(energies, params_list)
+        records = self._solve_batch(syst, energies, params_list, 'smatrix',
+                                    (out_leads, in_leads, check_hermiticity),
+                                    workers, threads)
+        return BatchResult(energies, params_list, out_leads, in_leads,
+                           records)
+
+    def greens_function_batch(self, sys, energies, params_list=None,
+                              out_leads=None, in_leads=None,
+                              check_hermiticity=True, *, workers=None,
+                              threads=False):
+        """
+        Compute retarded Green's functions for many energies and parameters.
+
+        The parameters are the same as for `smatrix_batch`.
+
+        Returns
+        -------
+        output : `~kwant.solvers.common.BatchResult`
+            The Green's functions between the sites interfacing the leads and
+            the transmissions of all the points.
+        """
+        syst = sys  # ensure consistent naming across function bodies
+        ensure_isinstance(syst, system.System)
+        out_leads, in_leads = _check_leads(syst, out_leads, in_leads)
+        energies, params_list = _batch_points(energies, params_list)
+        records = self._solve_batch(syst, energies, params_list,
+                                    'greens_function',
+                                    (out_leads, in_leads, check_hermiticity),
+                                    workers, threads)
+        return BatchResult(energies, params_list, out_leads, in_leads,
+                           records)
+
+    def ldos_batch(self, sys, energies, params_list=None,
+                   check_hermiticity=True, *, workers=None, threads=False):
+        """
+        Calculate the local density of states for many energies and
+        parameters.
+
+        The parameters have the same meaning as for `smatrix_batch`.
+
+        Returns
+        -------
+        ldos : 2d NumPy array
+            ``ldos[k]`` is the local density of states at each orbital of the
+            system for the k-th point.
+        """
+        syst = sys  # ensure consistent naming across function bodies
+        ensure_isinstance(syst, system.System)
+        _check_ldos_applicable(syst, check_hermiticity)
+        energies, params_list = _batch_points(energies, params_list)
+        records = self._solve_batch(syst, energies, params_list, 'ldos',
+                                    (check_hermiticity,), workers, threads)
+        if not records:
+            return np.zeros((0, 0))
+        return np.array(records)
+
+    def smatrix_ensemble(self, sys, energy, salts, observable, params=None,
+                         out_leads=None, in_leads=None,
+                         check_hermiticity=True, *, salt_name='salt',
+                         workers=None, threads=False, bins=None,
+                         hist_range=None, keep_values=False,
+                         cache_leads=False):
+        """
+        Average an observable over an ensemble of disorder realizations.
+
+        The realizations differ only in the value of the parameter
+        `salt_name`, which is meant to be passed as the salt to the functions
+        of `kwant.digest` inside the value functions of the system.
+
+        Parameters
+        ----------
+        sys : `kwant.system.FiniteSystem`
+            Low level system, containing the leads and the Hamiltonian of a
+            scattering region.
+        energy : number
+            Excitation energy at which to solve the scattering problems.
+        salts : int or sequence of strings
+            The salts of the realizations.  An integer ``n`` stands for the
+            salts ``'0', '1', ..., str(n - 1)``.
+        observable : callable
+            Called with the `SMatrix` of each realization.  It must return a
+            real number or an array of real numbers of fixed shape.  With
+            worker processes, it must be pickleable (e.g. a function defined
+            at module level).
+        params : dict, optional
+            Parameter values common to all realizations.
+        out_leads : sequence of integers or ``None``
+            Numbers of leads where current or wave function is extracted.
+            Default is ``None`` and means "all leads".
+        in_leads : sequence of integers or ``None``
+            Numbers of leads in which current or wave function is injected.
+            Default is ``None`` and means "all leads".
+        check_hermiticity : ``bool``
+            Check if the Hamiltonian matrices are Hermitian.
+            Enables deduction of missing transmission coefficients.
+        salt_name : str
+            Name of the parameter that holds the salt.  Defaults to
+            ``'salt'``.
+        workers : int, optional
+            Number of worker processes (or threads) among which the
+            realizations are distributed.  By default all realizations are
+            computed in the calling process.
+        threads : bool
+            Use threads instead of processes as workers.  See
+            `smatrix_batch`.  Defaults to ``False``.
+        bins : int or sequence of numbers, optional
+            If given, the values of the observable are also histogrammed.  An
+            integer is the number of bins of equal width in `hist_range`,
+            otherwise the bin edges are given.
+        hist_range : pair of numbers, optional
+            The range of the histogram.  Required if `bins` is an integer.
+        keep_values : bool
+            Keep the values of the observable for all the realizations.
+            Defaults to ``False``.
+        cache_leads : bool
+            Cache the modes of the leads that are instances of
+            `~kwant.system.InfiniteSystem` for the duration of the call, such
+            that they are computed only once if they do not depend on the
+            salt.  Like setting ``cache_bytes`` of the leads, this is only
+            valid if the value functions of the leads depend on nothing but
+            the energy and the parameters.  Defaults to ``False``.
+
+        Returns
+        -------
+        output : `~kwant.solvers.common.EnsembleResult`
+
+        Notes
+        -----
+        The results only depend on the salts, and not on the number of
+        workers or on how the realizations are distributed among them: the
+        values of the observable are accumulated in the order of the salts as
+        they arrive from the workers.  Only the values of the observable are
+        sent back by the workers, and unless `keep_values` is set, memory
+        usage does not grow with the number of realizations.
+
+        The realizations are split into chunks as in `smatrix_batch`, such
+        that each worker reuses the data cached by the solver (e.g. the
+        analysis of the sparsity pattern by MUMPS) between realizations.
+        Leads for which ``cache_bytes`` is set use their cache in any case.
+        With `cache_leads`, the other leads get a cache for the duration of
+        the call, and their ``cache_bytes`` is restored afterwards.
+        """
+        syst = sys  # ensure consistent naming across function bodies
+        ensure_isinstance(syst, system.System)
+        out_leads, in_leads = _check_leads(syst, out_leads, in_leads)
+        if isinstance(salts, Integral):
+            salts = [str(k) for k in range(salts)]
+        else:
+            salts = list(salts)
+        params = {} if params is None else dict(params)
+        if salt_name in params:
+            raise ValueError("The parameter {0!r} is set for each realization "
+                             "and must not be given in 'params'."
+                             .format(salt_name))
+        params_list = [dict(params, **{salt_name: salt}) for salt in salts]
+        energies = np.repeat(np.asarray(energy), len(salts))
+        accumulator = _EnsembleAccumulator(bins, hist_range, keep_values)
+
+        leads = []
+        if cache_leads:
+            leads = [lead for lead in syst.leads
+                     if isinstance(lead, system.InfiniteSystem)
+                     and not lead.cache_bytes]
+        saved = [lead.__dict__.get('cache_bytes') for lead in leads]
+        for lead in leads:
+            lead.cache_bytes = _ENSEMBLE_CACHE_BYTES
+        try:
+            options = (out_leads, in_leads, check_hermiticity, observable)
+            for values in self._solve_batch_chunks(syst, energies,
+                                                   params_list, 'ensemble',
+                                                   options, workers, threads):
+                for value in values:
+                    accumulator.add(value)
+        finally:
+            for lead, cache_bytes in zip(leads, saved):
+                if cache_bytes is None:
+                    del lead.cache_bytes
+                else:
+                    lead.cache_bytes = cache_bytes
+                lead.__dict__.pop('_cache', None)
+
+        return EnsembleResult(salts, accumulator)
+
+    def _solve_batch(self, syst, energies, params_list, what, options,
+                     workers, threads):
+        return list(chain.from_iterable(self._solve_batch_chunks(
+            syst, energies, params_list, what, options, workers, threads)))
+
+    def _solve_batch_chunks(self, syst, energies, params_list, what, options,
+                            workers, threads):
+        """Yield the records of the points chunk by chunk, in order."""
+        points = list(zip(energies, params_list))
+        if not workers or workers == 1 or len(points) < 2:
+            yield _solve_batch_chunk(self, syst, what, options, points)
+            return
+
+        # Several chunks per worker even out differences in the cost of the
+        # points.
+        num_chunks = min(len(points), 4 * workers)
+        bounds = np.linspace(0, len(points), num_chunks + 1).astype(int)
+        chunks = [points[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        if threads:
+            with ThreadPool(workers) as pool:
+                yield from pool.imap(
+                    partial(_solve_batch_chunk, self, syst, what, options),
+                    chunks)
+        else:
+            with multiprocessing.Pool(workers, _init_batch_worker,
+                                      (self, syst, what, options)) as pool:
+                yield from pool.imap(_solve_batch_chunk_in_worker, chunks)
+
+
+def _batch_points(energies, params_list):
+    energies = np.atleast_1d(energies)
+    if energies.ndim != 1:
+        raise ValueError("'energies' must be a number or a 1d sequence.")
+    if params_list is None or isinstance(params_list, Mapping):
+        params_list = [params_list] * len(energies)
+    else:
+        params_list = list(params_list)
+        if len(energies) == 1:
+            energies = np.repeat(energies, len(params_list))
+        elif len(params_list) != len(energies):
+            raise ValueError("'energies' and 'params_list' must have the "
+                             "same length.")
+    return energies, params_list
+
+
+def _batch_record(result):
+    """Return the compact data of a `BlockResult`."""
+    n = len(result.lead_info)
+    transmissions = np.empty((n, n))
+    for i, j in product(range(n), repeat=2):
+        try:
+            transmissions[i, j] = result.transmission(i, j)
+        except ValueError:
+            transmissions[i, j] = np.nan
+    num_propagating = [result.num_propagating(i) for i in range(n)]
+    return result.data, result.sizes, num_propagating, transmissions
+
+
+def _solve_batch_chunk(solver, syst, what, options, points):
+    """Solve the points of a batch one after the other."""
+    observable = None
+    if what == 'ensemble':
+        what = 'smatrix'
+        *options, observable = options
+    check_hermiticity = options[-1]
+    # 'params' objects for which hermiticity has been verified.
+    checked = []
+    records = []
+    for energy, params in points:
+        check = (check_hermiticity and
+                 not any(params is other for other in checked))
+        if what == 'ldos':
+            records.append(solver._ldos(syst, energy, (), check, params))
+        else:
+            out_leads, in_leads, current_conserving = options
+            solve = getattr(solver, '_' + what)
+            result = solve(syst, energy, (), out_leads, in_leads, check,
+                           current_conserving, params)
+            if observable is None:
+                records.append(_batch_record(result))
+            else:
+                records.append(np.asarray(observable(result), float))
+        if check:
+            checked.append(params)
+    return records
+
+
+# Memory used for caching the modes of each lead during `smatrix_ensemble`
+# with 'cache_leads'.
+_ENSEMBLE_CACHE_BYTES = 2**27
+
+
+class _EnsembleAccumulator:
+    """Accumulate the statistics of an observable value by value.
+
+    The mean and the sum of squared deviations are updated with Welford's
+    algorithm.
+    """
+
+    def __init__(self, bins, hist_range, keep_values):
+        if isinstance(bins, Integral):
+            if hist_range is None:
+                raise ValueError("'hist_range' is required if 'bins' is an "
+                                 "integer.")
+            bins = np.linspace(hist_range[0], hist_range[1], bins + 1)
+        elif bins is not None:
+            bins = np.asarray(bins, float)
+            if bins.ndim != 1 or len(bins) < 2 or np.any(np.diff(bins) <= 0):
+                raise ValueError("'bins' must be an integer or an increasing "
+                                 "sequence of bin edges.")
+        self.bin_edges = bins
+        self.values = [] if keep_values else None
+        self.count = 0
+        self.mean = self.m2 = self.histogram = None
+
+    def add(self, value):
+        if self.count == 0:
+            self.mean = np.zeros_like(value)
+            self.m2 = np.zeros_like(value)
+            if self.bin_edges is not None:
+                self.histogram = np.zeros(value.shape +
+                                          (len(self.bin_edges) - 1,), int)
+        elif value.shape != self.mean.shape:
+            raise ValueError("The observable must always have the same "
+                             "shape.")
+        self.count += 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (value - self.mean)
+        if self.values is not None:
+            self.values.append(value)
+        if self.bin_edges is not None:
+            # Like numpy.histogram, the last bin includes its right edge.
+            edges = self.bin_edges
+            value = value.reshape(-1)
+            i = np.searchsorted(edges, value, side='right') - 1
+            i[value == edges[-1]] = len(edges) - 2
+            inside = (i >= 0) & (i < len(edges) - 1)
+            self.histogram.reshape(-1, len(edges) - 1)[
+                np.flatnonzero(inside), i[inside]] += 1
+
+
+# The system and the solver are sent only once to each worker process.
+_batch_worker_state = None
+
+
+def _init_batch_worker(solver, syst, what, options):
+    global _batch_worker_state
+    _batch_worker_state = solver, syst, what, options
+
+
+def _solve_batch_chunk_in_worker(points):
+    return _solve_batch_chunk(*_batch_worker_state, points)
+
 
 class WaveFunction:
     def __init__(self, solver, sys, energy, args, check_hermiticity, params):
@@ -619,6 +1249,7 @@ class WaveFunction:
                                          args, check_hermiticity,
                                          params=params)[0]
         self.solve = solver._solve_linear_sys
+        self.solve_chunks = solver._solve_chunks
         self.rhs = linsys.rhs
         self.factorized_h = solver._factorized(linsys.lhs)
         self.num_orb = linsys.num_orb
@@ -628,6 +1259,190 @@ class WaveFunction:
                             slice(self.num_orb))
         return result.transpose()
 
+    def chunks(self, lead):
+        """Iterate over the wave function due to the modes of a lead in chunks.
+
+        The chunks are 2d NumPy arrays that hold the wave functions of
+        consecutive incoming modes, in the same layout as the result of
+        calling this object.  Only one chunk is held in memory at a time,
+        its size is limited by the ``memory_budget`` of the solver.
+        """
+        for result in self.solve_chunks(self.factorized_h, self.rhs[lead],
+                                        slice(self.num_orb)):
+            yield result.transpose()
+
+
+class PerturbationSolver:
+    """Scattering matrices and Green's functions of perturbed systems.
+
+    The Hamiltonian of a perturbed system is that of the reference system with
+    a matrix ``delta`` added to the block of the given ``orbitals`` of the
+    scattering region.  The scattering problem of the reference system is
+    factorized once, when it is solved for the first time.  The solution of
+    the reference system in the whole scattering region is kept in memory.
+
+    Instances are created by
+    `~kwant.solvers.common.SparseSolver.perturbation_solver`.
+    """
+
+    def __init__(self, solver, sys, energy, args, out_leads, in_leads,
+                 check_hermiticity, params):
+        syst = sys  # ensure consistent naming across function bodies
+        ensure_isinstance(syst, system.System)
+        self.out_leads, self.in_leads = _check_leads(syst, out_leads,
+                                                     in_leads)
+        self.solver = solver
+        self.syst = syst
+        self.energy = energy
+        self.args = args
+        self.check_hermiticity = check_hermiticity
+        self.params = params
+        self._problems = {}
+        self._hamiltonian = None
+
+    def _problem(self, realspace):
+        """Factorize the linear system of the reference system."""
+        try:
+            return self._problems[realspace]
+        except KeyError:
+            pass
+        solver = self.solver
+        linsys, lead_info = solver._make_linear_sys(
+            self.syst, self.in_leads, self.energy, self.args,
+            self.check_hermiticity, realspace, params=self.params)
+        kept_vars = np.concatenate([coords for i, coords in
+                                    enumerate(linsys.indices) if i in
+                                    self.out_leads])
+        num_orb = linsys.num_orb
+        factorized = solution = None
+        if sum(i.shape[1] for i in linsys.rhs) and len(kept_vars):
+            # See comment about zero-shaped sparse matrices at the top of
+            # common.py.
+            rhs = sp.bmat([[i for i in linsys.rhs if i.shape[1]]],
+                          format=solver.rhsformat)
+            factorized = solver._factorized(linsys.lhs)
+            solution = solver._solve_linear_sys(
+                factorized, rhs, np.r_[kept_vars, np.arange(num_orb)])
+        problem = (factorized, solution, kept_vars, num_orb,
+                   linsys.lhs.shape[0], lead_info)
+        self._problems[realspace] = problem
+        return problem
+
+    def _solve(self, realspace, orbitals, delta):
+        """Return the solution of the perturbed system and the lead info."""
+        (factorized, solution, kept_vars, num_orb,
+         num_vars, lead_info) = self._problem(realspace)
+        orbitals = np.asarray(orbitals, int).reshape(-1)
+        delta = np.asarray(delta)
+        k = len(orbitals)
+        if delta.shape != (k, k):
+            raise ValueError('The perturbation must be a square matrix of the '
+                             'size of the number of orbitals.')
+        if k and (orbitals.min() < 0 or orbitals.max() >= num_orb):
+            raise ValueError('The orbitals must belong to the scattering '
+                             'region.')
+        if len(np.unique(orbitals)) != k:
+            raise ValueError('The orbitals must be unique.')
+        if self.check_hermiticity and k:
+            tol = 1e-13 * np.max(np.abs(delta)) + 1e-300
+            if np.any(np.abs(delta - delta.T.conj()) > tol):
+                raise ValueError('The perturbation is not Hermitian. '
+                                 'Use option `check_hermiticity=False` '
+                                 'if this is intentional.')
+        if solution is None:
+            return np.zeros((len(kept_vars), 0)), lead_info
+        num_kept = len(kept_vars)
+        x_kept = solution[:num_kept]
+        if not k:
+            return x_kept, lead_info
+
+        # The inverse of the perturbed left hand side A + P delta P^T is
+        # A^-1 - A^-1 P (1 + delta P^T A^-1 P)^-1 delta P^T A^-1, where P
+        # projects onto the perturbed orbitals.
+        solver = self.solver
+        p = sp.csc_matrix((np.ones(k), (orbitals, np.arange(k))),
+                          shape=(num_vars, k))
+        y = solver._solve_linear_sys(factorized,
+                                     getattr(p, 'to' + solver.rhsformat)(),
+                                     np.r_[kept_vars, orbitals])
+        y_kept, y_orbs = y[:num_kept], y[num_kept:]
+        m = np.identity(k) + delta.dot(y_orbs)
+        x_orbs = solution[num_kept + orbitals]
+        correction = y_kept.dot(np.linalg.solve(m, delta.dot(x_orbs)))
+        return x_kept - correction, lead_info
+
+    def smatrix(self, orbitals, delta):
+        """Compute the scattering matrix of a perturbed system.
+
+        Parameters
+        ----------
+        orbitals : 1d array of integers
+            The perturbed orbitals of the scattering region.
+        delta : 2d array
+            The perturbation that is added to the Hamiltonian of the
+            reference system on the `orbitals`.
+
+        Returns
+        -------
+        output : `~kwant.solvers.common.SMatrix`
+        """
+        data, lead_info = self._solve(False, orbitals, delta)
+        return SMatrix(data, lead_info, self.out_leads, self.in_leads,
+                       self.check_hermiticity)
+
+    def greens_function(self, orbitals, delta):
+        """Compute the Green's function of a perturbed system.
+
+        The parameters are the same as for `smatrix`.
+
+        Returns
+        -------
+        output : `~kwant.solvers.common.GreensFunction`
+        """
+        data, lead_info = self._solve(True, orbitals, delta)
+        return GreensFunction(data, lead_info, self.out_leads, self.in_leads,
+                              self.check_hermiticity)
+
+    def perturbation(self, args=(), *, params=None):
+        """Return the perturbation due to other values of the parameters.
+
+        The Hamiltonian of the scattering region of the reference system is
+        evaluated with the given arguments and compared to the reference.
+
+        Parameters
+        ----------
+        args : tuple, defaults to empty
+            Positional arguments to pass to the ``hamiltonian`` method.
+            Mutually exclusive with 'params'.
+        params : dict, optional
+            Dictionary of parameter names and their values. Mutually exclusive
+            with 'args'.
+
+        Returns
+        -------
+        orbitals : 1d array of integers
+            The orbitals whose matrix elements differ from the reference.
+        delta : 2d array
+            The difference of the Hamiltonians on these orbitals.
+
+        Notes
+        -----
+        This method evaluates the whole Hamiltonian of the scattering region,
+        which is much cheaper than a factorization.  It is most useful when
+        the perturbation depends on parameters in a complicated way.
+        """
+        if self._hamiltonian is None:
+            self._hamiltonian = self.syst.hamiltonian_submatrix(
+                self.args, sparse=True, params=self.params).tocsr()
+        ham = self.syst.hamiltonian_submatrix(args, sparse=True,
+                                              params=params).tocsr()
+        diff = (ham - self._hamiltonian).tocsr()
+        coo = diff.tocoo()
+        nonzero = coo.data != 0
+        orbitals = np.unique(np.r_[coo.row[nonzero], coo.col[nonzero]])
+        delta = diff[orbitals][:, orbitals].toarray()
+        return orbitals, delta
+
 
 class BlockResult(metaclass=abc.ABCMeta):
     """
@@ -958,3 +1773,158 @@ class GreensFunction(BlockResult):
         return ("GreensFunction(data=%r, lead_info=%r, "
                 "out_leads=%r, in_leads=%r)" %
                 (self.data, self.lead_info, self.out_leads, self.in_leads))
+
+
+class BatchResult:
+    """Results of a batch of scattering calculations.
+
+    Returned by `~kwant.solvers.common.SparseSolver.smatrix_batch` and
+    `~kwant.solvers.common.SparseSolver.greens_function_batch`.  Instead of
+    one `SMatrix` or `GreensFunction` instance per point, all the results are
+    kept in a few arrays.  The lead information (modes or self-energies) is
+    not retained.
+
+    Attributes
+    ----------
+    energies : 1d NumPy array
+        The energy of each point.
+    params : list
+        The ``params`` of each point.
+    out_leads, in_leads : list of integers
+        Indices of the leads where current is extracted (out) or injected
+        (in).
+    num_propagating : 2d NumPy array of integers
+        ``num_propagating[k, i]`` is the number of propagating modes in lead
+        ``i`` at point ``k``.
+    transmissions : 3d NumPy array of floats
+        ``transmissions[k, i, j]`` is the transmission from lead ``j`` to lead
+        ``i`` at point ``k``.  It is NaN where it cannot be computed from the
+        requested leads.
+    data : 1d NumPy array
+        The matrices (scattering matrices or Green's functions) of all points,
+        flattened and concatenated.  Use `matrix` to access them.
+    offsets : 1d NumPy array of integers
+        The matrix of point ``k`` starts at ``data[offsets[k]]``.
+    shapes : 2d NumPy array of integers
+        ``shapes[k]`` is the shape of the matrix of point ``k``.
+    sizes : 2d NumPy array of integers
+        ``sizes[k, i]`` is the size of the block of lead ``i`` at point ``k``.
+    """
+
+    def __init__(self, energies, params, out_leads, in_leads, records):
+        self.energies = np.asarray(energies)
+        self.params = list(params)
+        self.out_leads = list(out_leads)
+        self.in_leads = list(in_leads)
+        num_leads = len(records[0][1]) if records else 0
+        matrices = [record[0] for record in records]
+        self.shapes = np.array([m.shape for m in matrices],
+                               int).reshape(-1, 2)
+        self.offsets = np.zeros(len(records) + 1, int)
+        self.offsets[1:] = np.cumsum(np.prod(self.shapes, axis=1))
+        self.data = (np.concatenate([np.ravel(m) for m in matrices])
+                     if matrices else np.zeros(0, complex))
+        self.sizes = np.array([record[1] for record in records],
+                              int).reshape(-1, num_leads)
+        self.num_propagating = np.array(
+            [record[2] for record in records], int).reshape(-1, num_leads)
+        self.transmissions = np.array(
+            [record[3] for record in records],
+            float).reshape(-1, num_leads, num_leads)
+
+    def __len__(self):
+        return len(self.energies)
+
+    def matrix(self, k):
+        """Return the matrix of the k-th point."""
+        return self.data[self.offsets[k] : self.offsets[k + 1]].reshape(
+            self.shapes[k])
+
+    def submatrix(self, k, lead_out, lead_in):
+        """Return the matrix elements from lead_in to lead_out at point k."""
+        sizes = self.sizes[k]
+        out_offsets = np.cumsum([0] + [sizes[i] for i in self.out_leads])
+        in_offsets = np.cumsum([0] + [sizes[i] for i in self.in_leads])
+        i = self.out_leads.index(lead_out)
+        j = self.in_leads.index(lead_in)
+        return self.matrix(k)[out_offsets[i] : out_offsets[i + 1],
+                              in_offsets[j] : in_offsets[j + 1]]
+
+    def transmission(self, lead_out, lead_in):
+        """Return the transmission from lead_in to lead_out at all points."""
+        result = self.transmissions[:, lead_out, lead_in]
+        if np.any(np.isnan(result)):
+            raise ValueError("Insufficient matrix elements to compute "
+                             "transmission({0}, {1}).".format(lead_out,
+                                                              lead_in))
+        return result
+
+    def conductance_matrix(self):
+        """Return the conductance matrices of all points.
+
+        See `BlockResult.conductance_matrix`.  Entries that depend on
+        transmissions that cannot be computed are NaN.
+        """
+        n = self.transmissions.shape[1]
+        result = -self.transmissions.copy()
+        result[:, np.arange(n), np.arange(n)] = 0
+        result[:, np.arange(n), np.arange(n)] = -result.sum(axis=1)
+        return result
+
+    def __repr__(self):
+        return ("BatchResult(energies=%r, out_leads=%r, in_leads=%r)" %
+                (self.energies, self.out_leads, self.in_leads))
+
+
+class EnsembleResult:
+    """Statistics of an observable over an ensemble of disorder realizations.
+
+    Returned by `~kwant.solvers.common.SparseSolver.smatrix_ensemble`.
+
+    Attributes
+    ----------
+    salts : list
+        The salts of the realizations.
+    count : int
+        The number of realizations.
+    mean : float or NumPy array
+        The mean of the observable.
+    variance : float or NumPy array
+        The unbiased sample variance of the observable.  NaN if there are
+        less than two realizations.
+    std_error : float or NumPy array
+        The standard error of the mean.
+    histogram : NumPy array of integers or ``None``
+        If bins were requested, ``histogram[..., b]`` is the number of
+        realizations for which the observable (or each of its components)
+        falls into bin ``b``.  Values outside of the bins are not counted.
+    bin_edges : 1d NumPy array or ``None``
+        The edges of the bins of the histogram.
+    values : NumPy array or ``None``
+        ``values[k]`` is the value of the observable for ``salts[k]``, if
+        the values were kept.
+    """
+
+    def __init__(self, salts, accumulator):
+        self.salts = salts
+        self.count = count = accumulator.count
+        if count:
+            self.mean = accumulator.mean[()]
+            if count > 1:
+                self.variance = (accumulator.m2 / (count - 1))[()]
+            else:
+                self.variance = np.full_like(accumulator.m2, np.nan)[()]
+            self.std_error = np.sqrt(self.variance / count)
+        else:
+            self.mean = self.variance = self.std_error = np.nan
+        self.histogram = accumulator.histogram
+        self.bin_edges = accumulator.bin_edges
+        values = accumulator.values
+        self.values = None if values is None else np.array(values)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "EnsembleResult(count=%r, mean=%r, std_error=%r)" % (
+            self.count, self.mean, self.std_error)
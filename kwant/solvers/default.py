@@ -6,7 +6,9 @@
 # the file AUTHORS.rst at the top-level directory of this distribution and at
 # http://kwant-project.org/authors.
 
-__all__ = ['smatrix', 'ldos', 'wave_function', 'greens_function']
+__all__ = ['smatrix', 'ldos', 'wave_function', 'greens_function',
+           'smatrix_batch', 'greens_function_batch', 'ldos_batch',
+           'smatrix_ensemble', 'perturbation_solver']
 
 # MUMPS usually works best.  Use SciPy as fallback.
 import warnings
@@ -24,3 +26,8 @@ smatrix = hidden_instance.smatrix
 ldos = hidden_instance.ldos
 wave_function = hidden_instance.wave_function
 greens_function = hidden_instance.greens_function
+smatrix_batch = hidden_instance.smatrix_batch
+greens_function_batch = hidden_instance.greens_function_batch
+ldos_batch = hidden_instance.ldos_batch
+smatrix_ensemble = hidden_instance.smatrix_ensemble
+perturbation_solver = hidden_instance.perturbation_solver
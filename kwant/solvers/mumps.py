@@ -6,9 +6,14 @@
 # the file AUTHORS.rst at the top-level directory of this distribution and at
 # http://kwant-project.org/authors.
 
-__all__ = ['smatrix', 'ldos', 'wave_function', 'greens_function', 'options',
+__all__ = ['smatrix', 'ldos', 'wave_function', 'greens_function',
+           'smatrix_batch', 'greens_function_batch', 'ldos_batch',
+           'smatrix_ensemble', 'perturbation_solver', 'options',
            'Solver']
 
+import weakref
+import threading
+from collections import OrderedDict
 import numpy as np
 from . import common
 from ..linalg import mumps
@@ -20,15 +25,40 @@ class Solver(common.SparseSolver):
     lhsformat = 'coo'
     rhsformat = 'csc'
 
+    # Maximal number of idle MUMPS contexts that are kept around for reusing
+    # their analysis.  Each of them holds on to the memory of its last
+    # factorization.
+    max_cached_contexts = 4
+
     def __init__(self):
         self.nrhs = self.ordering = self.sparse_rhs = None
+        self.reuse_analysis = self.eliminate_interior = None
+        self.memory_budget = None
+        self._idle_contexts = OrderedDict()
+        self._lock = threading.Lock()
         self.reset_options()
 
+    def __getstate__(self):
+        # MUMPS contexts and locks cannot be pickled.
+        state = self.__dict__.copy()
+        del state['_idle_contexts'], state['_lock']
+        state.pop('_interior_elimination', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._idle_contexts = OrderedDict()
+        self._lock = threading.Lock()
+
     def reset_options(self):
         """Set the options to default values.  Return the old options."""
-        return self.options(nrhs=6, ordering='kwant_decides', sparse_rhs=False)
+        return self.options(nrhs=6, ordering='kwant_decides', sparse_rhs=False,
+                            reuse_analysis=True, eliminate_interior=False,
+                            memory_budget=float('inf'))
 
-    def options(self, nrhs=None, ordering=None, sparse_rhs=None):
+    def options(self, nrhs=None, ordering=None, sparse_rhs=None,
+                reuse_analysis=None, eliminate_interior=None,
+                memory_budget=None):
         """
         Modify some options.  Return the old options.
 
@@ -57,6 +87,34 @@ class Solver(common.SparseSolver):
             MUMPS. Preliminary tests have not shown a significant performance
             increase when this feature is used, but this needs more looking
             into. Default value is False.
+        reuse_analysis : True or False
+            whether to reuse the analysis phase of MUMPS (ordering and
+            symbolic factorization) for linear systems whose left hand side
+            has the same sparsity pattern as an earlier one, as is typically
+            the case when scanning the energy or the parameters of a system.
+            Only the numerical factorization is then performed.  Default value
+            is True.
+        eliminate_interior : True or False
+            whether `smatrix` and `greens_function` first eliminate the
+            degrees of freedom of the scattering region that are not coupled
+            to the leads, using the Schur complement functionality of MUMPS.
+            Only a dense system for the interface of the scattering region
+            and the lead modes remains to be solved.  The elimination is
+            reused as long as the Hamiltonian of the interior of the
+            scattering region does not change, which makes this option
+            worthwhile when only the leads or the interface change between
+            calculations.  Note that a new elimination is needed whenever the
+            energy changes.  Default value is False.
+        memory_budget : number
+            upper limit in bytes for the memory used by the solutions of the
+            linear system in `ldos` and when iterating over the chunks of a
+            wave function.  The solutions are then computed in chunks of
+            columns, and each chunk is discarded once it has been processed.
+            The width of the chunks is given by the budget (or by the
+            available memory, if that is less), divided by the memory needed
+            for one column of the solution.  Within each chunk, MUMPS solves
+            for ``nrhs`` columns at a time.  Default value is infinite, in
+            which case the chunks are ``nrhs`` columns wide.
 
         Returns
         -------
@@ -75,7 +133,10 @@ class Solver(common.SparseSolver):
 
         old_opts = {'nrhs': self.nrhs,
                     'ordering': self.ordering,
-                    'sparse_rhs': self.sparse_rhs}
+                    'sparse_rhs': self.sparse_rhs,
+                    'reuse_analysis': self.reuse_analysis,
+                    'eliminate_interior': self.eliminate_interior,
+                    'memory_budget': self.memory_budget}
 
         if nrhs is not None:
             if nrhs < 1 and int(nrhs) != nrhs:
@@ -97,12 +158,75 @@ class Solver(common.SparseSolver):
         if sparse_rhs is not None:
             self.sparse_rhs = bool(sparse_rhs)
 
+        if reuse_analysis is not None:
+            self.reuse_analysis = bool(reuse_analysis)
+            if not self.reuse_analysis:
+                with self._lock:
+                    self._idle_contexts.clear()
+
+        if eliminate_interior is not None:
+            self.eliminate_interior = bool(eliminate_interior)
+            self._interior_elimination = None
+
+        if memory_budget is not None:
+            if not memory_budget > 0:
+                raise ValueError("memory_budget must be positive")
+            self.memory_budget = memory_budget
+
         return old_opts
 
     def _factorized(self, a):
-        inst = mumps.MUMPSContext()
-        inst.factor(a, ordering=self.ordering)
-        return inst
+        if not self.reuse_analysis:
+            inst = mumps.MUMPSContext()
+            inst.factor(a, ordering=self.ordering)
+            return inst
+
+        a = a.tocoo()
+        key = (a.shape, a.nnz, self.ordering)
+        inst = None
+        with self._lock:
+            idle = self._idle_contexts.get(key, [])
+            for i, (row, col, context) in enumerate(idle):
+                if np.array_equal(row, a.row) and np.array_equal(col, a.col):
+                    inst = context
+                    del idle[i]
+                    break
+        if inst is None:
+            row, col = a.row.copy(), a.col.copy()
+            inst = mumps.MUMPSContext()
+            inst.analyze(a, ordering=self.ordering)
+        inst.factor(a, ordering=self.ordering, reuse_analysis=True)
+
+        # A context may only be factorized anew once the previous
+        # factorization is not used anymore.  Hence it becomes available for
+        # reuse only when the returned object is garbage collected.
+        factorized = _Factorization(inst)
+        weakref.finalize(factorized, self._release, key, row, col, inst)
+        return factorized
+
+    def _release(self, key, row, col, inst):
+        if not self.reuse_analysis:
+            return
+        with self._lock:
+            idle = self._idle_contexts.pop(key, [])
+            idle.append((row, col, inst))
+            self._idle_contexts[key] = idle
+            num_idle = sum(len(contexts)
+                           for contexts in self._idle_contexts.values())
+            while num_idle > self.max_cached_contexts:
+                # Drop the least recently released contexts first.
+                oldest_key = next(iter(self._idle_contexts))
+                oldest = self._idle_contexts[oldest_key]
+                del oldest[0]
+                if not oldest:
+                    del self._idle_contexts[oldest_key]
+                num_idle -= 1
+
+    def _schur_complement(self, a, indices, groups=()):
+        if len(indices) in (0, a.shape[0]):
+            return a.tocsr()[indices][:, indices].toarray()
+        return mumps.schur_complement(a.tocoo(), indices,
+                                      ordering=self.ordering)
 
     def _solve_linear_sys(self, factorized_a, b, kept_vars):
         if b.shape[1] == 0:
@@ -121,11 +245,23 @@ class Solver(common.SparseSolver):
         return np.concatenate(sols, axis=1)
 
 
+class _Factorization:
+    """A factorized matrix that keeps its MUMPS context busy while alive."""
+
+    def __init__(self, inst):
+        self.solve = inst.solve
+
+
 default_solver = Solver()
 
 smatrix = default_solver.smatrix
 greens_function = default_solver.greens_function
 ldos = default_solver.ldos
 wave_function = default_solver.wave_function
+smatrix_batch = default_solver.smatrix_batch
+greens_function_batch = default_solver.greens_function_batch
+ldos_batch = default_solver.ldos_batch
+smatrix_ensemble = default_solver.smatrix_ensemble
+perturbation_solver = default_solver.perturbation_solver
 options = default_solver.options
 reset_options = default_solver.reset_options
@@ -0,0 +1,401 @@
+# Copyright 2011-2018 Kwant authors.
+#
+# This file is part of Kwant.  It is subject to the license terms in the file
+# LICENSE.rst found in the top-level directory of this distribution and at
+# http://kwant-project.org/license.  A list of Kwant authors can be found in
+# the file AUTHORS.rst at the top-level directory of this distribution and at
+# http://kwant-project.org/authors.
+
+"""Recursive Green's function solver for quasi-one-dimensional systems."""
+
+__all__ = ['smatrix', 'greens_function', 'ldos', 'smatrix_batch',
+           'greens_function_batch', 'ldos_batch', 'selected_greens_function',
+           'Solver']
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse import csgraph
+from . import common
+from .common import _check_ldos_applicable
+from .. import system
+from .._common import ensure_isinstance
+
+
+def _neighbors(graph, nodes):
+    """Return the unique neighbors of 'nodes' in the CSR matrix 'graph'."""
+    starts = graph.indptr[nodes]
+    lengths = graph.indptr[nodes + 1] - starts
+    # Offsets into graph.indices of all the neighbors, without Python loop.
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    offsets += np.arange(len(offsets))
+    return np.unique(graph.indices[offsets])
+
+
+def layers(a, seeds):
+    """Split the indices of the square matrix 'a' into layers.
+
+    The layers are the shells of a breadth-first search through the graph
+    defined by the non-zero entries of 'a', starting from the first of the
+    'seeds'.  A seed is either an index or an array of indices, for example
+    all the orbitals attached to a lead, which together form the first layer.
+    Whenever the search is exhausted, it is continued from the indices of the
+    next seed that have not been reached yet.  Thus the matrix is
+    block-tridiagonal with respect to the layers.  Indices that cannot be
+    reached from any seed are not included.
+
+    Parameters
+    ----------
+    a : sparse matrix
+    seeds : sequence of integers or of 1d integer arrays
+
+    Returns
+    -------
+    layers : list of 1d integer arrays
+    """
+    a = sp.csr_matrix(a)
+    graph = (abs(a) + abs(a.T)).tocsr()
+    visited = np.zeros(a.shape[0], bool)
+    result = []
+    for seed in seeds:
+        layer = np.unique(np.asarray(seed, int))
+        layer = layer[~visited[layer]]
+        visited[layer] = True
+        while len(layer):
+            result.append(layer)
+            layer = _neighbors(graph, layer)
+            layer = layer[~visited[layer]]
+            visited[layer] = True
+    return result
+
+
+def _layer_order(a, slices):
+    """Permute the square matrix 'a' into the order of the layers 'slices'.
+
+    Returns the permuted matrix in CSR format, the position of each index of
+    'a' in it (-1 for indices that are not part of any layer, which are
+    dropped), and the offsets of the layers.  Layer ``k`` corresponds to the
+    rows and columns ``offsets[k]:offsets[k + 1]``.
+    """
+    order = np.concatenate(slices) if slices else np.zeros(0, int)
+    position = np.full(a.shape[0], -1)
+    position[order] = np.arange(len(order))
+    offsets = np.cumsum([0] + [len(layer) for layer in slices])
+    a = a.tocsr()[order][:, order]
+    a.sum_duplicates()
+    return a, position, offsets
+
+
+def _block(a, rows, cols):
+    return a[rows][:, cols].toarray()
+
+
+def _slice_block(a, rows, cols):
+    """Return the block of the CSR matrix 'a' for two ranges as an array.
+
+    'rows' and 'cols' are pairs of start and stop indices.  Only the entries
+    of the given rows are touched, in contrast to indexing 'a' by arrays,
+    which costs time proportional to the size of 'a'.  'a' must not contain
+    duplicate entries.
+    """
+    (r0, r1), (c0, c1) = rows, cols
+    indptr = a.indptr[r0:r1 + 1]
+    entries = slice(indptr[0], indptr[-1])
+    row = np.repeat(np.arange(r1 - r0), np.diff(indptr))
+    col = a.indices[entries] - c0
+    which = (col >= 0) & (col < c1 - c0)
+    block = np.zeros((r1 - r0, c1 - c0), a.dtype)
+    block[row[which], col[which]] = a.data[entries][which]
+    return block
+
+
+class Solver(common.SparseSolver):
+    """Recursive Green's function solver.
+
+    The scattering region is cut into layers by a breadth-first search
+    starting at the sites attached to leads, such that every layer is only
+    coupled to its two neighbors.  The interior of the scattering region is
+    then eliminated layer by layer, which requires time proportional to ``L
+    W**3`` and memory proportional to ``W**2`` (on top of the memory used by
+    the Hamiltonian itself) for a system of ``L`` layers with ``W`` orbitals
+    each.  This is much less than needed by a direct sparse solver for long
+    quasi-one-dimensional systems.  The remaining linear system for the
+    interface of the scattering region and the lead modes is solved as
+    described for `~kwant.solvers.common.SparseSolver`.
+
+    The layers are thinnest when the system is long and its leads are
+    attached at its two ends.  For other geometries the layers may become
+    wide, which makes this solver slow.
+
+    `ldos` is computed from the diagonal of the retarded Green's function,
+    using a forward and a backward sweep over the layers.  This requires
+    memory proportional to ``L W**2``.  In the same way,
+    `selected_greens_function` computes the entries of the Green's function
+    that are needed for local quantities.  `wave_function` and
+    `perturbation_solver` are not provided by this solver, because they
+    require the factorization of the full linear system.
+    """
+
+    lhsformat = 'csr'
+    rhsformat = 'csr'
+    eliminate_interior = True
+
+    def _factorized(self, a):
+        raise TypeError("The RGF solver does not factorize the full linear "
+                        "system.")
+
+    def _solve_linear_sys(self, factorized_a, b, kept_vars):
+        raise TypeError("The RGF solver does not factorize the full linear "
+                        "system.")
+
+    def _schur_complement(self, a, indices, groups=()):
+        # Start from the orbitals of one lead, such that the layers are the
+        # cross sections of a quasi-one-dimensional system.
+        slices = layers(a, list(groups) + list(indices))
+        a, position, offsets = _layer_order(a, slices)
+        dtype = np.result_type(a.dtype, float)
+        boundary = np.zeros(a.shape[0], bool)
+        boundary[position[indices]] = True
+
+        # All indices below are positions in the order of the layers.
+        # 'kept' are the boundary indices encountered so far, 'interior' the
+        # interior indices of the previous layer.  m_kk is the Schur
+        # complement with all the other interior indices eliminated, m_ik and
+        # m_ki the effective couplings of 'interior' and 'kept', and 'g' the
+        # inverse of the effective block of 'interior'.
+        kept = np.zeros(0, int)
+        interior = np.zeros(0, int)
+        m_kk = np.zeros((0, 0), dtype)
+        m_ik = m_ki = g = np.zeros((0, 0), dtype)
+
+        for k in range(len(slices)):
+            layer = offsets[k], offsets[k + 1]
+            prev = offsets[max(k - 1, 0)], offsets[k]
+            m_ll = _slice_block(a, layer, layer).astype(dtype)
+            # A layer is only coupled to itself and to the previous layer.
+            a_lp = _slice_block(a, layer, prev)
+            a_pl = _slice_block(a, prev, layer)
+            near = kept >= prev[0]
+            m_lk = np.zeros((len(m_ll), len(kept)), dtype)
+            m_kl = np.zeros((len(kept), len(m_ll)), dtype)
+            m_lk[:, near] = a_lp[:, kept[near] - prev[0]]
+            m_kl[near] = a_pl[kept[near] - prev[0]]
+            if len(interior):
+                # Eliminate the interior of the previous layer.
+                a_li = a_lp[:, interior - prev[0]].dot(g)
+                a_il = a_pl[interior - prev[0]]
+                m_ki_g = m_ki.dot(g)
+                m_ll -= a_li.dot(a_il)
+                m_lk -= a_li.dot(m_ik)
+                m_kl -= m_ki_g.dot(a_il)
+                m_kk -= m_ki_g.dot(m_ik)
+
+            is_kept = boundary[layer[0]:layer[1]]
+            m_kk = np.block([[m_kk, m_kl[:, is_kept]],
+                             [m_lk[is_kept], m_ll[np.ix_(is_kept, is_kept)]]])
+            kept = np.r_[kept, layer[0] + np.flatnonzero(is_kept)]
+
+            is_interior = ~is_kept
+            interior = layer[0] + np.flatnonzero(is_interior)
+            m_ik = np.c_[m_lk[is_interior], m_ll[np.ix_(is_interior, is_kept)]]
+            m_ki = np.r_[m_kl[:, is_interior],
+                         m_ll[np.ix_(is_kept, is_interior)]]
+            g = np.linalg.inv(m_ll[np.ix_(is_interior, is_interior)])
+
+        if len(interior):
+            m_kk -= m_ki.dot(g).dot(m_ik)
+
+        # Return the Schur complement in the order of 'indices'.
+        where = np.empty(a.shape[0], int)
+        where[kept] = np.arange(len(kept))
+        where = where[position[indices]]
+        return m_kk[np.ix_(where, where)]
+
+    def selected_greens_function(self, sys, energy=0, args=(),
+                                 check_hermiticity=True, *, params=None):
+        """
+        Compute selected entries of the retarded Green's function.
+
+        The entries are those on the diagonal and those where the
+        Hamiltonian of the scattering region (including the self-energies of
+        the leads) is non-zero, i.e. the on-site and hopping entries.  They
+        are obtained by selected inversion: a forward and a backward sweep
+        over the layers, without solving for any wave functions.  Local
+        quantities of the equilibrium state, like densities and currents, can
+        be expressed by these entries alone.
+
+        Parameters
+        ----------
+        sys : `kwant.system.FiniteSystem`
+            Low level system, containing the leads and the Hamiltonian of the
+            scattering region.  If the system has no leads, the energy should
+            have a positive imaginary part.
+        energy : number
+            Excitation energy at which to compute the Green's function.
+        args : tuple of arguments, or empty tuple
+            Positional arguments to pass to the function(s) which
+            evaluate the hamiltonian matrix elements.  Mutually exclusive
+            with 'params'.
+        check_hermiticity : ``bool``
+            Check if the Hamiltonian matrices are Hermitian.
+        params : dict, optional
+            Dictionary of parameter names and their values. Mutually exclusive
+            with 'args'.
+
+        Returns
+        -------
+        greens_function : `scipy.sparse.csr_matrix`
+            The selected entries of the retarded Green's function, indexed by
+            the orbitals of the system.  Entries of orbitals that are not
+            connected to any lead are not included.
+        """
+        syst = sys  # ensure consistent naming across function bodies
+        ensure_isinstance(syst, system.System)
+        if syst.leads:
+            _check_ldos_applicable(syst, check_hermiticity)
+            ham, seeds = self._open_hamiltonian(syst, energy, args,
+                                                check_hermiticity, params)
+        else:
+            ham = syst.hamiltonian_submatrix(args, sparse=True,
+                                             params=params).tocsr()
+            ham = ham - energy * sp.identity(ham.shape[0], format='csr')
+            seeds = range(ham.shape[0])
+        return -self._selected_inverse(ham, seeds)
+
+    def _open_hamiltonian(self, syst, energy, args, check_hermiticity,
+                          params):
+        """Return the Hamiltonian minus the energy plus the self-energies.
+
+        The orbitals attached to each lead are returned as well.
+        """
+        linsys = self._make_linear_sys(syst, [], energy, args,
+                                       check_hermiticity, params=params)[0]
+        num_orb = linsys.num_orb
+        lhs = linsys.lhs.tocsr()
+
+        # Eliminate the variables of the lead modes.  This adds the
+        # self-energies of the leads to the Hamiltonian minus the energy.  The
+        # variables of different leads are not coupled to each other, so
+        # every lead can be eliminated on its own.
+        ham = lhs[:num_orb, :num_orb]
+        lead_block = abs(lhs[num_orb:, num_orb:])
+        num_leads, which = csgraph.connected_components(lead_block)
+        seeds = []
+        for i in range(num_leads):
+            indices = num_orb + np.flatnonzero(which == i)
+            to_lead = lhs[:num_orb, indices]
+            from_lead = lhs[indices, :num_orb]
+            rows = np.flatnonzero(np.diff(to_lead.indptr))
+            cols = np.unique(from_lead.indices)
+            sigma = -(to_lead[rows].toarray().dot(
+                np.linalg.solve(_block(lhs, indices, indices),
+                                from_lead[:, cols].toarray())))
+            seeds.append(rows)
+            rows, cols = np.meshgrid(rows, cols, indexing='ij')
+            sigma = sp.csr_matrix((sigma.ravel(), (rows.ravel(), cols.ravel())),
+                                  shape=ham.shape)
+            ham = ham + sigma
+        return ham, seeds
+
+    def _selected_inverse(self, a, seeds):
+        """Return the entries of the inverse of 'a' in its sparsity pattern.
+
+        The diagonal is always included.  Indices that are not reached from
+        the 'seeds' (see `layers`) are left out.
+        """
+        shape = a.shape
+        slices = layers(a, seeds)
+        order = np.concatenate(slices) if slices else np.zeros(0, int)
+        a, position, offsets = _layer_order(a, slices)
+        num_layers = len(slices)
+
+        # The entries, in the order of the layers, grouped by the pair of
+        # layers of their row and column.
+        pattern = (a + sp.identity(a.shape[0], format='csr')).tocoo()
+        rows, cols = pattern.row, pattern.col
+        data = np.zeros(len(rows), complex)
+        row_layer = np.searchsorted(offsets, rows, 'right') - 1
+        col_layer = np.searchsorted(offsets, cols, 'right') - 1
+        key = 3 * row_layer + col_layer - row_layer + 1
+        order_of_entries = np.argsort(key, kind='mergesort')
+        bounds = np.searchsorted(key[order_of_entries],
+                                 np.arange(3 * num_layers + 1))
+
+        def fill(k, offset, block):
+            which = order_of_entries[bounds[3 * k + offset + 1]:
+                                     bounds[3 * k + offset + 2]]
+            data[which] = block[rows[which] - offsets[k],
+                                cols[which] - offsets[k + offset]]
+
+        def layer(k):
+            return offsets[k], offsets[k + 1]
+
+        # Forward sweep: inverses of the layers connected to the left.
+        left = []
+        for k in range(num_layers):
+            m = _slice_block(a, layer(k), layer(k))
+            if k:
+                m = m - (_slice_block(a, layer(k), layer(k - 1))
+                         .dot(left[-1])
+                         .dot(_slice_block(a, layer(k - 1), layer(k))))
+            left.append(np.linalg.inv(m))
+
+        # Backward sweep: the diagonal and off-diagonal blocks of the full
+        # inverse, following Takahashi's recursion.
+        if num_layers:
+            inv = left.pop()
+            fill(num_layers - 1, 0, inv)
+        for k in range(num_layers - 2, -1, -1):
+            g = left.pop()
+            a_kn = _slice_block(a, layer(k), layer(k + 1))
+            a_nk = _slice_block(a, layer(k + 1), layer(k))
+            upper = -g.dot(a_kn).dot(inv)
+            lower = -inv.dot(a_nk).dot(g)
+            inv = g - upper.dot(a_nk).dot(g)
+            fill(k, 0, inv)
+            fill(k, 1, upper)
+            fill(k + 1, -1, lower)
+
+        result = sp.csr_matrix((data, (order[rows], order[cols])),
+                               shape=shape)
+        result.eliminate_zeros()
+        return result
+
+    def _ldos(self, syst, energy, args, check_hermiticity, params):
+        ham, seeds = self._open_hamiltonian(syst, energy, args,
+                                            check_hermiticity, params)
+        # 'ham' is minus the inverse of the retarded Green's function.
+        inverse = self._selected_inverse(ham, seeds)
+        return inverse.diagonal().imag / np.pi
+
+    def wave_function(self, sys, energy=0, args=(), check_hermiticity=True,
+                      *, params=None):
+        """Not provided by the RGF solver.
+
+        Raises
+        ------
+        TypeError
+        """
+        raise TypeError("The RGF solver does not compute wave functions.")
+
+    def perturbation_solver(self, sys, energy=0, args=(), out_leads=None,
+                            in_leads=None, check_hermiticity=True, *,
+                            params=None):
+        """Not provided by the RGF solver.
+
+        Raises
+        ------
+        TypeError
+        """
+        raise TypeError("The RGF solver does not provide a perturbation "
+                        "solver.")
+
+
+default_solver = Solver()
+
+smatrix = default_solver.smatrix
+greens_function = default_solver.greens_function
+ldos = default_solver.ldos
+smatrix_batch = default_solver.smatrix_batch
+greens_function_batch = default_solver.greens_function_batch
+ldos_batch = default_solver.ldos_batch
+selected_greens_function = default_solver.selected_greens_function
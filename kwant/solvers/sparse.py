@@ -6,7 +6,9 @@
 # the file AUTHORS.rst at the top-level directory of this distribution and at
 # http://kwant-project.org/authors.
 
-__all__ = ['smatrix', 'greens_function', 'ldos', 'wave_function', 'Solver']
+__all__ = ['smatrix', 'greens_function', 'ldos', 'wave_function',
+           'smatrix_batch', 'greens_function_batch', 'ldos_batch',
+           'smatrix_ensemble', 'perturbation_solver', 'Solver']
 
 import numpy as np
 import scipy.sparse as sp
@@ -113,3 +115,8 @@ smatrix = default_solver.smatrix
 greens_function = default_solver.greens_function
 ldos = default_solver.ldos
 wave_function = default_solver.wave_function
+smatrix_batch = default_solver.smatrix_batch
+greens_function_batch = default_solver.greens_function_batch
+ldos_batch = default_solver.ldos_batch
+smatrix_ensemble = default_solver.smatrix_ensemble
+perturbation_solver = default_solver.perturbation_solver
@@ -8,6 +8,7 @@
 
 
 from math import cos, sin
+from itertools import product
 import numpy as np
 from pytest import raises
 from numpy.testing import assert_almost_equal
@@ -539,3 +540,270 @@ def test_arg_passing(wave_function, ldos, smatrix):
     np.testing.assert_array_equal(
         smatrix(fsyst, args=args).data,
         smatrix(fsyst, params=params).data)
+
+
+# Module level such that the system can be sent to worker processes.
+def _batch_onsite(site, V):
+    return 4 + V * site.pos[1]
+
+
+def _batch_hopping(site1, site2, t):
+    return -t
+
+
+def test_batch(smatrix, greens_function, ldos, smatrix_batch,
+               greens_function_batch, ldos_batch):
+    syst = kwant.Builder()
+    syst[(square(i, j) for i in range(4) for j in range(3))] = _batch_onsite
+    syst[square.neighbors()] = _batch_hopping
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(square(0, j) for j in range(3))] = 4
+    lead[square.neighbors()] = -1
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    fsyst = syst.finalized()
+
+    energies = [0.5, 1, 1.5, 2, 2.5]
+    params_list = [dict(V=0.1 * i, t=1) for i in range(len(energies))]
+
+    def check_blocks(batch, results):
+        assert len(batch) == len(results)
+        for k, result in enumerate(results):
+            assert_almost_equal(batch.matrix(k), result.data)
+            for i, j in product(batch.out_leads, batch.in_leads):
+                assert_almost_equal(batch.submatrix(k, i, j),
+                                    result.submatrix(i, j))
+                assert_almost_equal(batch.transmissions[k, i, j],
+                                    result.transmission(i, j))
+            assert_almost_equal(batch.conductance_matrix()[k],
+                                result.conductance_matrix())
+
+    for kwargs in [{}, dict(workers=2), dict(workers=2, threads=True)]:
+        batch = smatrix_batch(fsyst, energies, params_list, **kwargs)
+        check_blocks(batch, [smatrix(fsyst, e, params=p)
+                             for e, p in zip(energies, params_list)])
+        assert_almost_equal(batch.transmission(1, 0),
+                            [smatrix(fsyst, e, params=p).transmission(1, 0)
+                             for e, p in zip(energies, params_list)])
+
+        batch = greens_function_batch(fsyst, energies, params_list, **kwargs)
+        check_blocks(batch, [greens_function(fsyst, e, params=p)
+                             for e, p in zip(energies, params_list)])
+
+        result = ldos_batch(fsyst, energies, params_list, **kwargs)
+        assert_almost_equal(result, [ldos(fsyst, e, params=p)
+                                     for e, p in zip(energies, params_list)])
+
+    # A single dict of parameters is used for all energies, and a single
+    # energy for all parameters.
+    params = dict(V=0.2, t=1)
+    batch = smatrix_batch(fsyst, energies, params)
+    check_blocks(batch, [smatrix(fsyst, e, params=params) for e in energies])
+    batch = smatrix_batch(fsyst, 1, params_list)
+    check_blocks(batch, [smatrix(fsyst, 1, params=p) for p in params_list])
+    raises(ValueError, smatrix_batch, fsyst, energies, params_list[:2])
+
+    # Only some of the leads, without deducing the missing transmissions.
+    batch = smatrix_batch(fsyst, energies, params, out_leads=[1],
+                          in_leads=[0], check_hermiticity=False)
+    results = [smatrix(fsyst, e, params=params, out_leads=[1], in_leads=[0],
+                       check_hermiticity=False)
+               for e in energies]
+    for k, result in enumerate(results):
+        assert_almost_equal(batch.matrix(k), result.data)
+        assert_almost_equal(batch.transmission(1, 0)[k],
+                            result.transmission(1, 0))
+    assert np.all(np.isnan(batch.transmissions[:, 0, 1]))
+    raises(ValueError, batch.transmission, 0, 1)
+
+
+def test_eliminate_interior(smatrix, greens_function, solver):
+    syst = kwant.Builder()
+    syst[(square(i, j) for i in range(6) for j in range(4))] = (
+        lambda site, V: 4 + V * site.pos[0])
+    syst[square.neighbors()] = -1
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(square(0, j) for j in range(4))] = lambda site, V_lead: 4 + V_lead
+    lead[square.neighbors()] = -1
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    lead = kwant.Builder(kwant.TranslationalSymmetry((0, 1)))
+    lead[(square(i, 0) for i in range(2, 4))] = 4
+    lead[square.neighbors()] = -1
+    syst.attach_lead(lead)
+    fsyst = syst.finalized()
+
+    def check(energy, params):
+        for out_leads, in_leads in [(None, None), ([1], [0]), ([0, 2], [1])]:
+            kwargs = dict(params=params, out_leads=out_leads,
+                          in_leads=in_leads)
+            assert_almost_equal(solver.smatrix(fsyst, energy, **kwargs).data,
+                                smatrix(fsyst, energy, **kwargs).data)
+            assert_almost_equal(
+                solver.greens_function(fsyst, energy, **kwargs).data,
+                greens_function(fsyst, energy, **kwargs).data)
+        return solver._interior_elimination[-1]
+
+    elimination = check(1.0, dict(V=0.1, V_lead=0))
+    # Changing only the leads reuses the elimination of the interior.
+    assert check(1.0, dict(V=0.1, V_lead=0.2)) is elimination
+    # Changing the energy or the scattering region does not.
+    assert check(1.2, dict(V=0.1, V_lead=0.2)) is not elimination
+    elimination = check(1.2, dict(V=0.2, V_lead=0.2))
+    assert check(1.2, dict(V=0.2, V_lead=0.2)) is elimination
+
+
+def test_memory_budget(wave_function, ldos, solver):
+    syst = kwant.Builder()
+    syst[(square(i, j) for i in range(5) for j in range(6))] = 4
+    syst[square.neighbors()] = -1
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(square(0, j) for j in range(6))] = 4
+    lead[square.neighbors()] = -1
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    fsyst = syst.finalized()
+    num_vars = fsyst.graph.num_nodes + 2 * 6
+
+    # A budget for about two columns of the solution.
+    solver.memory_budget = 2 * 3 * 16 * num_vars
+    assert solver._chunk_width(num_vars) == 2
+    assert solver._chunk_width(2 * num_vars) == 1
+
+    energy = 3
+    assert_almost_equal(solver.ldos(fsyst, energy), ldos(fsyst, energy))
+    wf = wave_function(fsyst, energy)
+    wf_chunked = solver.wave_function(fsyst, energy)
+    for lead in range(2):
+        chunks = list(wf_chunked.chunks(lead))
+        assert len(chunks) == (len(wf(lead)) + 1) // 2 > 1
+        assert all(len(chunk) <= 2 for chunk in chunks)
+        assert_almost_equal(np.concatenate(chunks), wf(lead))
+
+
+def test_perturbation_solver(smatrix, greens_function, perturbation_solver):
+    syst = kwant.Builder()
+    syst[(square(i, j) for i in range(5) for j in range(4))] = 4
+    syst[square(2, 1)] = syst[square(3, 2)] = lambda site, V: 4 + V
+    syst[square.neighbors()] = -1
+    syst[square(2, 1), square(3, 1)] = lambda site1, site2, t: -t
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(square(0, j) for j in range(4))] = 4
+    lead[square.neighbors()] = -1
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    fsyst = syst.finalized()
+
+    energy = 1.3
+    reference = dict(V=0, t=1)
+    for out_leads, in_leads in [(None, None), ([1], [0])]:
+        kwargs = dict(out_leads=out_leads, in_leads=in_leads)
+        solver = perturbation_solver(fsyst, energy, params=reference,
+                                     **kwargs)
+        for params, num_orbs in [(dict(V=0.7, t=1), 2),
+                                 (dict(V=-0.3, t=1.5), 3), (reference, 0)]:
+            orbitals, delta = solver.perturbation(params=params)
+            assert len(orbitals) == num_orbs
+            assert_almost_equal(
+                solver.smatrix(orbitals, delta).data,
+                smatrix(fsyst, energy, params=params, **kwargs).data)
+            assert_almost_equal(
+                solver.greens_function(orbitals, delta).data,
+                greens_function(fsyst, energy, params=params, **kwargs).data)
+
+    # An explicitly given perturbation.
+    solver = perturbation_solver(fsyst, energy, params=reference)
+    i = fsyst.id_by_site[square(2, 1)]
+    j = fsyst.id_by_site[square(3, 2)]
+    assert_almost_equal(solver.smatrix([j, i], np.diag([0.5, 0.5])).data,
+                        smatrix(fsyst, energy, params=dict(V=0.5, t=1)).data)
+
+    raises(ValueError, solver.smatrix, [i], [[0.5, 0]])
+    raises(ValueError, solver.smatrix, [i, i], np.zeros((2, 2)))
+    raises(ValueError, solver.smatrix, [fsyst.graph.num_nodes], [[0.5]])
+    raises(ValueError, solver.smatrix, [i, i + 1], [[0, 1], [2, 0]])
+    solver = perturbation_solver(fsyst, energy, params=reference,
+                                 check_hermiticity=False)
+    solver.smatrix([i, i + 1], [[0, 1], [2, 0]])
+
+
+# Module level such that they can be sent to worker processes.
+def _ensemble_onsite(site, W, salt):
+    return 4 + W * (kwant.digest.uniform(repr(site), salt) - 0.5)
+
+
+def _ensemble_observable(smatrix):
+    return [smatrix.transmission(1, 0), smatrix.transmission(0, 0)]
+
+
+def test_smatrix_ensemble(smatrix, smatrix_ensemble):
+    syst = kwant.Builder()
+    syst[(square(i, j) for i in range(4) for j in range(3))] = _ensemble_onsite
+    syst[square.neighbors()] = -1
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(square(0, j) for j in range(3))] = 4
+    lead[square.neighbors()] = -1
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    fsyst = syst.finalized()
+
+    energy = 1.5
+    params = dict(W=2)
+    salts = [str(k) for k in range(7)]
+    values = np.array([_ensemble_observable(
+        smatrix(fsyst, energy, params=dict(params, salt=salt)))
+                       for salt in salts])
+    counts = np.array([np.histogram(v, bins=4, range=(0, 2))[0]
+                       for v in values.T])
+
+    for kwargs in [{}, dict(workers=2), dict(workers=3, threads=True),
+                   dict(cache_leads=True),
+                   dict(workers=2, cache_leads=True)]:
+        result = smatrix_ensemble(fsyst, energy, 7, _ensemble_observable,
+                                  params, bins=4, hist_range=(0, 2),
+                                  keep_values=True, **kwargs)
+        assert result.salts == salts
+        assert len(result) == 7
+        assert_almost_equal(result.values, values)
+        assert_almost_equal(result.mean, values.mean(axis=0))
+        assert_almost_equal(result.variance, values.var(axis=0, ddof=1))
+        assert_almost_equal(result.std_error,
+                            np.sqrt(values.var(axis=0, ddof=1) / 7))
+        np.testing.assert_array_equal(result.histogram, counts)
+    # The leads are left as they were.
+    assert all(lead.cache_bytes == 0 for lead in fsyst.leads)
+    assert all('_cache' not in vars(lead) for lead in fsyst.leads)
+
+    # Caching of the leads is only enabled on request, and leads that are
+    # cached already keep their own setting.
+    def cache_bytes(smatrix):
+        return [lead.cache_bytes for lead in fsyst.leads]
+
+    result = smatrix_ensemble(fsyst, energy, 2, cache_bytes, params)
+    assert_almost_equal(result.mean, [0, 0])
+    fsyst.leads[0].cache_bytes = 2**20
+    result = smatrix_ensemble(fsyst, energy, 2, cache_bytes, params,
+                              cache_leads=True)
+    assert result.mean[0] == 2**20
+    assert result.mean[1] > 0
+    assert fsyst.leads[0].cache_bytes == 2**20
+    assert len(fsyst.leads[0]._cache)
+    assert fsyst.leads[1].cache_bytes == 0
+    del fsyst.leads[0].cache_bytes
+
+    # A scalar observable, given salts, and no histogram.
+    result = smatrix_ensemble(fsyst, energy, ['a', 'b'],
+                              lambda s: s.transmission(1, 0), params)
+    assert result.histogram is result.values is None
+    assert_almost_equal(result.mean, np.mean(
+        [smatrix(fsyst, energy, params=dict(W=2, salt=salt))
+         .transmission(1, 0) for salt in 'ab']))
+    assert np.isnan(smatrix_ensemble(fsyst, energy, 1, _ensemble_observable,
+                                     params).variance).all()
+
+    raises(ValueError, smatrix_ensemble, fsyst, energy, 2,
+           _ensemble_observable, dict(W=2, salt='0'))
+    raises(ValueError, smatrix_ensemble, fsyst, energy, 2,
+           _ensemble_observable, params, bins=3)
+    raises(ValueError, smatrix_ensemble, fsyst, energy, 2,
+           _ensemble_observable, params, bins=[1, 0])
@@ -7,9 +7,13 @@
 # http://kwant-project.org/authors.
 
 import pytest
+import numpy as np
+import kwant
 try:
     from kwant.solvers.mumps import (
-        smatrix, greens_function, ldos, wave_function, options, reset_options)
+        smatrix, greens_function, ldos, wave_function, options, reset_options,
+        smatrix_batch, greens_function_batch, ldos_batch, default_solver,
+        smatrix_ensemble, perturbation_solver, Solver)
     from . import _test_sparse
     no_mumps = False
 except ImportError:
@@ -22,7 +26,9 @@ opt_list=[{},
           {'nrhs' : 10},
           {'nrhs' : 1, 'ordering' : 'amd'},
           {'nrhs' : 10, 'sparse_rhs' : True},
-          {'nrhs' : 2, 'ordering' : 'amd', 'sparse_rhs' : True}]
+          {'nrhs' : 2, 'ordering' : 'amd', 'sparse_rhs' : True},
+          {'reuse_analysis' : False},
+          {'eliminate_interior' : True}]
 
 
 def test_output():
@@ -116,3 +122,74 @@ def test_wavefunc_ldos_consistency():
 
 def test_arg_passing():
     _test_sparse.test_arg_passing(wave_function, ldos, smatrix)
+
+
+def test_batch():
+    for opts in opt_list:
+        reset_options()
+        options(**opts)
+        _test_sparse.test_batch(smatrix, greens_function, ldos, smatrix_batch,
+                                greens_function_batch, ldos_batch)
+
+
+def test_smatrix_ensemble():
+    for opts in opt_list:
+        reset_options()
+        options(**opts)
+        _test_sparse.test_smatrix_ensemble(smatrix, smatrix_ensemble)
+
+
+def test_perturbation_solver():
+    for opts in opt_list:
+        reset_options()
+        options(**opts)
+        _test_sparse.test_perturbation_solver(smatrix, greens_function,
+                                              perturbation_solver)
+
+
+def test_reuse_analysis():
+    syst = kwant.Builder()
+    lat = kwant.lattice.square()
+    syst[(lat(x, y) for x in range(5) for y in range(4))] = 4
+    syst[lat.neighbors()] = -1
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(lat(0, y) for y in range(4))] = 4
+    lead[lat.neighbors()] = -1
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    fsyst = syst.finalized()
+    energies = [0.5, 0.6, 0.7, 1.5]
+
+    reset_options()
+    options(reuse_analysis=False)
+    expected = [smatrix(fsyst, e).data for e in energies]
+    expected_wf = wave_function(fsyst, 0.5)(0)
+
+    reset_options()
+    # Keep a factorization alive while other energies are solved.
+    wf = wave_function(fsyst, 0.5)
+    for e, s in zip(energies, expected):
+        np.testing.assert_almost_equal(smatrix(fsyst, e).data, s)
+    np.testing.assert_almost_equal(wf(0), expected_wf)
+    del wf
+
+    num_idle = sum(len(contexts) for contexts
+                   in default_solver._idle_contexts.values())
+    assert 0 < num_idle <= default_solver.max_cached_contexts
+    reset_options()
+
+
+def test_eliminate_interior():
+    reset_options()
+    solver = Solver()
+    solver.options(eliminate_interior=True)
+    _test_sparse.test_eliminate_interior(smatrix, greens_function, solver)
+
+
+def test_memory_budget():
+    reset_options()
+    solver = Solver()
+    _test_sparse.test_memory_budget(wave_function, ldos, solver)
+    solver.options(memory_budget=float('inf'))
+    assert solver._chunk_width(1000) == solver.nrhs
+    pytest.raises(ValueError, solver.options, memory_budget=0)
@@ -0,0 +1,160 @@
+# Copyright 2011-2018 Kwant authors.
+#
+# This file is part of Kwant.  It is subject to the license terms in the file
+# LICENSE.rst found in the top-level directory of this distribution and at
+# http://kwant-project.org/license.  A list of Kwant authors can be found in
+# the file AUTHORS.rst at the top-level directory of this distribution and at
+# http://kwant-project.org/authors.
+
+import numpy as np
+from pytest import raises
+from numpy.testing import assert_almost_equal
+import kwant
+from kwant._common import ensure_rng
+from kwant.solvers.rgf import (smatrix, greens_function, ldos, smatrix_batch,
+                               greens_function_batch, ldos_batch,
+                               selected_greens_function, layers)
+from kwant.solvers import sparse
+from . import _test_sparse
+
+
+def test_output():
+    _test_sparse.test_output(smatrix)
+
+
+def test_one_lead():
+    _test_sparse.test_one_lead(smatrix)
+
+
+def test_smatrix_shape():
+    _test_sparse.test_smatrix_shape(smatrix)
+
+
+def test_two_equal_leads():
+    _test_sparse.test_two_equal_leads(smatrix)
+
+
+def test_graph_system():
+    _test_sparse.test_graph_system(smatrix)
+
+
+def test_singular_graph_system():
+    _test_sparse.test_singular_graph_system(smatrix)
+
+
+def test_tricky_singular_hopping():
+    _test_sparse.test_tricky_singular_hopping(smatrix)
+
+
+def test_many_leads():
+    _test_sparse.test_many_leads(greens_function, smatrix)
+
+
+def test_selfenergy():
+    _test_sparse.test_selfenergy(greens_function, smatrix)
+
+
+def test_selfenergy_reflection():
+    _test_sparse.test_selfenergy_reflection(greens_function, smatrix)
+
+
+def test_very_singular_leads():
+    _test_sparse.test_very_singular_leads(smatrix)
+
+
+def test_ldos():
+    _test_sparse.test_ldos(ldos)
+
+
+def test_batch():
+    _test_sparse.test_batch(smatrix, greens_function, ldos, smatrix_batch,
+                            greens_function_batch, ldos_batch)
+
+
+def test_layers():
+    lat = kwant.lattice.square()
+    syst = kwant.Builder()
+    syst[(lat(x, y) for x in range(30) for y in range(10))] = 4
+    syst[lat.neighbors()] = -1
+    # A site that is not connected to the rest.
+    syst[lat(15, 10)] = 4
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(lat(0, y) for y in range(10))] = 4
+    lead[lat.neighbors()] = -1
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    fsyst = syst.finalized()
+    ham = fsyst.hamiltonian_submatrix(sparse=True)
+
+    slices = layers(ham, [fsyst.lead_interfaces[0]])
+    sites = np.concatenate(slices)
+    assert len(sites) == len(np.unique(sites)) == fsyst.graph.num_nodes - 1
+    # The layers are the cross sections of the wire, and only neighboring
+    # layers are coupled.
+    assert len(slices) == 30
+    assert all(len(layer) == 10 for layer in slices)
+    position = np.empty(fsyst.graph.num_nodes, int)
+    for k, layer in enumerate(slices):
+        position[layer] = k
+    ham = ham.tocoo()
+    connected = ham.row != fsyst.id_by_site[lat(15, 10)]
+    assert np.all(abs(position[ham.row[connected]] -
+                      position[ham.col[connected]]) <= 1)
+
+    # The solver handles the long wire and the isolated site.
+    for energy in [0.5, 1.5]:
+        assert_almost_equal(smatrix(fsyst, energy).data,
+                            sparse.smatrix(fsyst, energy).data)
+        assert_almost_equal(ldos(fsyst, energy),
+                            sparse.ldos(fsyst, energy))
+
+    # A single orbital as a seed starts the search from that orbital only.
+    slices = layers(ham, fsyst.lead_interfaces[0][:1])
+    assert len(slices) == 39
+    assert len(np.concatenate(slices)) == fsyst.graph.num_nodes - 1
+
+    # Methods that need the factorization of the full system fail early.
+    solver = kwant.solvers.rgf.default_solver
+    raises(TypeError, solver.wave_function, fsyst, 1)
+    raises(TypeError, solver.perturbation_solver, fsyst, 1)
+
+
+def test_selected_greens_function():
+    lat = kwant.lattice.square(norbs=2)
+    rng = ensure_rng(5)
+
+    syst = kwant.Builder()
+    for site in (lat(x, y) for x in range(8) for y in range(3)):
+        h = rng.random_sample((2, 2)) + 1j * rng.random_sample((2, 2))
+        syst[site] = 4 * np.identity(2) + h + h.conjugate().transpose()
+    syst[lat.neighbors()] = -np.identity(2)
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(lat(0, y) for y in range(3))] = 4 * np.identity(2)
+    lead[lat.neighbors()] = -np.identity(2)
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    fsyst = syst.finalized()
+    ham = fsyst.hamiltonian_submatrix()
+
+    def check(fsyst, energy, h_eff):
+        # The entries in the pattern of the Hamiltonian with self-energies.
+        pattern = (h_eff != 0) | np.identity(len(h_eff), bool)
+        dense = np.linalg.inv(energy * np.identity(len(h_eff)) - h_eff)
+        selected = selected_greens_function(fsyst, energy).toarray()
+        assert_almost_equal(selected[pattern], dense[pattern])
+        assert not np.any(selected[~pattern])
+
+    energy = 1.3
+    h_eff = ham.astype(complex)
+    for lead, interface in zip(fsyst.leads, fsyst.lead_interfaces):
+        orbs = np.concatenate([np.arange(2 * i, 2 * i + 2)
+                               for i in interface])
+        h_eff[np.ix_(orbs, orbs)] += lead.selfenergy(energy)
+    check(fsyst, energy, h_eff)
+    assert_almost_equal(ldos(fsyst, energy), sparse.ldos(fsyst, energy))
+
+    # Closed systems at complex energy.
+    fsyst = syst.finalized()
+    fsyst.leads = fsyst.lead_interfaces = []
+    energy = 1.3 + 0.1j
+    check(fsyst, energy, ham)
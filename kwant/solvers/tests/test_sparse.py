@@ -6,7 +6,11 @@
 # the file AUTHORS.rst at the top-level directory of this distribution and at
 # http://kwant-project.org/authors.
 
-from  kwant.solvers.sparse import smatrix, greens_function, ldos, wave_function
+from  kwant.solvers.sparse import (smatrix, greens_function, ldos,
+                                  wave_function, smatrix_batch,
+                                  greens_function_batch, ldos_batch,
+                                  smatrix_ensemble, perturbation_solver,
+                                  Solver)
 from . import _test_sparse
 
 def test_output():
@@ -62,3 +66,32 @@ def test_wavefunc_ldos_consistency():
 
 def test_arg_passing():
     _test_sparse.test_arg_passing(wave_function, ldos, smatrix)
+
+
+def test_batch():
+    _test_sparse.test_batch(smatrix, greens_function, ldos, smatrix_batch,
+                            greens_function_batch, ldos_batch)
+
+
+def test_smatrix_ensemble():
+    _test_sparse.test_smatrix_ensemble(smatrix, smatrix_ensemble)
+
+
+def test_perturbation_solver():
+    _test_sparse.test_perturbation_solver(smatrix, greens_function,
+                                          perturbation_solver)
+
+
+def test_eliminate_interior():
+    solver = Solver()
+    solver.eliminate_interior = True
+    _test_sparse.test_eliminate_interior(smatrix, greens_function, solver)
+    _test_sparse.test_output(solver.smatrix)
+    _test_sparse.test_two_equal_leads(solver.smatrix)
+    _test_sparse.test_graph_system(solver.smatrix)
+    _test_sparse.test_many_leads(solver.greens_function, solver.smatrix)
+    _test_sparse.test_selfenergy(solver.greens_function, solver.smatrix)
+
+
+def test_memory_budget():
+    _test_sparse.test_memory_budget(wave_function, ldos, Solver())
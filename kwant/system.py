@@ -12,7 +12,9 @@ __all__ = ['System', 'FiniteSystem', 'InfiniteSystem']
 
 import abc
 from copy import copy
+import numpy as np
 from . import _system
+from ._common import LRUCache
 
 
 class System(metaclass=abc.ABCMeta):
@@ -164,6 +166,27 @@ class FiniteSystem(System, metaclass=abc.ABCMeta):
         return result
 
 
+    def _hamiltonian_csc(self, args=(), *, params=None, energy=0):
+        """Return the Hamiltonian minus ``energy`` as a CSC matrix.
+
+        The numbers of orbitals of the sites are returned as well.  The
+        sparsity pattern of the Hamiltonian and the mapping of its entries to
+        the CSC data array are computed on the first call and stored on the
+        system, later calls only fill the data array.  Unlike
+        ``hamiltonian_submatrix``, the matrix keeps explicitly stored zeros,
+        such that its sparsity pattern does not depend on the parameters.
+        """
+        return _system.hamiltonian_csc(self, args, params, energy)
+
+
+def _equal_projectors(a, b):
+    """Return whether two sequences of projectors (or None) are equal."""
+    if a is None or b is None:
+        return a is b
+    return len(a) == len(b) and all(
+        p.shape == q.shape and not (p != q).sum() for p, q in zip(a, b))
+
+
 class InfiniteSystem(System, metaclass=abc.ABCMeta):
     """Abstract infinite low-level system.
 
@@ -174,6 +197,13 @@ class InfiniteSystem(System, metaclass=abc.ABCMeta):
     ----------
     cell_size : integer
         The number of sites in a single cell of the system.
+    cache_bytes : integer
+        The maximal memory in bytes used for caching the results of `modes`
+        and `selfenergy` for different energies and parameter values.  The
+        least recently used results are dropped first.  Defaults to zero,
+        which disables caching.  Caching may only be enabled if the
+        Hamiltonian depends on nothing but the energy and the parameters
+        (e.g. not on global variables used in value functions).
 
     Notes
     -----
@@ -219,6 +249,8 @@ class InfiniteSystem(System, metaclass=abc.ABCMeta):
         return self.hamiltonian_submatrix(args, cell_sites, interface_sites,
                                           sparse=sparse, params=params)
 
+    cache_bytes = 0
+
     def modes(self, energy=0, args=(), *, params=None):
         """Return mode decomposition of the lead
 
@@ -230,7 +262,12 @@ class InfiniteSystem(System, metaclass=abc.ABCMeta):
         freedom on the first ``cell_sites`` sites of the system
         (recall that infinite systems store first the sites in the unit
         cell, then connected sites in the neighboring unit cell).
+
+        The results may be cached, see ``cache_bytes``.
         """
+        return self._cached('modes', self._modes, energy, args, params)
+
+    def _modes(self, energy, args, params):
         from . import physics   # Putting this here avoids a circular import.
         ham = self.cell_hamiltonian(args, params=params)
         hop = self.inter_cell_hopping(args, params=params)
@@ -247,10 +284,32 @@ class InfiniteSystem(System, metaclass=abc.ABCMeta):
         # Subtract energy from the diagonal.
         ham.flat[::ham.shape[0] + 1] -= energy
 
+        hop_svds = self._hopping_svds(hop, symmetries.projectors)
+
         # Particle-hole and chiral symmetries only apply at zero energy.
         if energy:
             symmetries.particle_hole = symmetries.chiral = None
-        return physics.modes(ham, hop, discrete_symmetry=symmetries)
+        return physics.modes(ham, hop, discrete_symmetry=symmetries,
+                             hop_svds=hop_svds)
+
+    def _hopping_svds(self, hop, projectors):
+        """Return the decompositions of the inter-cell hopping 'hop'.
+
+        The decompositions (see `kwant.physics.leads.hopping_svds`) do not
+        depend on the energy.  The last ones are stored on the system and
+        reused as long as the hopping and the projectors of the conservation
+        law do not change, such that an energy sweep computes them only once.
+        Unlike the results of `modes`, they are checked against the matrices
+        themselves, so this does not depend on ``cache_bytes``.
+        """
+        from . import physics   # Putting this here avoids a circular import.
+        last = getattr(self, '_last_hopping_svds', None)
+        if (last is not None and np.array_equal(last[0], hop)
+            and _equal_projectors(last[1], projectors)):
+            return last[2]
+        svds = physics.leads.hopping_svds(hop, projectors)
+        self._last_hopping_svds = (hop.copy(), projectors, svds)
+        return svds
 
     def selfenergy(self, energy=0, args=(), *, params=None):
         """Return self-energy of a lead.
@@ -258,7 +317,13 @@ class InfiniteSystem(System, metaclass=abc.ABCMeta):
         The returned matrix has the shape (s, s), where s is
         ``sum(len(self.hamiltonian(i, i)) for i in range(self.graph.num_nodes -
         self.cell_size))``.
+
+        The results may be cached, see ``cache_bytes``.
         """
+        return self._cached('selfenergy', self._selfenergy, energy, args,
+                           params)
+
+    def _selfenergy(self, energy, args, params):
         from . import physics   # Putting this here avoids a circular import.
         ham = self.cell_hamiltonian(args, params=params)
         shape = ham.shape
@@ -269,6 +334,35 @@ class InfiniteSystem(System, metaclass=abc.ABCMeta):
         return physics.selfenergy(ham,
                                   self.inter_cell_hopping(args, params=params))
 
+    def _cached(self, what, compute, energy, args, params):
+        """Return ``compute(energy, args, params)``, cached.
+
+        The results are kept in a least-recently-used cache whose size is
+        bounded by ``cache_bytes``.  They are looked up by 'what', the
+        energy, 'args', and the parameters returned by `_relevant_params`.
+        Results for parameter values that are not hashable are not cached.
+        """
+        if not self.cache_bytes:
+            return compute(energy, args, params)
+        cache = self.__dict__.get('_cache')
+        if cache is None:
+            cache = self._cache = LRUCache(self.cache_bytes)
+        cache.max_bytes = self.cache_bytes
+        if params is None:
+            key = (what, energy, tuple(args), None)
+        else:
+            relevant = self._relevant_params(params)
+            key = (what, energy, tuple(args),
+                   tuple(sorted(relevant.items())))
+        return cache.get(key, lambda: compute(energy, args, params))
+
+    def _relevant_params(self, params):
+        """Return the subset of 'params' on which the lead may depend.
+
+        By default all the parameters are considered relevant.
+        """
+        return params
+
 
 class PrecalculatedLead:
     def __init__(self, modes=None, selfenergy=None):
@@ -456,6 +456,129 @@ def test_finalization():
     raises(ValueError, lead.finalized)
 
 
+def test_compact_sites():
+    lat = kwant.lattice.honeycomb(norbs=1)
+    fam = builder.SimpleSiteFamily(name='strings', norbs=1)
+    fam2 = builder.SimpleSiteFamily(name='tuples', norbs=1)
+    syst = builder.Builder()
+    syst[lat.shape(lambda pos: np.linalg.norm(pos) < 20, (0, 0))] = 0
+    syst[lat.neighbors()] = -1
+    syst[fam('a')] = syst[fam2(1, 2)] = 1
+    syst[fam('a'), lat.a(0, 0)] = -1
+    syst[lat.b(-50, 70)] = 0
+    fsyst = syst.finalized()
+    sites = tuple(sorted(syst.H))
+
+    assert len(fsyst.sites) == len(sites)
+    assert fsyst.sites == sites
+    assert fsyst.sites[-3:] == sites[-3:]
+    assert ({type(site.tag) for site in fsyst.sites} ==
+            {ta.ndarray_int, tuple})
+    check_id_by_site(fsyst)
+    assert fsyst.sites.index(lat.b(-50, 70)) == sites.index(lat.b(-50, 70))
+    del syst[fam('a')], syst[fam2(1, 2)]
+    lat_fsyst = syst.finalized()
+    assert_almost_equal(lat_fsyst.sites.positions,
+                        [site.pos for site in lat_fsyst.sites])
+
+    for site in [lat.a(30, 0), lat.b(-50, 71), fam('b'), fam2(1), 'foo']:
+        assert site not in fsyst.id_by_site
+        raises(KeyError, fsyst.id_by_site.__getitem__, site)
+    ids = fsyst.id_by_site.ids(lat.b, [(0, 0), (30, 0), (-50, 70)])
+    assert list(ids) == [fsyst.id_by_site[lat.b(0, 0)], -1,
+                         fsyst.id_by_site[lat.b(-50, 70)]]
+
+    # The sites are pickled as arrays.
+    fsyst2 = pickle.loads(pickle.dumps(fsyst))
+    assert fsyst2.sites == sites
+    check_id_by_site(fsyst2)
+    assert (len(pickle.dumps(fsyst.sites)) <
+            len(pickle.dumps(sites)) / 2)
+
+
+def test_refinalized():
+    lat = kwant.lattice.honeycomb(norbs=1)
+    fam = builder.SimpleSiteFamily(name='strings', norbs=1)
+
+    def onsite(site, t):
+        return t * site.pos[0]
+
+    def hopping(a, b, t):
+        return 1j * t
+
+    syst = builder.Builder()
+    syst[lat.shape(lambda pos: np.linalg.norm(pos) < 6, (0, 0))] = onsite
+    syst[lat.neighbors()] = builder.HermConjOfFunc(hopping)
+    lead = builder.Builder(kwant.TranslationalSymmetry(lat.vec((-1, 0))))
+    lead[lat.shape(lambda pos: abs(pos[1]) < 2, (0, 0))] = 1
+    lead[lat.neighbors()] = -1
+    syst.attach_lead(lead)
+
+    def check(fsyst, changed, old_fsyst):
+        ref = syst.finalized()
+        assert fsyst.sites == ref.sites
+        check_id_by_site(fsyst)
+        assert np.all(np.array(fsyst.graph.edge_arrays())
+                      == np.array(ref.graph.edge_arrays()))
+        assert fsyst.hoppings == ref.hoppings
+        assert fsyst.onsite_hamiltonians == ref.onsite_hamiltonians
+        assert fsyst.site_ranges == ref.site_ranges
+        assert all(np.all(a == b) for a, b in zip(fsyst.lead_interfaces,
+                                                   ref.lead_interfaces))
+        params = dict(t=2)
+        ham = fsyst.hamiltonian_submatrix(params=params)
+        assert_almost_equal(ham, ref.hamiltonian_submatrix(params=params))
+        # The rows of the sites that did not change are those of the old
+        # system.
+        old_ham = old_fsyst.hamiltonian_submatrix(params=params)
+        unchanged = np.ones(len(fsyst.sites), bool)
+        unchanged[changed] = False
+        for i in np.flatnonzero(unchanged):
+            j = old_fsyst.id_by_site[fsyst.sites[i]]
+            row = {site: x for site, x in zip(fsyst.sites, ham[i]) if x}
+            old_row = {site: x for site, x in zip(old_fsyst.sites, old_ham[j])
+                       if x}
+            assert row == old_row
+
+    fsyst = syst.finalized()
+    modifications = [
+        lambda: syst.__setitem__(lat.a(0, 0), 3),
+        lambda: syst.__delitem__(lat.b(1, 1)),
+        lambda: syst.__delitem__((lat.a(2, 0), lat.b(2, 0))),
+        lambda: syst.__setitem__(fam('x'), 1),
+        lambda: syst.__setitem__((fam('x'), lat.a(-1, 1)), 2),
+        lambda: syst.add_sites(lat.a, [(20, 0), (21, 0)], onsite),
+        lambda: syst.add_hoppings(lat.a, [(20, 0)], lat.a, [(21, 0)],
+                                  hopping),
+        lambda: syst.__setitem__(lat.neighbors(), -1),
+        lambda: syst.__delitem__([lat.a(20, 0), lat.a(21, 0), fam('x')])]
+    for modify in modifications:
+        modify()
+        new_fsyst, changed = syst.refinalized(fsyst)
+        assert len(changed) < len(new_fsyst.sites) or not len(changed)
+        check(new_fsyst, changed, fsyst)
+        fsyst = new_fsyst
+    changed = syst.refinalized(fsyst)[1]
+    assert len(changed) == 0
+
+    # Modifications that cannot be tracked lead to a full finalization.
+    old_fsyst = fsyst
+    template = builder.Builder(kwant.TranslationalSymmetry(
+        lat.vec((1, 0)), lat.vec((0, 1))))
+    template[lat.shape(lambda pos: True, (0, 0))] = 1
+    template[lat.neighbors()] = -1
+    syst.fill(template, lambda site: 30 < site.pos[0] < 40 and
+              abs(site.pos[1]) < 2, lat.a(31, 0))
+    fsyst, changed = syst.refinalized(fsyst)
+    assert np.all(changed == np.arange(len(fsyst.sites)))
+    check(fsyst, changed, old_fsyst)
+    syst[lat.a(0, 0)] = 1
+    fsyst, changed = syst.refinalized(old_fsyst)
+    assert np.all(changed == np.arange(len(fsyst.sites)))
+    check(fsyst, changed, old_fsyst)
+    assert len(syst.refinalized(fsyst)[1]) == 0
+
+
 def test_site_ranges():
     lat1a = kwant.lattice.chain(norbs=1, name='a')
     lat1b = kwant.lattice.chain(norbs=1, name='b')
@@ -640,6 +763,66 @@ def test_builder_with_symmetry():
                                                                   (5, 0, -3))])
 
 
+def test_bulk_assignment():
+    def graph(syst):
+        return {tail: (hvhv[1], set(zip(hvhv[2::2], hvhv[3::2])))
+                for tail, hvhv in syst.H.items()}
+
+    lat = kwant.lattice.kagome()
+    a, b, c = lat.sublattices
+    rng = ensure_rng(3)
+    tags = rng.randint(-5, 6, (60, 2))
+    for sym in [builder.NoSymmetry(),
+                kwant.TranslationalSymmetry(lat.vec((3, 0)))]:
+        syst0 = builder.Builder(sym)
+        syst1 = builder.Builder(sym)
+        for family, value in [(a, 1), (b, 2), (c, 3)]:
+            syst0[(family(*tag) for tag in tags)] = value
+            syst1.add_sites(family, tags, value)
+        # Overwrite some values.
+        syst0[(a(*tag) for tag in tags[:10])] = 7
+        syst1.add_sites(a, tags[:10], 7)
+        assert graph(syst0) == graph(syst1)
+
+        # Include hoppings that cross the boundary of the fundamental
+        # domain, and hoppings that are set twice.
+        deltas = [(0, 0), (1, 0), (-1, 1)]
+        for (fam_a, fam_b), delta in it.product([(a, b), (b, c), (c, a)],
+                                                deltas):
+            keep = np.array([fam_b(*(tag + delta)) in syst0 for tag in tags])
+            tags_a, tags_b = tags[keep], tags[keep] + delta
+            syst0[((fam_a(*x), fam_b(*y))
+                   for x, y in zip(tags_a, tags_b))] = 1j
+            syst1.add_hoppings(fam_a, tags_a, fam_b, tags_b, 1j)
+        syst0[builder.HoppingKind((1, 0), a, a)] = -1
+        hoppings = list(builder.HoppingKind((1, 0), a, a)(syst1))
+        syst1.add_hoppings(a, [h[0].tag for h in hoppings],
+                           a, [h[1].tag for h in hoppings], -1)
+        assert graph(syst0) == graph(syst1)
+        assert len(list(syst1.hoppings())) > 50
+
+        # Errors leave the builder unchanged.
+        before = graph(syst1)
+        with raises(KeyError):
+            syst1.add_hoppings(a, tags[:3], a, [(0, 0), (0, 1), (100, 0)], 2)
+        with raises(ValueError):
+            syst1.add_hoppings(a, tags[:3], a, tags[:3], 2)
+        with raises(ValueError):
+            syst1.add_hoppings(a, tags[:3], b, tags[:2], 2)
+        with raises(ValueError):
+            syst1.add_sites(a, [1, 2], 2)
+        with raises(TypeError):
+            syst1.add_sites(a, [(1.5, 2)], 2)
+        assert graph(syst1) == before
+
+    # Families whose tags are not tinyarrays are supported as well.
+    fam = builder.SimpleSiteFamily()
+    syst = builder.Builder()
+    syst.add_sites(fam, [(0,), (1,)], 1)
+    syst.add_hoppings(fam, [(0,)], fam, [(1,)], 2)
+    assert syst[fam(1), fam(0)] == 2
+
+
 def test_fill():
     g = kwant.lattice.square()
     sym_x = kwant.TranslationalSymmetry((-1, 0))
@@ -827,6 +1010,129 @@ def test_fill_sticky():
             == set(syst1.hopping_value_pairs()))
 
 
+def test_fill_vectorized():
+    def check_same(a, b):
+        assert set(a.site_value_pairs()) == set(b.site_value_pairs())
+        assert (set(a.hopping_value_pairs())
+                == set(b.hopping_value_pairs()))
+
+    # Shapes are written as functions of a single position.
+    def scalar(shape):
+        return lambda site: shape(site.pos)
+
+    def vectorized(shape):
+        return builder.Vectorized(
+            lambda positions: np.array([shape(p) for p in positions], bool))
+
+    # Template with several families and further neighbor hoppings.
+    lat = kwant.lattice.kagome()
+    template = kwant.Builder(kwant.TranslationalSymmetry(
+        lat.vec((1, 0)), lat.vec((0, 1))))
+    for i, sl in enumerate(lat.sublattices):
+        template[sl(0, 0)] = i
+    for i in range(1, 3):
+        for j, hop in enumerate(template.expand(lat.neighbors(i))):
+            template[hop] = j * 1j
+
+    def disk(pos):
+        return ta.dot(pos, pos) < 13
+
+    def halfplane(pos):
+        return ta.dot(pos - (-1, 1), (-0.9, 0.63)) > 0
+
+    def vectorized_disk(positions):
+        return np.sum(positions**2, axis=1) < 13
+
+    syst0 = kwant.Builder()
+    added0 = syst0.fill(template, scalar(disk), (0, 0))
+    syst1 = kwant.Builder()
+    added1 = syst1.fill(template, builder.Vectorized(vectorized_disk), (0, 0))
+    check_same(syst0, syst1)
+    assert sorted(added0) == sorted(added1)
+
+    # The same vectorized shape can be used with lattices.
+    syst2 = kwant.Builder()
+    syst2[lat.shape(builder.Vectorized(vectorized_disk), (0, 0))] = 0
+    assert set(syst2.sites()) == set(syst1.sites())
+
+    # Adjacent regions filled separately are interconnected.
+    syst1 = kwant.Builder()
+    syst1.fill(template, vectorized(lambda p: disk(p) and halfplane(p)),
+               (-2, 1))
+    syst1.fill(template, vectorized(lambda p: disk(p) and not halfplane(p)),
+               (0, 0))
+    check_same(syst0, syst1)
+
+    # Targets with translational symmetry and a template without.  On the
+    # square lattice, the positions are equal to the tags.
+    g = kwant.lattice.square()
+    template_2d = builder.Builder(kwant.TranslationalSymmetry((-1, 0),
+                                                              (0, 1)))
+    template_2d[g(0, 0)] = 4
+    template_2d[g.neighbors()] = -1
+    template_2d[builder.HoppingKind((2, 1), g)] = 1j
+    finite = builder.Builder()
+    finite.fill(template_2d, lambda s: abs(s.tag[0]) + abs(s.tag[1]) < 9,
+                g(0, 0))
+    for templ, sym, shape in [
+            (template_2d, kwant.TranslationalSymmetry((3, 0)),
+             lambda p: -4 <= p[1] < 5),
+            (template_2d, kwant.TranslationalSymmetry((2, 2)),
+             lambda p: -4 <= p[0] - p[1] < 5),
+            (finite, builder.NoSymmetry(), lambda p: p[0] > -3)]:
+        target0 = builder.Builder(sym)
+        target0.fill(templ, scalar(shape), g(0, 1))
+        target1 = builder.Builder(sym)
+        target1.fill(templ, vectorized(shape), g(0, 1))
+        check_same(target0, target1)
+
+    # max_sites and the warnings behave as for ordinary shapes.
+    everywhere = builder.Vectorized(
+        lambda positions: np.ones(len(positions), bool))
+    target = builder.Builder()
+    with raises(RuntimeError):
+        target.fill(template_2d, everywhere, g(0, 0), max_sites=100)
+    assert len(list(target.sites())) == 0
+    target = builder.Builder(kwant.TranslationalSymmetry((10, 0)))
+    assert len(target.fill(template_2d, vectorized(
+        lambda p: abs(p[1]) < 3), g(0, 0), max_sites=50)) == 50
+    nowhere = builder.Vectorized(
+        lambda positions: np.zeros(len(positions), bool))
+    with warns(RuntimeWarning):
+        target.fill(template_2d, nowhere, g(50, 50))
+    with warns(RuntimeWarning):
+        target.fill(template_2d, everywhere, g(0, 0))
+
+    # Sites with tags that are too large for the vectorized fill neither
+    # break it nor get lost, and such tags are filled site by site.
+    far = 2**40
+    for start in [g(0, 0), g(far, 1)]:
+        def shape(p):
+            return abs(p[1]) < 2 and -3 < p[0] - start.tag[0] < 3
+
+        target0 = builder.Builder()
+        target0[g(far, 0)] = 1
+        target0.fill(template_2d, scalar(shape), start)
+        target1 = builder.Builder()
+        target1[g(far, 0)] = 1
+        target1.fill(template_2d, vectorized(shape), start)
+        check_same(target0, target1)
+        assert g(far, 0) in target1
+
+    # The fill continues site by site once it reaches such tags.
+    edge = 2**(builder._FillTemplate(template_2d).bits - 1)
+
+    def shape(p):
+        return abs(p[1]) < 2 and edge - 4 < p[0] < edge + 4
+
+    target0 = builder.Builder()
+    target0.fill(template_2d, scalar(shape), g(edge - 3, 0))
+    target1 = builder.Builder()
+    target1.fill(template_2d, vectorized(shape), g(edge - 3, 0))
+    check_same(target0, target1)
+    assert len(list(target1.sites())) == 21
+
+
 def test_attach_lead():
     fam = builder.SimpleSiteFamily()
     fam_noncommensurate = builder.SimpleSiteFamily(name='other')
@@ -942,6 +1248,49 @@ def test_closest():
                         assert dd >= 0.999999 * dist
 
 
+def test_spatial_queries():
+    rng = ensure_rng(7)
+    lat = kwant.lattice.kagome(norbs=1)
+    syst = builder.Builder()
+    syst[lat.shape(lambda pos: np.linalg.norm(pos) < 8, (0, 0))] = 0
+    syst[lat.neighbors()] = 1
+    fsyst = syst.finalized()
+    sites = list(syst.sites())
+    positions = np.array([site.pos for site in sites])
+    points = 10 * rng.random_sample((50, 2)) - 5
+
+    closest = syst.closest(points)
+    ids = fsyst.closest(points)
+    for point, site, i in zip(points, closest, ids):
+        dist = np.linalg.norm(positions - point, axis=1)
+        assert np.isclose(np.linalg.norm(site.pos - point), dist.min())
+        assert fsyst.sites[i] == site
+        assert syst.closest(point) == site
+        assert fsyst.closest(point) == i
+        within = np.flatnonzero(dist <= 1.5)
+        assert (set(syst.sites_within(point, 1.5))
+                == set(sites[j] for j in within))
+        assert (sorted(fsyst.sites[j] for j in fsyst.sites_within(point, 1.5))
+                == sorted(sites[j] for j in within))
+    assert [len(group) for group in syst.sites_within(points, 1.5)] == [
+        len(group) for group in fsyst.sites_within(points, 1.5)]
+
+    # The index follows modifications of the builder.
+    del syst[closest[0]]
+    assert syst.closest(points[0]) != closest[0]
+    assert closest[0] not in syst.sites_within(points[0], 1.5)
+    syst[closest[0]] = 0
+    assert syst.closest(points[0]) == closest[0]
+
+    assert builder.Builder().closest((0, 0)) is None
+    assert builder.Builder().sites_within([(0, 0)], 1) == [[]]
+    with raises(ValueError):
+        fsyst.closest((0, 0, 0))
+    with raises(ValueError):
+        builder.Builder(kwant.TranslationalSymmetry((1, 0))).sites_within(
+            (0, 0), 1)
+
+
 def test_update():
     lat = builder.SimpleSiteFamily()
 
@@ -1022,6 +1371,43 @@ def test_HoppingKind():
         assert len({hk: 0, hk2:1, hk3: 2}) == 2
 
 
+def test_setting_HoppingKinds():
+    def graph(syst):
+        return {tail: (hvhv[1], set(zip(hvhv[2::2], hvhv[3::2])))
+                for tail, hvhv in syst.H.items()}
+
+    g = kwant.lattice.general(ta.identity(3), name='some_lattice')
+    h = kwant.lattice.general(ta.identity(3), name='another_lattice')
+    fam = builder.SimpleSiteFamily()
+    kinds = [builder.HoppingKind((1, 0, 0), g, h),
+             builder.HoppingKind((1, 0, 0), h, g),
+             builder.HoppingKind((0, 4, 0), h),
+             builder.HoppingKind((0, 1, 1), g),
+             builder.HoppingKind((1, 0), fam),
+             builder.HoppingKind((0, 0, 1), g,
+                                 kwant.lattice.general(ta.identity(3)))]
+    f = builder.HermConjOfFunc(lambda a, b: 1j)
+    for sym in [builder.NoSymmetry(), kwant.TranslationalSymmetry((0, 2, 0))]:
+        syst0, syst1 = builder.Builder(sym), builder.Builder(sym)
+        for syst in [syst0, syst1]:
+            syst[((h if max(x, y, z) % 2 else g)(x, y, z)
+                  for x in range(4) for y in range(2) for z in range(4))] = 0
+            if isinstance(sym, builder.NoSymmetry):
+                syst[(fam(i, 0) for i in range(3))] = 0
+        for value in [1, f]:
+            # Set the hoppings one by one for the reference.
+            for kind in kinds:
+                syst0[list(kind(syst0))] = value
+            syst1[kinds] = value
+            assert graph(syst0) == graph(syst1)
+            assert len(list(syst1.hoppings())) > 10
+        syst1[kinds[0]] = 2
+        assert all(syst1[hop] == 2 for hop in kinds[0](syst1))
+
+    with raises(ValueError):
+        syst1[builder.HoppingKind((0, 0, 0), g)] = 1
+
+
 def test_invalid_HoppingKind():
     g = kwant.lattice.general(ta.identity(3))
     h = kwant.lattice.general(np.identity(3)[:-1])  # 2D lattice in 3D
@@ -1262,6 +1648,100 @@ def test_argument_passing():
     )
 
 
+def test_vectorized_value_functions():
+    lat = kwant.lattice.square(norbs=2)
+    sigma_z = np.array([[1, 0], [0, -1]])
+    sigma_x = np.array([[0, 1], [1, 0]])
+
+    def onsite(site, V, t, phi):
+        x, y = site.pos
+        return (4 * t + V * np.cos(x) * np.sin(y)) * sigma_z
+
+    def hopping(site1, site2, V, t, phi):
+        x1, y1 = site1.pos
+        x2, y2 = site2.pos
+        return -t * np.exp(1j * phi * (x1 - x2) * (y1 + y2)) * sigma_x
+
+    def vec_onsite(sites, V, t, phi):
+        x, y = sites.positions.T
+        return (4 * t + V * np.cos(x) * np.sin(y))[:, None, None] * sigma_z
+
+    def vec_hopping(sites1, sites2, V, t, phi):
+        x1, y1 = sites1.positions.T
+        x2, y2 = sites2.positions.T
+        phase = np.exp(1j * phi * (x1 - x2) * (y1 + y2))
+        return -t * phase[:, None, None] * sigma_x
+
+    def make_system(onsite, hopping, sym=kwant.builder.NoSymmetry(), L=4):
+        syst = kwant.Builder(sym)
+        syst[(lat(x, y) for x in range(L) for y in range(3))] = onsite
+        syst[lat.neighbors()] = hopping
+        return syst
+
+    syst = make_system(onsite, hopping).finalized()
+    vec_syst = make_system(builder.Vectorized(vec_onsite),
+                           builder.Vectorized(vec_hopping)).finalized()
+    params = dict(V=0.3, t=1.2, phi=0.4)
+    for sparse in (False, True):
+        expected = syst.hamiltonian_submatrix(params=params, sparse=sparse)
+        got = vec_syst.hamiltonian_submatrix(params=params, sparse=sparse)
+        if sparse:
+            expected, got = expected.toarray(), got.toarray()
+        assert_almost_equal(got, expected)
+        got = vec_syst.hamiltonian_submatrix(args=(0.3, 1.2, 0.4),
+                                             sparse=sparse)
+        if sparse:
+            got = got.toarray()
+        assert_almost_equal(got, expected)
+
+    # Single matrix elements and submatrices fall back to calling the value
+    # functions with site arrays of length one.
+    for i, j in [(0, 0), (0, 1), (1, 0)]:
+        assert_almost_equal(vec_syst.hamiltonian(i, j, params=params),
+                            syst.hamiltonian(i, j, params=params))
+    sites = [1, 3, 4]
+    assert_almost_equal(
+        vec_syst.hamiltonian_submatrix(to_sites=sites, params=params),
+        syst.hamiltonian_submatrix(to_sites=sites, params=params))
+
+    # Mixing vectorized and ordinary value functions, and parameter
+    # substitution.
+    mixed = make_system(onsite, builder.Vectorized(vec_hopping))
+    mixed = mixed.subs(phi='B').finalized()
+    assert_almost_equal(
+        mixed.hamiltonian_submatrix(params=dict(V=0.3, t=1.2, B=0.4)),
+        syst.hamiltonian_submatrix(params=params))
+
+    # Scalars and single matrices are used for all sites.
+    single = make_system(builder.Vectorized(lambda s: 2 * np.eye(2)),
+                         builder.Vectorized(lambda a, b: 1j * sigma_x))
+    plain = make_system(2 * np.eye(2), 1j * sigma_x)
+    assert_almost_equal(single.finalized().hamiltonian_submatrix(),
+                        plain.finalized().hamiltonian_submatrix())
+
+    # Wrong number of orbitals or of values.
+    for bad in (lambda s: np.zeros((len(s), 3, 3)),
+                lambda s: np.zeros((len(s) + 1, 2, 2))):
+        bad_syst = make_system(builder.Vectorized(bad), hopping).finalized()
+        raises(ValueError, bad_syst.hamiltonian_submatrix, params=params)
+
+    # Systems with leads.
+    def attach_leads(syst, onsite, hopping):
+        lead = make_system(onsite, hopping, kwant.TranslationalSymmetry((-1, 0)),
+                           L=1)
+        syst.attach_lead(lead)
+        syst.attach_lead(lead.reversed())
+        return syst.finalized()
+
+    syst = attach_leads(make_system(onsite, hopping), onsite, hopping)
+    vec_onsite, vec_hopping = map(builder.Vectorized, (vec_onsite, vec_hopping))
+    vec_syst = attach_leads(make_system(vec_onsite, vec_hopping),
+                            vec_onsite, vec_hopping)
+    smatrix = kwant.smatrix(syst, 0.5, params=params).data
+    assert_almost_equal(kwant.smatrix(vec_syst, 0.5, params=params).data,
+                        smatrix)
+
+
 def test_parameter_substitution():
 
     Subs = builder.ParameterSubstitution
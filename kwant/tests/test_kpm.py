@@ -6,12 +6,14 @@
 # the file AUTHORS.rst at the top-level directory of this distribution and at
 # http://kwant-project.org/authors.
 
+import io
 from copy import copy as copy
 from types import SimpleNamespace
 
 import pytest
 import numpy as np
 import scipy.sparse.linalg as sla
+from scipy.sparse import csr_matrix
 from scipy.integrate import simps
 
 import kwant
@@ -389,6 +391,145 @@ def test_increase_num_vectors():
     assert np.all(spectrum_raise.densities == spectrum.densities)
 
 
+def test_block_recursion():
+    # The moments of all the vectors, computed together, agree with the
+    # Chebyshev recursion for each vector.
+    rng = ensure_rng(3)
+    vectors = [rng.randn(dim) for r in range(4)]
+    vectors.append(np.exp(2j * np.pi * rng.random_sample(dim)))
+    for operator in [None, np.diag(np.arange(dim))]:
+        factory = iter(vectors).__next__
+        spectrum = SpectralDensity(ham, operator=operator, num_moments=11,
+                                   num_vectors=len(vectors),
+                                   vector_factory=lambda n: factory())
+        h = (ham - spectrum._b * np.identity(dim)) / spectrum._a
+        op = np.identity(dim) if operator is None else operator
+        for vector, moments in zip(vectors, spectrum._moments_list):
+            alpha, alpha_next = vector, h.dot(vector)
+            expected = [np.vdot(vector, op.dot(alpha)),
+                        np.vdot(vector, op.dot(alpha_next))]
+            for n in range(2, 11):
+                alpha, alpha_next = alpha_next, 2 * h.dot(alpha_next) - alpha
+                expected.append(np.vdot(vector, op.dot(alpha_next)))
+            assert_allclose(moments, expected)
+
+
+def test_save_load():
+    for operator in [None, np.diag(np.arange(dim))]:
+        spectrum = SpectralDensity(ham, operator=operator, num_moments=10,
+                                   num_vectors=3, rng=1)
+        for save_vectors in [True, False]:
+            file = io.BytesIO()
+            spectrum.save(file, save_vectors=save_vectors)
+            file.seek(0)
+            loaded = SpectralDensity.load(file, ham, operator=operator)
+            assert loaded.bounds == spectrum.bounds
+            assert np.all(loaded.densities == spectrum.densities)
+            if not save_vectors:
+                with pytest.raises(ValueError):
+                    loaded.add_moments(5)
+                with pytest.raises(ValueError):
+                    loaded.save(io.BytesIO(), save_vectors=True)
+        # The calculation is resumed where it was saved, including the
+        # state of the random number generator.
+        loaded.add_vectors(2)
+        spectrum.add_vectors(2)
+        assert np.all(loaded.densities == spectrum.densities)
+        file = io.BytesIO()
+        spectrum.save(file, save_vectors=True)
+        file.seek(0)
+        loaded = SpectralDensity.load(file, ham, operator=operator)
+        loaded.add_moments(5)
+        spectrum.add_moments(5)
+        assert np.all(loaded.densities == spectrum.densities)
+
+    with pytest.raises(ValueError):
+        file.seek(0)
+        SpectralDensity.load(file, kwant.rmt.gaussian(dim + 1))
+
+
+def test_merge():
+    bounds = (-10, 10)
+    spectra = [SpectralDensity(ham, num_moments=10, num_vectors=num_vectors,
+                               bounds=bounds, rng=seed)
+               for seed, num_vectors in [(1, 3), (2, 1), (3, 4)]]
+    expected = sum(spectrum.num_vectors * spectrum._moments()
+                   for spectrum in spectra) / 8
+    spectra[0].merge(*spectra[1:])
+    assert spectra[0].num_vectors == 8
+    assert_allclose(spectra[0]._moments(), expected)
+    # The merged vectors can be refined further.
+    spectra[0].add_moments(5)
+    assert len(spectra[0].densities) == 30
+
+    # different rescaling, number of moments, and shape of the moments
+    with pytest.raises(ValueError):
+        spectra[0].merge(SpectralDensity(ham, num_moments=15, num_vectors=1,
+                                         rng=4))
+    with pytest.raises(ValueError):
+        spectra[0].merge(spectra[1])
+    with pytest.raises(ValueError):
+        spectra[0].merge(SpectralDensity(
+            ham, num_moments=15, num_vectors=1, bounds=bounds, rng=4,
+            operator=lambda bra, ket: np.conj(bra) * ket))
+
+
+def test_errors():
+    rng = ensure_rng(5)
+    vectors = [np.exp(2j * np.pi * rng.random_sample(dim)) for r in range(4)]
+    bounds = (-10, 10)
+    factory = iter(vectors).__next__
+    spectrum = SpectralDensity(ham, num_moments=20, num_vectors=len(vectors),
+                               bounds=bounds,
+                               vector_factory=lambda n: factory())
+    singles = [SpectralDensity(ham, num_moments=20, num_vectors=1,
+                               bounds=bounds, vector_factory=lambda n: v)
+               for v in vectors]
+    assert np.all(np.isnan(singles[0].errors))
+    assert np.all(np.isnan(singles[0].integrate(return_error=True)[1]))
+
+    def distribution(e):
+        return e < 0.5
+
+    densities = [single.densities for single in singles]
+    integrals = [single.integrate(distribution) for single in singles]
+    scale = np.sqrt(len(vectors))
+    assert_allclose(spectrum.errors, np.std(densities, axis=0, ddof=1) / scale)
+    integral, error = spectrum.integrate(distribution, return_error=True)
+    assert_allclose(integral, spectrum.integrate(distribution))
+    assert_allclose(error, np.std(integrals, ddof=1) / scale)
+
+
+def test_add_vectors_rtol():
+    spectrum = make_spectrum(ham, p, rng=2)
+    spectrum.add_vectors(rtol=0.1, batch_size=3)
+    assert spectrum._relative_error() <= 0.1
+    assert (spectrum.num_vectors - p.num_vectors) % 3 == 0
+    # The vectors are the same as if added one batch at a time.
+    reference = make_spectrum(ham, p, rng=2)
+    for i in range((spectrum.num_vectors - p.num_vectors) // 3):
+        reference.add_vectors(3)
+    assert np.all(reference.densities == spectrum.densities)
+
+    num_vectors = spectrum.num_vectors
+    with pytest.warns(RuntimeWarning):
+        spectrum.add_vectors(rtol=1e-6, max_vectors=num_vectors + 4)
+    assert spectrum.num_vectors == num_vectors + 4
+
+    # A vanishing density is converged once the errors are known.
+    spectrum = SpectralDensity(ham, operator=csr_matrix((dim, dim)),
+                               num_moments=10, num_vectors=1, rng=1)
+    spectrum.add_vectors(rtol=0.1, batch_size=2)
+    assert spectrum.num_vectors == 3
+
+    with pytest.raises(TypeError):
+        spectrum.add_vectors()
+    with pytest.raises(TypeError):
+        spectrum.add_vectors(2, rtol=0.1)
+    with pytest.raises(ValueError):
+        spectrum.add_vectors(rtol=-1)
+
+
 def test_invalid_input():
 
     with pytest.raises(TypeError):
@@ -562,3 +703,129 @@ def test_rescale():
     test this is that the product gives a complex number in the unit circle."""
     eigvalues, eigvectors = np.linalg.eigh(ham)
     assert np.all(1 - np.abs(np.vdot(eigvectors, rescaled_eigvectors)) < TOL)
+
+
+# ### Correlator
+
+
+def unit_vector_factory(dim):
+    """Return a vector factory that yields the canonical basis vectors.
+
+    Using all of them as random vectors gives the exact trace, divided by
+    the dimension.
+    """
+    vectors = iter(np.identity(dim, dtype=complex))
+    return lambda n: next(vectors)
+
+
+def test_correlator_moments():
+    rng = ensure_rng(4)
+    ops = [kwant.rmt.gaussian(dim, rng=rng) for i in range(2)]
+    num_moments = 7
+    # A small memory budget forces the moments to be computed in chunks.
+    for memory_budget in [2**30, 3 * 16 * dim**2]:
+        correlator = kwant.kpm.Correlator(
+            ham, *ops, num_vectors=dim, num_moments=num_moments,
+            vector_factory=unit_vector_factory(dim),
+            memory_budget=memory_budget)
+        correlator.add_moments(3)
+        h = (ham - correlator._b * np.identity(dim)) / correlator._a
+        chebyshev = [np.identity(dim), h]
+        for n in range(2, num_moments + 3):
+            chebyshev.append(2 * h.dot(chebyshev[-1]) - chebyshev[-2])
+        expected = [[np.trace(ops[0] @ t_m @ ops[1] @ t_n) for t_n in
+                     chebyshev] for t_m in chebyshev]
+        assert_allclose_sp(dim * correlator._moments(), expected)
+
+    # Adding vectors is the same as using them from the start.
+    correlator = kwant.kpm.Correlator(ham, *ops, num_vectors=4,
+                                      num_moments=num_moments, rng=1)
+    correlator.add_vectors(3)
+    precise = kwant.kpm.Correlator(ham, *ops, num_vectors=7,
+                                   num_moments=num_moments, rng=1)
+    assert_allclose(correlator._moments(), precise._moments())
+    assert_allclose(correlator(0.1), precise(0.1))
+
+
+def test_correlator_kubo_bastin():
+    # Compare with the Kubo-Bastin formula evaluated in the eigenbasis of
+    # the Hamiltonian, for a chemical potential inside of a gap.
+    rng = ensure_rng(1)
+    size = 10
+    ham, op1, op2 = [kwant.rmt.gaussian(size, rng=rng) for i in range(3)]
+    energies, states = np.linalg.eigh(ham)
+    op1, op2 = [states.T.conj() @ op @ states for op in (op1, op2)]
+    gap = np.argmax(np.diff(energies))
+    mu = (energies[gap] + energies[gap + 1]) / 2
+    occupation = (energies < mu).astype(float)
+    differences = energies[:, None] - energies[None, :]
+    np.fill_diagonal(differences, np.inf)
+    expected = np.sum(1j * (occupation[:, None] - occupation[None, :])
+                      * op1 * op2.T / differences**2).real
+
+    correlator = kwant.kpm.Correlator(
+        ham, states @ op1 @ states.T.conj(), states @ op2 @ states.T.conj(),
+        num_vectors=size, num_moments=400,
+        vector_factory=unit_vector_factory(size))
+    assert abs(size * correlator(mu) - expected) < TOL_WEAK * abs(expected)
+    # No states are occupied below the spectrum.
+    assert correlator(correlator.bounds[0] - 1) == 0
+    assert correlator([mu, mu]).shape == (2,)
+    assert abs(correlator(mu, temperature=1e-3) - correlator(mu)) < TOL_SP
+
+    with pytest.raises(ValueError):
+        correlator(mu, temperature=-1)
+    with pytest.raises(TypeError):
+        kwant.kpm.Correlator(ham, num_moments=10, energy_resolution=0.1)
+
+
+def test_conductivity():
+    lat = kwant.lattice.square(norbs=2)
+    syst = kwant.Builder()
+    syst[(lat(i, j) for i in range(4) for j in range(3))] = np.diag([1, -1])
+    syst[lat.neighbors()] = np.array([[1, 1j], [1j, -1]])
+    fsyst = syst.finalized()
+    hamiltonian = fsyst.hamiltonian_submatrix(sparse=True)
+    positions = np.repeat([s.pos for s in fsyst.sites], 2, axis=0)
+
+    # The velocity operator from the system agrees with the commutator.
+    x = np.diag(positions[:, 0])
+    velocity = 1j * (hamiltonian @ x - x @ hamiltonian)
+    sigma = kwant.kpm.conductivity(fsyst, 'x', 'x', num_moments=20,
+                                   num_vectors=3, rng=0)
+    reference = kwant.kpm.Correlator(fsyst, velocity, velocity,
+                                     num_moments=20, num_vectors=3, rng=0)
+    assert_allclose(sigma._moments(), reference._moments())
+
+    sigma_xy = kwant.kpm.conductivity(hamiltonian, 'x', 'y',
+                                      positions=positions, num_moments=20,
+                                      num_vectors=3, rng=0)
+    assert np.isfinite(sigma_xy([-1, 0, 1])).all()
+    # The longitudinal conductivity is non-negative, if the trace is exact.
+    sigma = kwant.kpm.conductivity(
+        fsyst, num_moments=20, num_vectors=hamiltonian.shape[0],
+        vector_factory=unit_vector_factory(hamiltonian.shape[0]))
+    assert np.all(sigma(np.linspace(-2, 2, 11)) > -TOL_SP)
+    assert np.all(sigma(np.linspace(-2, 2, 11), temperature=0.1) > -TOL_SP)
+
+    # In a metal, the Fermi surface term at low temperature converges to
+    # the one at zero temperature.
+    lat = kwant.lattice.square(norbs=1)
+    metal = kwant.Builder()
+    metal[(lat(i, j) for i in range(8) for j in range(8))] = 0
+    metal[lat.neighbors()] = -1
+    metal = metal.finalized()
+    sigma = kwant.kpm.conductivity(metal, num_moments=40, num_vectors=64,
+                                   vector_factory=unit_vector_factory(64),
+                                   bounds=(-4, 4))
+    mu = 0.3
+    assert sigma(mu) > 0.1
+    for temperature in [1e-8, 1e-5, 1e-3]:
+        assert abs(sigma(mu, temperature) - sigma(mu)) < 10 * temperature
+
+    with pytest.raises(ValueError):
+        kwant.kpm.conductivity(hamiltonian, 'x', 'x')
+    with pytest.raises(ValueError):
+        kwant.kpm.conductivity(fsyst, 'x', 'z')
+    with pytest.raises(ValueError):
+        kwant.kpm.conductivity(fsyst, 'x', 'w')
@@ -27,6 +27,19 @@ def test_closest():
         tag = rng.randint(10, size=(3,))
         assert lat.closest(lat(*tag).pos) == tag
 
+    # Many positions at once, compared with the exhaustive search.
+    for vecs in [rng.randn(2, 2), rng.randn(3, 3), rng.randn(2, 3)]:
+        lat = lattice.general(vecs, [rng.randn(vecs.shape[1])]).sublattices[0]
+        points = 10 * rng.randn(100, vecs.shape[1])
+        tags = lat.closest(points)
+        assert tags.shape == (100, len(vecs))
+        for point, tag in zip(points, tags):
+            assert np.allclose(np.linalg.norm(point - lat(*tag).pos),
+                               np.linalg.norm(point - lat(*lat.n_closest(
+                                   point)[0]).pos))
+    with pytest.raises(ValueError):
+        lat.closest(np.zeros((2, 2)))
+
 
 def test_general():
     for lat in (lattice.general(((1, 0), (0.5, 0.5))),
@@ -83,6 +96,36 @@ def test_shape():
         assert len(sites) > 35
 
 
+def test_vectorized_shape():
+    def in_circle(pos):
+        return pos[0] ** 2 + pos[1] ** 2 < 30
+
+    def in_circle_vectorized(pos):
+        return np.sum(pos**2, axis=1) < 30
+
+    vectorized = builder.Vectorized(in_circle_vectorized)
+    for lat in [lattice.honeycomb(), lattice.kagome(), lattice.square()]:
+        sites = list(lat.shape(vectorized, (0.2, 0.1))())
+        assert len(sites) == len(set(sites))
+        assert set(sites) == set(lat.shape(in_circle, (0.2, 0.1))())
+
+        # Restriction to the fundamental domain of a symmetry.
+        sym = lattice.TranslationalSymmetry(lat.vec((1, 0)))
+        def ribbon(pos):
+            return abs(pos[1]) < 4
+        def ribbon_vectorized(pos):
+            return abs(pos[:, 1]) < 4
+        sites = list(lat.shape(builder.Vectorized(ribbon_vectorized),
+                               (0, 0))(sym))
+        assert len(sites) == len(set(sites))
+        assert set(sites) == set(lat.shape(ribbon, (0, 0))(sym))
+
+    lat = lattice.honeycomb()
+    raises(ValueError, lat.shape(vectorized, (10, 10))().__next__)
+    wrong = builder.Vectorized(lambda pos: True)
+    raises(ValueError, lat.shape(wrong, (0, 0))().__next__)
+
+
 def test_wire():
     rng = ensure_rng(5)
     vecs = rng.randn(3, 3)
@@ -84,6 +84,53 @@ def test_hamiltonian_submatrix():
     raises(ValueError, syst2.hamiltonian_submatrix, sparse=True)
 
 
+def test_hamiltonian_csc():
+    lat = kwant.lattice.square(norbs=2)
+    sigma_y = np.array([[0, -1j], [1j, 0]])
+
+    def onsite(site, V):
+        return V * np.eye(2) * site.pos[0]
+
+    def hopping(site1, site2, t, so):
+        return -t * np.eye(2) + 1j * so * sigma_y
+
+    syst = kwant.Builder()
+    syst[(lat(x, y) for x in range(4) for y in range(3))] = onsite
+    syst[lat.neighbors()] = hopping
+    syst = syst.finalized()
+
+    for params in [dict(V=0.5, t=1, so=0.2), dict(V=0, t=2, so=0),
+                   dict(V=1.5, t=0.3, so=1)]:
+        for energy in (0, 0.7):
+            mat, norb = syst._hamiltonian_csc(params=params, energy=energy)
+            assert sparse.isspmatrix_csc(mat)
+            assert mat.has_sorted_indices
+            np.testing.assert_array_equal(norb, 2)
+            expected = (syst.hamiltonian_submatrix(params=params)
+                        - energy * np.eye(mat.shape[0]))
+            np.testing.assert_array_equal(mat.toarray(), expected)
+    # Vanishing parameters do not change the sparsity pattern.
+    pattern = syst._hamiltonian_csc(params=dict(V=0, t=0, so=0))[0]
+    np.testing.assert_array_equal(pattern.indices, mat.indices)
+    np.testing.assert_array_equal(pattern.indptr, mat.indptr)
+
+    # In-place operations on the returned matrix do not affect the plan.
+    pattern.eliminate_zeros()
+    mat2 = syst._hamiltonian_csc(params=params, energy=energy)[0]
+    np.testing.assert_array_equal(mat2.toarray(), mat.toarray())
+
+    # The plan is remade when the number of orbitals changes.
+    syst = kwant.Builder()
+    chain = kwant.lattice.chain()
+    syst[(chain(i) for i in range(3))] = lambda site, n: np.eye(n)
+    syst[chain.neighbors()] = lambda a, b, n: np.ones((n, n))
+    syst = syst.finalized()
+    for n in (1, 2, 1):
+        mat = syst._hamiltonian_csc(params=dict(n=n))[0]
+        np.testing.assert_array_equal(
+            mat.toarray(), syst.hamiltonian_submatrix(params=dict(n=n)))
+
+
 def test_pickling():
     syst = kwant.Builder()
     lead = kwant.Builder(symmetry=kwant.TranslationalSymmetry([1.]))
@@ -102,3 +149,96 @@ def test_pickling():
     s = kwant.smatrix(syst, 0.1)
     for other in (syst_copy1, syst_copy2, syst_copy3, syst_copy4):
         assert np.all(kwant.smatrix(other, 0.1).data == s.data)
+
+
+def test_lead_cache():
+    calls = []
+
+    def onsite(site, V):
+        calls.append(V)
+        return 2 * V
+
+    def num_computations():
+        return len(calls) // per_computation
+
+    lat = kwant.lattice.chain()
+    lead = kwant.Builder(kwant.TranslationalSymmetry([-1]))
+    lead[lat(0)] = onsite
+    lead[lat.neighbors()] = lambda a, b, t: -t
+    lead = lead.finalized()
+
+    params = dict(V=1, t=1, unused=0)
+    # Caching is disabled by default.
+    lead.modes(0.5, params=params)
+    per_computation = len(calls)
+    lead.modes(0.5, params=params)
+    assert num_computations() == 2
+
+    lead.cache_bytes = 2**20
+    del calls[:]
+    modes = lead.modes(0.5, params=params)
+    assert num_computations() == 1
+    # Irrelevant parameters do not invalidate the cache.
+    lead.modes(0.5, params=dict(params, unused=1))
+    assert num_computations() == 1
+    # Relevant parameters and the energy do.
+    lead.modes(0.5, params=dict(params, V=0.5))
+    lead.modes(0.6, params=params)
+    assert num_computations() == 3
+    # Modifying the returned values does not affect the cache.
+    modes[0].velocities[:] = 0
+    cached = lead.modes(0.5, params=params)
+    assert num_computations() == 3
+    assert np.all(cached[0].velocities != 0)
+    # 'modes' and 'selfenergy' are cached separately.
+    del calls[:]
+    se = lead.selfenergy(0.5, params=params)
+    per_computation = len(calls)
+    lead.selfenergy(0.5, params=params)
+    assert num_computations() == 1
+    np.testing.assert_array_equal(se, lead.selfenergy(0.5, params=params))
+
+    # The oldest entries are dropped when the cache is full.
+    lead.cache_bytes = 1
+    del calls[:]
+    lead.selfenergy(0.5, params=params)
+    lead.selfenergy(0.5, params=params)
+    assert num_computations() == 2
+
+
+def test_hopping_svds_reuse():
+    lat = kwant.lattice.square(norbs=2)
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)),
+                         conservation_law=np.diag([1, -1]))
+    lead[(lat(0, y) for y in range(3))] = lambda site, B: B * np.diag([1, -1])
+    lead[lat.neighbors()] = lambda a, b, t: -t * np.eye(2)
+    lead = lead.finalized()
+    assert lead.cache_bytes == 0
+
+    hopping_svds = kwant.physics.leads.hopping_svds
+    calls = []
+
+    def counting_svds(*args, **kwargs):
+        calls.append(args)
+        return hopping_svds(*args, **kwargs)
+
+    kwant.physics.leads.hopping_svds = counting_svds
+    try:
+        # An energy sweep with default settings decomposes the hopping once,
+        # also when parameters that do not affect the hopping change.
+        for energy in np.linspace(-1, 1, 5):
+            lead.modes(energy, params=dict(B=0.1, t=1))
+        lead.modes(0.5, params=dict(B=0.2, t=1))
+        assert len(calls) == 1
+        # A different hopping is decomposed anew.
+        modes = lead.modes(0.5, params=dict(B=0.1, t=2))
+        assert len(calls) == 2
+    finally:
+        kwant.physics.leads.hopping_svds = hopping_svds
+
+    # The stored decompositions do not change the result.
+    del lead._last_hopping_svds
+    fresh = lead.modes(0.5, params=dict(B=0.1, t=2))
+    np.testing.assert_almost_equal(modes[0].velocities, fresh[0].velocities)
+    np.testing.assert_almost_equal(modes[1].selfenergy(),
+                                   fresh[1].selfenergy())
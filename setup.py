@@ -375,6 +375,22 @@ def search_libs(libs):
             return libs
 
 
+def search_openmp():
+    """Return the compiler flags for OpenMP if they work with gcc."""
+    flags = ['-fopenmp']
+    cmd = ['gcc'] + flags + ['-o/dev/null', '-xc', '-']
+    try:
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        pass
+    else:
+        p.communicate(input=b'#include <omp.h>\n'
+                      b'int main() { return omp_get_max_threads() < 1; }\n')
+        if p.wait() == 0:
+            return flags
+    return []
+
+
 def search_mumps():
     """Return the configuration for MUMPS if it is available in a known way.
 
@@ -414,6 +430,20 @@ def configure_special_extensions(exts, build_summary):
             del exts['kwant.linalg._mumps']
             build_summary.append('No MUMPS support')
 
+    #### Special config for OpenMP, used by the sparse matrix products.
+    spmv = exts['kwant.linalg._spmv']
+    if 'extra_compile_args' in spmv or 'extra_link_args' in spmv:
+        build_summary.append('User-configured OpenMP')
+    else:
+        openmp_flags = search_openmp()
+        if openmp_flags:
+            spmv['extra_compile_args'] = openmp_flags
+            spmv['extra_link_args'] = openmp_flags
+            build_summary.append('Auto-configured OpenMP')
+        else:
+            build_summary.append('No OpenMP support: sparse matrix products '
+                                 'are single-threaded')
+
     return exts
 
 
@@ -534,6 +564,8 @@ def main():
                        'kwant/graph/defs.pxd'])),
         ('kwant.linalg.lapack',
          dict(sources=['kwant/linalg/lapack.pyx'])),
+        ('kwant.linalg._spmv',
+         dict(sources=['kwant/linalg/_spmv.pyx'])),
         ('kwant.linalg._mumps',
          dict(sources=['kwant/linalg/_mumps.pyx'],
               depends=['kwant/linalg/cmumps.pxd']))])